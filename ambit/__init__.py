@@ -4,4 +4,6 @@ from ambit.flags import *
 from ambit.message import *
 from ambit.component import *
 from ambit.configuration import *
+from ambit.command import *
+from ambit.executor import *
 from ambit.controller import *
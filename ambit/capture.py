@@ -0,0 +1,256 @@
+"""Read usb traffic from pcapng captures (see docs/captures) without tshark."""
+
+from ambit.message import message_decode, message_decoder, MESSAGE_FORMAT_JSON, MESSAGE_FORMAT_MSGPACK
+from ambit.record import ReplayDevice, RECORD_CONTROL, RECORD_READ, RECORD_WRITE
+
+import mmap
+import struct
+
+from typing import Any, Iterator, List, Optional, Tuple
+
+
+PCAPNG_SECTION_HEADER = 0x0a0d0d0a
+PCAPNG_INTERFACE_DESCRIPTION = 0x00000001
+PCAPNG_SIMPLE_PACKET = 0x00000003
+PCAPNG_ENHANCED_PACKET = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+PCAPNG_OPTION_TSRESOL = 9
+
+# usbmon headers, as captured on linux.
+LINKTYPE_USB_LINUX = 189
+LINKTYPE_USB_LINUX_MMAPPED = 220
+USBMON_HEADER_SIZES = {
+        LINKTYPE_USB_LINUX: 48,
+        LINKTYPE_USB_LINUX_MMAPPED: 64,
+}
+
+USB_EVENT_SUBMIT = ord('S')
+USB_EVENT_COMPLETE = ord('C')
+
+USB_TRANSFER_CONTROL = 2
+USB_TRANSFER_BULK = 3
+
+USB_DIRECTION_IN = 0x80
+
+# screen images are uploaded in a single large bulk transfer.
+SCREEN_WRITE_MIN_BYTES = 16000
+
+
+class UsbPacket(object):
+    """One usbmon event. data is a memoryview into the mapped capture, so
+    payloads are only copied when they are used."""
+    timestamp: float
+    event: int
+    transfer_type: int
+    endpoint: int
+    device: int
+    bus: int
+    setup: bytes
+    data: memoryview
+
+    def __init__(self, timestamp, event, transfer_type, endpoint, device, bus, setup, data):
+        self.timestamp = timestamp
+        self.event = event
+        self.transfer_type = transfer_type
+        self.endpoint = endpoint
+        self.device = device
+        self.bus = bus
+        self.setup = setup
+        self.data = data
+
+    def inbound(self):
+        return bool(self.endpoint & USB_DIRECTION_IN)
+
+    def bulk(self):
+        return self.transfer_type == USB_TRANSFER_BULK
+
+    def control(self):
+        return self.transfer_type == USB_TRANSFER_CONTROL
+
+    def payload(self):
+        """Data carried to or from the device, or None for the half of the
+        transfer which carries no data (the submit of an in transfer or
+        the completion of an out transfer)."""
+        if not self.data:
+            return None
+        if self.inbound() and self.event != USB_EVENT_COMPLETE:
+            return None
+        if not self.inbound() and self.event != USB_EVENT_SUBMIT:
+            return None
+        return self.data
+
+
+class Capture(object):
+    """A memory mapped pcapng file of usbmon traffic."""
+
+    _map: Optional[mmap.mmap]
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *unused):
+        self.close()
+
+    def close(self):
+        """Unmaps the capture, unless packets still hold data from it,
+        in which case the mapping is released along with them."""
+        self._file.close()
+        if self._map is None:
+            return
+        try:
+            self._view.release()
+            self._map.close()
+        except BufferError:
+            pass
+        self._view = memoryview(b'')
+        self._map = None
+
+    def blocks(self):
+        """Yields (block type, body memoryview, byte order) for every block."""
+        view = self._view
+        offset = 0
+        order = '<'
+        while offset + 12 <= len(view):
+            block_type, = struct.unpack_from(order + 'I', view, offset)
+            if block_type == PCAPNG_SECTION_HEADER:
+                magic, = struct.unpack_from('<I', view, offset + 8)
+                order = '<' if magic == PCAPNG_BYTE_ORDER_MAGIC else '>'
+            block_length, = struct.unpack_from(order + 'I', view, offset + 4)
+            if block_length < 12 or offset + block_length > len(view):
+                break
+            yield block_type, view[offset + 8:offset + block_length - 4], order
+            offset += block_length
+
+    def packets(self):
+        """Yields a UsbPacket for every usbmon event, in capture order."""
+        interfaces = []
+        for block_type, body, order in self.blocks():
+            if block_type == PCAPNG_SECTION_HEADER:
+                interfaces = []
+            elif block_type == PCAPNG_INTERFACE_DESCRIPTION:
+                link_type, = struct.unpack_from(order + 'H', body, 0)
+                interfaces.append((link_type, self._tsresol(body[8:], order)))
+            elif block_type == PCAPNG_ENHANCED_PACKET:
+                interface_id, ts_high, ts_low, captured, _ = struct.unpack_from(order + 'IIIII', body, 0)
+                link_type, resolution = interfaces[interface_id]
+                timestamp = ((ts_high << 32) | ts_low) * resolution
+                packet = self._usb_packet(link_type, body[20:20 + captured], timestamp)
+                if packet:
+                    yield packet
+            elif block_type == PCAPNG_SIMPLE_PACKET:
+                captured = len(body) - 4
+                link_type, _ = interfaces[0]
+                packet = self._usb_packet(link_type, body[4:4 + captured], 0)
+                if packet:
+                    yield packet
+
+    @staticmethod
+    def _tsresol(options, order):
+        offset = 0
+        while offset + 4 <= len(options):
+            code, length = struct.unpack_from(order + 'HH', options, offset)
+            if code == 0:
+                break
+            if code == PCAPNG_OPTION_TSRESOL and length == 1:
+                value = options[offset + 4]
+                if value & 0x80:
+                    return 2 ** -(value & 0x7f)
+                return 10 ** -value
+            offset += 4 + ((length + 3) & ~3)
+        return 1e-6
+
+    @staticmethod
+    def _usb_packet(link_type, frame, timestamp):
+        header_size = USBMON_HEADER_SIZES.get(link_type)
+        if header_size is None or len(frame) < header_size:
+            return None
+        # usbmon headers are in host byte order; captures here are little endian.
+        event, transfer_type, endpoint, device, bus = struct.unpack_from('<BBBBH', frame, 8)
+        setup = bytes(frame[40:48])
+        return UsbPacket(timestamp, event, transfer_type, endpoint, device, bus, setup, frame[header_size:])
+
+    def bulk_payloads(self, inbound=None):
+        """Yields packets carrying bulk data, optionally in one direction."""
+        for packet in self.packets():
+            if not packet.bulk() or packet.payload() is None:
+                continue
+            if inbound is not None and packet.inbound() != inbound:
+                continue
+            yield packet
+
+    def control_payloads(self):
+        """Yields control transfer submissions and completions."""
+        for packet in self.packets():
+            if packet.control():
+                yield packet
+
+    def message_format(self):
+        for packet in self.bulk_payloads():
+            if bytes(packet.data[:1]) == b'~':
+                return MESSAGE_FORMAT_MSGPACK
+            return MESSAGE_FORMAT_JSON
+        return MESSAGE_FORMAT_JSON
+
+    def messages(self, inbound=True):
+        """Yields the messages decoded from one direction of the bulk
+        stream, carrying partial messages across transfers."""
+        decoder = message_decoder(self.message_format())
+        for packet in self.bulk_payloads(inbound):
+            # image uploads carry a binary tail which is not a message.
+            if not inbound and len(packet.data) >= SCREEN_WRITE_MIN_BYTES:
+                continue
+            for message in decoder.feed(packet.data):
+                yield message
+
+    def images(self):
+        """Yields (index, image bytes) for each screen image upload."""
+        message_format = self.message_format()
+        for packet in self.bulk_payloads(inbound=False):
+            if len(packet.data) < SCREEN_WRITE_MIN_BYTES:
+                continue
+            messages, image = message_decode(packet.data, message_format)
+            if messages and 'screen_write' in messages[0]:
+                yield messages[0]['screen_write'], bytes(image)
+
+    def replay_entries(self):
+        """Converts the capture into ambit.record entries: device reads,
+        host writes and control responses, timed from the first one."""
+        entries = []
+        start = None
+        for packet in self.packets():
+            if packet.bulk():
+                kind = RECORD_READ if packet.inbound() else RECORD_WRITE
+                payload = packet.payload()
+                if payload is None:
+                    continue
+                payload = bytes(payload)
+            elif packet.control() and packet.event == USB_EVENT_COMPLETE:
+                kind = RECORD_CONTROL
+                payload = packet.setup[:2] + bytes(packet.data)
+            else:
+                continue
+            if start is None:
+                start = packet.timestamp
+            entries.append((kind, packet.timestamp - start, payload))
+        return entries
+
+
+class CaptureDevice(ReplayDevice):
+    """Replays the device side of a capture into a Controller, the way
+    ambit.record.ReplayDevice replays a recording."""
+
+    def __init__(self, path, speed=1):
+        self.path = path
+        self.speed = speed
+        with Capture(path) as capture:
+            self._legacy = capture.message_format() == MESSAGE_FORMAT_JSON
+            self._entries = capture.replay_entries()
+        self.device_id = 'CAPTURE'
+        self.interface_id = 0
+        self.handle = None
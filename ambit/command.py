@@ -0,0 +1,171 @@
+import ambit.trace
+
+import collections
+import os
+import subprocess
+import threading
+import time
+
+from typing import Any, Callable, List
+
+
+def command_argv(argv, value):
+    """Substitute %AMBIT_VALUE% in each argument with the value."""
+    return [a.replace('%AMBIT_VALUE%', str(value)) for a in argv]
+
+
+def command_env(value):
+    """Environment for a command, leaving the process environment alone."""
+    env = dict(os.environ)
+    env['AMBIT_VALUE'] = str(value)
+    return env
+
+
+class CommandCache(object):
+    """Command output by key, kept for ttl seconds. Once more than
+    max_entries are stored, the least recently used entry is evicted."""
+
+    DEFAULT_MAX_ENTRIES = 16
+
+    def __init__(self, ttl, max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max(1, int(max_entries))
+        self.lock = threading.Lock()
+        # key -> (expiry, output), least recently used first.
+        self.entries = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, output):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, output)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class CommandRunner(object):
+    """Runs the command of one executeCommand binding.
+
+    At most max_concurrency instances of the command run at once. Values
+    which arrive while that many are running are coalesced, so only the
+    latest one runs when an instance completes. With a debounce, a value
+    only runs once no newer one has arrived for that many seconds. With a
+    cache, output is reused while it is fresh instead of rerunning."""
+
+    DEFAULT_DEBOUNCE_SECONDS = 0
+    DEFAULT_MAX_CONCURRENCY = 1
+
+    argv: List[str]
+    output_callback: Callable
+
+    def __init__(self, argv, output_callback=None, debounce=DEFAULT_DEBOUNCE_SECONDS,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, done_callback=None, cache=None):
+        self.argv = argv
+        self.cache = cache
+        self.output_callback = output_callback
+        self.done_callback = done_callback
+        self.debounce = debounce
+        self.max_concurrency = max(1, int(max_concurrency))
+
+        self.lock = threading.Lock()
+        self.timer = None
+        self.pending = False
+        self.pending_value = None
+        self.pending_context = None
+        self.running = 0
+
+        self.launched = 0
+        self.coalesced = 0
+
+    def run(self, value):
+        with self.lock:
+            if self.pending:
+                self.coalesced += 1
+            self.pending = True
+            self.pending_value = value
+            self.pending_context = ambit.trace.current()
+            if self.debounce:
+                # trailing edge: restart the quiet period on every value.
+                if self.timer:
+                    self.timer.cancel()
+                self.timer = threading.Timer(self.debounce, self.debounced)
+                self.timer.start()
+                return
+            self.launch()
+
+    def debounced(self):
+        with self.lock:
+            self.timer = None
+            self.launch()
+
+    def launch(self):
+        # must be called with the lock held.
+        while self.pending and not self.timer and self.running < self.max_concurrency:
+            value, context = self.pending_value, self.pending_context
+            self.pending = False
+            self.pending_value = None
+            self.pending_context = None
+            self.running += 1
+            self.launched += 1
+            threading.Thread(target=self.execute, args=(value, context)).start()
+
+    def execute(self, value, context=None):
+        try:
+            with ambit.trace.activate(context):
+                with ambit.trace.span('command', argv=str(self.argv)):
+                    output = self.command(value)
+                if output and self.output_callback:
+                    self.output_callback(output)
+        except Exception as err:
+            print('[!] Command %s failed: %r' % (self.argv, err))
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.launch()
+            if self.done_callback:
+                self.done_callback()
+
+    def command(self, value):
+        """Run the command once and return the first line of its stdout."""
+        cmd = command_argv(self.argv, value)
+        # AMBIT_VALUE is passed in the environment too, so it is part of
+        # the key even when the argv does not reference it.
+        key = (tuple(cmd), str(value))
+        if self.cache:
+            output = self.cache.get(key)
+            if output is not None:
+                print('[0] Using cached output of command: %s' % cmd)
+                return output
+        print('[0] Executing command: %s' % cmd)
+        p = subprocess.run(cmd, env=command_env(value), stdout=subprocess.PIPE)
+        output = p.stdout.decode().split('\n')[0].strip()
+        if self.cache:
+            self.cache.put(key, output)
+        return output
+
+    def cancel(self):
+        """Forget any value waiting for the debounce period to end."""
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            self.pending = False
+            self.pending_value = None
+            self.pending_context = None
+
+    def idle(self):
+        with self.lock:
+            return not self.pending and not self.running
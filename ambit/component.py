@@ -2,9 +2,9 @@ from ambit.configuration import Configuration
 from ambit.flags import FLAGS
 
 import ambit.coordinates
+import ambit.trace
 
-import copy
-
+from types import MappingProxyType
 from typing import Any, Callable, Dict, List, Tuple
 
 
@@ -20,11 +20,313 @@ INPUT_TYPE_DISPATCH_ORDER = [
 ]
 
 
+def _value_changed(values, previous_values, vindex):
+    if len(previous_values) < vindex + 1:
+        return True
+    return previous_values[vindex] != values[vindex]
+
+
+def _pressed(values, previous_values):
+    return values[0] == 1 and _value_changed(values, previous_values, 0)
+
+
+def _released(values, previous_values):
+    return values[0] == 0 and _value_changed(values, previous_values, 0)
+
+
+def _core_pressed(values, previous_values):
+    # the core button reports 1 or 3 for as long as it is held.
+    return values[0] == 1 or values[0] == 3
+
+
+def _dial_set(values, previous_values):
+    return _value_changed(values, previous_values, 3)
+
+
+def _dial_rotation_right(values, previous_values):
+    return values[2] > 0
+
+
+def _dial_rotation_left(values, previous_values):
+    return values[1] > 0
+
+
+def _always(values, previous_values):
+    return True
+
+
+class InputDispatch(object):
+    """The input types an event on one component kind can raise, limited
+    to the bound ones. Each has a test on the values; the mask of tests
+    which pass indexes a table of the (input_type, vindex) pairs to
+    dispatch, in INPUT_TYPE_DISPATCH_ORDER."""
+    tests: Tuple[Callable, ...]
+    table: Tuple[Tuple[Tuple[int, int], ...], ...]
+
+    def __init__(self, kind, input_types=None):
+        conditions = [c for c in Component.input_conditions(kind)
+                if input_types is None or c[0] in input_types]
+        self.tests = tuple(test for _, _, test in conditions)
+        self.table = tuple(
+                tuple((input_type, vindex)
+                    for bit, (input_type, vindex, _) in enumerate(conditions)
+                    if mask & (1 << bit))
+                for mask in range(1 << len(conditions)))
+
+    def inputs(self, values, previous_values):
+        mask = 0
+        bit = 1
+        for test in self.tests:
+            if test(values, previous_values):
+                mask |= bit
+            bit <<= 1
+        return self.table[mask]
+
+
+# InputDispatch per (kind, bound input types), shared by every component
+# of a kind with the same bindings.
+_input_dispatches: Dict[Tuple[int, Any], InputDispatch] = {}
+
+
+def input_dispatch(kind, input_types=None):
+    """The InputDispatch for kind, considering only input_types (or every
+    input type when None)."""
+    key = (kind, input_types)
+    dispatch = _input_dispatches.get(key)
+    if dispatch is None:
+        dispatch = _input_dispatches[key] = InputDispatch(kind, input_types)
+    return dispatch
+
+
+def canonical_config(value):
+    """A hashable form of an action config, equal for equal configs
+    regardless of key order."""
+    if isinstance(value, dict):
+        return ('{}', tuple(sorted((str(k), canonical_config(v)) for k, v in value.items())))
+    if isinstance(value, (list, tuple)):
+        return ('[]', tuple(canonical_config(v) for v in value))
+    try:
+        hash(value)
+    except TypeError:
+        return ('repr', repr(value))
+    return value
+
+
+class CompiledQuery(object):
+    """A parsed component query: the index to start from, the predicates
+    remaining components must pass and the rowwise and select filters."""
+
+    # checked in this order when choosing an index, most selective first.
+    INDEXED = (
+        ('uid', 'components_by_uid'),
+        ('slot', 'components_by_slot'),
+        ('kind', 'components_by_kind'),
+        ('orientation', 'components_by_orientation'),
+    )
+
+    def __init__(self, search_kwargs, select=None):
+        self.search_kwargs = search_kwargs
+        self.select = select
+        self.rowwise = bool(search_kwargs.get('rowwise'))
+        fields = [(k, v) for k, v in search_kwargs.items()
+                  if k != 'rowwise' and v is not None]
+        self.key = (tuple(sorted(fields)), self.rowwise, select)
+        self.index_name = None
+        self.index_value = None
+        indexed_field = None
+        for name, index_name in CompiledQuery.INDEXED:
+            if search_kwargs.get(name) is not None:
+                indexed_field = name
+                self.index_name = index_name
+                self.index_value = search_kwargs[name]
+                break
+        # (attribute, value) checks for the fields the index does not cover.
+        self.predicates = tuple((k, v) for k, v in fields if k != indexed_field)
+
+    def run(self, layout):
+        if self.index_name:
+            candidates = getattr(layout, self.index_name).get(self.index_value, ())
+        else:
+            candidates = layout.connected_components
+        components = []
+        for component in candidates:
+            for name, value in self.predicates:
+                if getattr(component, name) != value:
+                    break
+            else:
+                components.append(component)
+        if self.rowwise:
+            components = sorted_rowwise(components)
+        return components
+
+
+# CompiledQuery per query string. queries come from configuration, so
+# there are only ever a handful.
+_compiled_queries: Dict[str, CompiledQuery] = {}
+
+
+def compile_query(query):
+    """Parse a query, such as '[kind=Dial orientation=90 | rowwise |
+    select(2)]' or a bare uid, into a CompiledQuery."""
+    compiled = _compiled_queries.get(query)
+    if compiled is not None:
+        return compiled
+
+    if not (query.startswith('[') and query.endswith(']')):
+        compiled = _compiled_queries[query] = CompiledQuery({'uid': query})
+        return compiled
+
+    search_kwargs = {}
+
+    # Parse the matcher portion of the query.
+    matcher, *filters = query.lstrip('[').rstrip(']').split(' | ')
+    matcher_parts = matcher.split(' ')
+    for mp in matcher_parts:
+        k, _, v = mp.partition('=')
+        if k == 'kind':
+            for kind, kind_name in Component.KIND_NAME_MAP.items():
+                if v == kind_name:
+                    v = kind
+                    break
+        if k == 'index':
+            v = int(v)
+        if k == 'orientation':
+            v = int(v)
+        if k == 'slot':
+            x, y = v.lstrip('(').rstrip(')').split(',')
+            v = (int(x), int(y))
+        search_kwargs[k] = v
+
+    # Parse the filters.
+    select = None
+    for f in filters:
+        if f == 'rowwise':
+            search_kwargs['rowwise'] = True
+        if f.startswith('select('):
+            select = int(f.lstrip('select(').rstrip(')'))
+
+    compiled = _compiled_queries[query] = CompiledQuery(search_kwargs, select)
+    return compiled
+
+
 def sorted_rowwise(components):
     return sorted(components, key=lambda x: (-x.slot[1], x.slot[0]))
 
 
+def _identity_value(value):
+    return value
+
+
+def _constant_value(constant):
+    def callback_value(value):
+        return constant
+    return callback_value
+
+
+def _stored_value(state, change):
+    def callback_value(value):
+        return state['stored_value'] + change
+    return callback_value
+
+
+def _delta_value(invocation, invert):
+    if invert:
+        def callback_value(value):
+            return -invocation.cumulative_change
+        return callback_value
+
+    def callback_value(value):
+        return invocation.cumulative_change
+    return callback_value
+
+
+def _scaled_cycle_value(step):
+    def callback_value(value):
+        return int(value / step)
+    return callback_value
+
+
+def _scaled_trigger_value(low, step):
+    def callback_value(value):
+        return low + value / step
+    return callback_value
+
+
+def _limited_value(function, low, high, loop):
+    if loop:
+        def callback_value(value):
+            callback_value = function(value)
+            if callback_value < low:
+                return high
+            if callback_value > high:
+                return low
+            return callback_value
+        return callback_value
+
+    def callback_value(value):
+        callback_value = function(value)
+        if callback_value < low:
+            return low
+        if callback_value > high:
+            return high
+        return callback_value
+    return callback_value
+
+
+def _discrete_value(function):
+    def callback_value(value):
+        return int(function(value))
+    return callback_value
+
+
+def compile_callback_value(invocation):
+    """A function computing ComponentInvocation.callback_value for one
+    binding, built from closures with the behavior's constants folded in
+    and the branches it never takes left out. Returns None for behaviors
+    whose limits the specialized form does not handle."""
+    behavior = invocation.behavior
+    limits = behavior.limits
+    if limits is not None and (len(limits) != 2 or None in limits):
+        return None
+    if behavior.loop and not limits:
+        return None
+    scaled = invocation.input_type == Configuration.INPUT_SET and bool(limits)
+    if scaled and limits[1] == limits[0]:
+        return None
+    step = 255 / (limits[1] - limits[0]) if scaled else None
+    state = invocation.persistent_state
+
+    # the later branches of callback_value override the earlier ones.
+    if behavior.behavior == ComponentBehavior.ACCUMULATE:
+        change = behavior.value if behavior.value else invocation.threshold
+        function = _stored_value(state, -change if behavior.invert else change)
+    elif behavior.value is not None:
+        function = _constant_value(behavior.value)
+    elif behavior.behavior == ComponentBehavior.DELTA:
+        function = _delta_value(invocation, behavior.invert)
+    elif behavior.behavior == ComponentBehavior.CYCLE and scaled:
+        function = _scaled_cycle_value(step)
+    elif behavior.behavior == ComponentBehavior.CYCLE:
+        function = _stored_value(state, -1 if behavior.invert else 1)
+    elif behavior.behavior == ComponentBehavior.TRIGGER and scaled:
+        function = _scaled_trigger_value(limits[0], step)
+    else:
+        function = _identity_value
+
+    if limits:
+        function = _limited_value(function, limits[0], limits[1], behavior.loop)
+    if behavior.discrete:
+        function = _discrete_value(function)
+    return function
+
+
 class ComponentInvocation(object):
+    __slots__ = (
+        'input_type', 'action_name', 'behavior', 'function', 'vindex',
+        'action_config', 'persistent_state', 'threshold', 'data',
+        'cumulative_change', 'value_function',
+    )
+
     input_type: int
     action_name: str
     behavior: Any
@@ -36,7 +338,7 @@ class ComponentInvocation(object):
     data: Any
     cumulative_change: int
 
-    def __init__(self, input_type, action_name, behavior, callback, vindex, action_config, persistent_state):
+    def __init__(self, input_type, action_name, behavior, callback, vindex, action_config, persistent_state, data=None):
         self.input_type = input_type
         self.action_name = action_name
         self.behavior = behavior
@@ -49,11 +351,17 @@ class ComponentInvocation(object):
             self.persistent_state['stored_value'] = self.behavior.default
 
         self.threshold = self.behavior.threshold
-        self.data = behavior.data
+        # behaviors are shared between bindings, so data which belongs
+        # to one binding is passed separately.
+        self.data = behavior.data if data is None else data
 
         self.cumulative_change = 0
 
+        self.value_function = compile_callback_value(self) or self.callback_value
+
     def callback_value(self, value):
+        """Reference implementation of the value passed to the callback,
+        which compile_callback_value specializes for each binding."""
         callback_value = value
 
         change = self.cumulative_change
@@ -144,7 +452,7 @@ class ComponentInvocation(object):
                 self.input_type, self.action_name,
                 self.cumulative_change, self.threshold, value, change))
 
-        callback_value = self.callback_value(value)
+        callback_value = self.value_function(value)
 
         if not self.mandatory(callback_value) and self.cumulative_change < self.threshold:
             return
@@ -161,7 +469,11 @@ class ComponentInvocation(object):
         if self.behavior.nested:
             callback_value = (callback_value, self.behavior.items[callback_value])
 
-        self.function(callback_value, *self.data)
+        if ambit.trace.current() is None:
+            self.function(callback_value, *self.data)
+        else:
+            with ambit.trace.span('callback %s' % self.action_name, value=str(callback_value)):
+                self.function(callback_value, *self.data)
 
         return callback_value
 
@@ -172,6 +484,12 @@ class ComponentBehavior(object):
     ACCUMULATE = 'ACCUMULATE'
     DELTA = 'DELTA'
 
+    __slots__ = (
+        'behavior', 'items', 'limits', 'loop', 'invert', 'nested',
+        'discrete', 'threshold', 'value', 'default', 'data', 'action_config',
+        'frozen',
+    )
+
     behavior: int
     items: Any
     limits: Tuple[int, int]
@@ -189,6 +507,7 @@ class ComponentBehavior(object):
             loop=None, invert=None, nested=None, discrete=None,
             threshold=None, value=None, default=None, action_config=None,
             data=None):
+        self.frozen = False
         self.behavior = behavior
         self.items = items
         self.limits = limits
@@ -241,14 +560,40 @@ class ComponentBehavior(object):
                 self.behavior, self.items, self.limits,
                 self.loop, self.invert, self.threshold)
 
+    def __setattr__(self, name, value):
+        if getattr(self, 'frozen', False):
+            raise AttributeError('frozen ComponentBehavior is immutable: %s' % name)
+        object.__setattr__(self, name, value)
+
+    def freeze(self):
+        """Make the behavior immutable, so it can be shared by bindings:
+        its items and limits become tuples and its action config a read
+        only view."""
+        if self.items is not None:
+            self.items = tuple(self.items)
+        if self.limits is not None:
+            self.limits = tuple(self.limits)
+        if self.action_config is not None:
+            self.action_config = MappingProxyType(dict(self.action_config))
+        self.frozen = True
+        return self
+
+    def copy(self):
+        """An unfrozen shallow copy. Fields are replaced, never mutated in
+        place, so sharing the values with self is safe."""
+        return ComponentBehavior(
+                self.behavior, self.items, self.limits, self.loop,
+                self.invert, self.nested, self.discrete, self.threshold,
+                self.value, self.default, self.action_config, self.data)
+
     def __add__(self, other):
-        ret = copy.deepcopy(self)
+        ret = self.copy()
         if other.behavior is not None:
             ret.behavior = other.behavior
         if other.limits is not None:
             ret.limits = other.limits
         if other.items is not None:
-            ret.set_items(self.items + other.items)
+            ret.set_items(list(self.items) + list(other.items))
         if other.loop is not None:
             ret.loop = other.loop
         if other.invert is not None:
@@ -305,6 +650,16 @@ class Component(object):
         KIND_ORBITER: "Orbiter",
     }
 
+    # values reported by the device per input event.
+    VALUES_SIZE = 8
+
+    __slots__ = (
+        'index', 'uid', 'kind', 'flip', 'persistent_state',
+        'screen_string', 'screen_display', 'values', 'previous_values',
+        'callbacks', 'hidkeys', 'num_ports', 'dispatch', 'children',
+        'parent', 'parent_port', 'slot', 'orientation', 'led', 'sensitivity',
+    )
+
     def __init__(self, index, uid, kind, flip=False):
         self.index = index
         self.uid = uid
@@ -315,12 +670,14 @@ class Component(object):
         self.screen_string = ''
         self.screen_display = Configuration.ICON_BLANK
 
-        self.values = [0, 0, 0, 0, 0, 0, 0, 0]
-        self.previous_values = [0, 0, 0, 0, 0, 0, 0, 0]
+        self.values = [0] * Component.VALUES_SIZE
+        self.previous_values = [0] * Component.VALUES_SIZE
 
         self.callbacks = None
         self.hidkeys = None
         self.num_ports = None
+        # InputDispatch for the bound input types, built on first input.
+        self.dispatch = None
 
         # FIXME: do these belong in ComponentLayout?
         self.children = {}
@@ -342,82 +699,93 @@ class Component(object):
         # TODO: should we also reset persistent_state here?
         self.callbacks = {}
         self.hidkeys = []
+        self.dispatch = None
 
     def set_sensitivity(self, sensitivity):
         self.sensitivity = sensitivity
 
+    def update_values(self, values):
+        """Make the current values previous and the decoded ones current.
+        The decoded list is kept as is, which is cheaper than copying it
+        into a preallocated buffer."""
+        self.previous_values = self.values
+        self.values = values
+
+    @staticmethod
+    def input_conditions(kind):
+        """(input_type, vindex, test) for each input type an event on a
+        component of kind can raise, in dispatch order."""
+        pressed = _core_pressed if kind == Component.KIND_CORE else _pressed
+        if kind == Component.KIND_SLIDER:
+            return (
+                (Configuration.INPUT_SET, 0, _always),
+            )
+        if kind == Component.KIND_DIAL:
+            return (
+                (Configuration.INPUT_PRESSED, 0, pressed),
+                (Configuration.INPUT_RELEASED, 0, _released),
+                (Configuration.INPUT_SET, 3, _dial_set),
+                (Configuration.INPUT_ROTATION_RIGHT, 2, _dial_rotation_right),
+                (Configuration.INPUT_ROTATION_LEFT, 1, _dial_rotation_left),
+            )
+        return (
+            (Configuration.INPUT_PRESSED, 0, pressed),
+            (Configuration.INPUT_RELEASED, 0, _released),
+        )
+
     def dominant_value(self, input_type):
         vindex = self.determine_vindex(input_type)
         return self.values[vindex]
 
     def determine_vindex(self, input_type):
-        if input_type == Configuration.INPUT_PRESSED:
-            return 0
-        if input_type == Configuration.INPUT_RELEASED:
-            return 0
-        if self.kind == Component.KIND_DIAL:
-            if input_type == Configuration.INPUT_SET:
-                return 3
-            if input_type == Configuration.INPUT_ROTATION_LEFT:
-                return 1
-            if input_type == Configuration.INPUT_ROTATION_RIGHT:
-                return 2
-        if self.kind == Component.KIND_SLIDER:
-            return 0
+        for condition_type, vindex, _ in Component.input_conditions(self.kind):
+            if condition_type == input_type:
+                return vindex
         return 0
 
     def determine_input_types(self):
-        input_types = set()
-
-        if self.kind == Component.KIND_ORBITER:
-            pass
-
-        if self.kind == Component.KIND_CORE:
-            if self.values[0] == 1:
-                input_types.add(Configuration.INPUT_PRESSED)
-            if self.values[0] == 3:
-                input_types.add(Configuration.INPUT_PRESSED)
-
-        if self.kind == Component.KIND_TRI_DIAL:
-            pass
-
-        if self.value_changed(0) and self.kind != Component.KIND_SLIDER:
-            if self.values[0] == 1:
-                input_types.add(Configuration.INPUT_PRESSED)
-            if self.values[0] == 0:
-                input_types.add(Configuration.INPUT_RELEASED)
-
-        if self.kind == Component.KIND_DIAL:
-            if self.value_changed(3):
-                input_types.add(Configuration.INPUT_SET)
-            if self.values[2] > 0:
-                input_types.add(Configuration.INPUT_ROTATION_RIGHT)
-            if self.values[1] > 0:
-                input_types.add(Configuration.INPUT_ROTATION_LEFT)
-
-        if self.kind == Component.KIND_SLIDER:
-            input_types.add(Configuration.INPUT_SET)
-
-        return sorted(input_types, key=lambda t: (
-                INPUT_TYPE_DISPATCH_ORDER.index(t)
-                if t in INPUT_TYPE_DISPATCH_ORDER
-                else len(INPUT_TYPE_DISPATCH_ORDER), t))
-
-    def set_callback(self, input_type, action_name, behavior, callback, action_config):
+        """Every input type raised by the current values, bound or not."""
+        dispatch = input_dispatch(self.kind)
+        return [t for t, _ in dispatch.inputs(self.values, self.previous_values)]
+
+    def dispatch_inputs(self):
+        """(input_type, vindex) for each input type raised by the current
+        values, in dispatch order. Only bound input types are considered,
+        unless every input is printed with --verbose."""
+        dispatch = self.dispatch
+        if dispatch is None:
+            input_types = None if FLAGS.verbose else frozenset(self.callbacks)
+            dispatch = self.dispatch = input_dispatch(self.kind, input_types)
+        return dispatch.inputs(self.values, self.previous_values)
+
+    def make_invocation(self, input_type, action_name, behavior, callback, action_config, data=None,
+                        persistent_state=None):
+        """An invocation for this component, without binding it. Its state
+        is the component's own unless another persistent_state is given."""
         if behavior is None:
-            return
+            return None
+        if persistent_state is None:
+            persistent_state = self.persistent_state
         vindex = self.determine_vindex(input_type)
         print('[0] Bound callback %s %s (%s) to component %s' % (input_type, action_name, behavior.behavior, self.uid))
-        invocation = ComponentInvocation(
+        return ComponentInvocation(
                 input_type, action_name, behavior,
-                callback, vindex, action_config, self.persistent_state)
+                callback, vindex, action_config, persistent_state, data)
+
+    def set_callback(self, input_type, action_name, behavior, callback, action_config, data=None):
+        invocation = self.make_invocation(input_type, action_name, behavior, callback, action_config, data)
+        if invocation is None:
+            return
         self.callbacks[input_type] = invocation
+        self.dispatch = None
 
     def invoke_callback(self, input_type):
-        if input_type not in self.callbacks:
+        """The value the callback bound to input_type was triggered with,
+        or None when nothing is bound or the binding did not trigger."""
+        invocation = self.callbacks.get(input_type)
+        if invocation is None:
             return
-        invocation = self.callbacks[input_type]
-        vindex = self.determine_vindex(input_type)
+        vindex = invocation.vindex
         return invocation.run(self.values[vindex], self.previous_values[vindex])
 
     def set_hidkey(self, control, key, mod, repeat):
@@ -433,9 +801,39 @@ class Component(object):
         return Component.KIND_NAME_MAP[self.kind]
 
     def value_changed(self, vindex):
-        if len(self.previous_values) < vindex + 1:
-            return True
-        return self.previous_values[vindex] != self.values[vindex]
+        return _value_changed(self.values, self.previous_values, vindex)
+
+
+class LayoutDiff(object):
+    """How the connected components changed in one layout update. moved
+    components changed index or slot, reoriented ones orientation or flip;
+    a component can be both."""
+    added: List[Component]
+    removed: List[Component]
+    moved: List[Component]
+    reoriented: List[Component]
+
+    def __init__(self, added=None, removed=None, moved=None, reoriented=None):
+        self.added = added or []
+        self.removed = removed or []
+        self.moved = moved or []
+        self.reoriented = reoriented or []
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.moved or self.reoriented)
+
+    def __repr__(self):
+        return '<LayoutDiff added=%s removed=%s moved=%s reoriented=%s>' % (
+                [c.uid for c in self.added], [c.uid for c in self.removed],
+                [c.uid for c in self.moved], [c.uid for c in self.reoriented])
+
+    def affected(self):
+        """Connected components whose device state must be resent, in
+        index order."""
+        affected = {}
+        for component in self.added + self.moved + self.reoriented:
+            affected[component.uid] = component
+        return sorted(affected.values(), key=lambda c: c.index)
 
 
 class ComponentLayout(object):
@@ -449,6 +847,17 @@ class ComponentLayout(object):
         self.components_index = {}
         self.components_slot = {}
         self.layout_dict = {}
+        # bumped whenever the connected components change; query and
+        # search results are memoized for one generation.
+        self.generation = 0
+        self.query_cache = {}
+        self.query_cache_generation = 0
+        self.connected_components = []
+        # secondary indexes of connected components, in index order.
+        self.components_by_uid = {}
+        self.components_by_kind = {}
+        self.components_by_orientation = {}
+        self.components_by_slot = {}
         if layout_dict:
             self.update(layout_dict)
 
@@ -456,10 +865,47 @@ class ComponentLayout(object):
         return len(self.components)
 
     def update(self, layout_dict):
+        """Replace the layout, returning a LayoutDiff against the previous one."""
+        previous = {}
+        for component in self.connected_components:
+            previous[component.uid] = (
+                    component, component.index, component.slot,
+                    component.orientation, component.flip)
         self.components_index = {}
         self.components_slot = {}
         self.traverse(layout_dict)
         self.layout_dict = layout_dict
+        self.reindex()
+
+        diff = LayoutDiff()
+        for component in self.connected_components:
+            if component.uid not in previous:
+                diff.added.append(component)
+                continue
+            _, index, slot, orientation, flip = previous.pop(component.uid)
+            if (index, slot) != (component.index, component.slot):
+                diff.moved.append(component)
+            if (orientation, flip) != (component.orientation, component.flip):
+                diff.reoriented.append(component)
+        diff.removed = [entry[0] for entry in previous.values()]
+        return diff
+
+    def reindex(self):
+        """Rebuild the secondary indexes and start a new generation."""
+        connected = []
+        for index in sorted(self.components_index):
+            connected.append(self.components[self.components_index[index]])
+        self.connected_components = connected
+        self.components_by_uid = {}
+        self.components_by_kind = {}
+        self.components_by_orientation = {}
+        self.components_by_slot = {}
+        for component in connected:
+            self.components_by_uid.setdefault(component.uid, []).append(component)
+            self.components_by_kind.setdefault(component.kind, []).append(component)
+            self.components_by_orientation.setdefault(component.orientation, []).append(component)
+            self.components_by_slot.setdefault(component.slot, []).append(component)
+        self.generation += 1
 
     def traverse(self, layout_dict, parent=None, port=None):
         if not layout_dict:
@@ -531,54 +977,31 @@ class ComponentLayout(object):
         pass
 
     def connected(self):
-        components = []
-        for index in sorted(self.components_index):
-            uid = self.components_index[index]
-            components.append(self.components[uid])
-        return components
+        return list(self.connected_components)
 
     def connected_rowwise(self):
         return sorted_rowwise(self.connected())
 
     # TODO: this does not need to be a class method
     def parse_query(self, query):
-        if not (query.startswith('[') and query.endswith(']')):
-            return {'uid': query}, None
-
-        search_kwargs = {}
-
-        # Parse the matcher portion of the query.
-        matcher, *filters = query.lstrip('[').rstrip(']').split(' | ')
-        matcher_parts = matcher.split(' ')
-        for mp in matcher_parts:
-            k, _, v = mp.partition('=')
-            if k == 'kind':
-                for kind, kind_name in Component.KIND_NAME_MAP.items():
-                    if v == kind_name:
-                        v = kind
-                        break
-            if k == 'index':
-                v = int(v)
-            if k == 'orientation':
-                v = int(v)
-            if k == 'slot':
-                x, y = v.lstrip('(').rstrip(')').split(',')
-                v = (int(x), int(y))
-            search_kwargs[k] = v
-
-        # Parse the filters.
-        select = None
-        for f in filters:
-            if f == 'rowwise':
-                search_kwargs['rowwise'] = True
-            if f.startswith('select('):
-                select = int(f.lstrip('select(').rstrip(')'))
-
-        return search_kwargs, select
+        compiled = compile_query(query)
+        return dict(compiled.search_kwargs), compiled.select
+
+    def cached(self, key, function):
+        """Memoize function() for the current layout generation."""
+        if self.query_cache_generation != self.generation:
+            self.query_cache = {}
+            self.query_cache_generation = self.generation
+        if key not in self.query_cache:
+            self.query_cache[key] = function()
+        return list(self.query_cache[key])
 
     def query(self, query):
-        search_kwargs, select = self.parse_query(query)
-        components = self.search(**search_kwargs)
+        return self.cached(('query', query), lambda: self.run_query(compile_query(query)))
+
+    def run_query(self, compiled):
+        components = compiled.run(self)
+        select = compiled.select
         if select is not None:
             if len(components) < select:
                 # FIXME: need better error handling for this case.
@@ -589,22 +1012,10 @@ class ComponentLayout(object):
         return components
 
     def search(self, uid=None, kind=None, index=None, slot=None, orientation=None, rowwise=False):
-        components = []
-        for component in self.connected():
-            if uid is not None and component.uid != uid:
-                continue
-            if kind is not None and component.kind != kind:
-                continue
-            if slot is not None and component.slot != slot:
-                continue
-            if index is not None and component.index != index:
-                continue
-            if orientation is not None and component.orientation != orientation:
-                continue
-            components.append(component)
-        if rowwise:
-            components = sorted_rowwise(components)
-        return components
+        compiled = CompiledQuery(dict(
+                uid=uid, kind=kind, index=index, slot=slot,
+                orientation=orientation, rowwise=rowwise))
+        return self.cached(('search', compiled.key), lambda: compiled.run(self))
 
     def find_component(self, index):
         if index not in self.components_index:
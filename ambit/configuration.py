@@ -1,8 +1,10 @@
 from ambit.flags import FLAGS
+from ambit.profile_cache import ProfileCache
 
 import ambit.resources
 
 import json
+import os
 import sys
 
 from typing import Any, Callable, Dict, List, Tuple
@@ -24,6 +26,12 @@ class Profile(object):
         self.key_map = {}
         self.layout = {}
         self.orientation = 0
+        # the file the profile was loaded from, if any.
+        self.path = None
+        # resolved from the maps above, see Configuration.compile_profile.
+        self.bindings = {}
+        self.hidkeys = {}
+        self.colors = {}
 
 
 class Configuration(object):
@@ -291,33 +299,165 @@ class Configuration(object):
     profile: Profile
     profiles: List[Profile]
 
-    def __init__(self, paths=None):
+    def __init__(self, paths=None, cache_path=None):
         self.profile_index = 0
         self.profile = Profile()
         self.profiles = []
-        self.config_dicts = []
+        self.paths = list(paths or [])
+        self.cache_path = cache_path
         if not paths:
             return
+        cache = ProfileCache(cache_path) if cache_path else None
         for path in paths:
-            with open(path, 'r') as f:
-                config_bytes = f.read()
             try:
-                config_dict = json.loads(config_bytes)
-            except Exception as err:
+                table = Configuration.load_table(path, cache)
+            except ValueError as err:
                 print('Error loading JSON from %s: %s' % (path, err))
                 sys.exit(1)
-            self.config_dicts.append(config_dict)
-            profile = Profile()
-            profile.title = config_dict['title']
-            profile.icon = Configuration.ICON_TYPE_MAP[config_dict['tabType']]
-            profile.action_map = config_dict['module_mappings'].get('actionMap', {})
-            profile.media_map = config_dict['module_mappings'].get('mediaMap', {})
-            profile.key_map = config_dict['module_mappings'].get('keyMap', {})
-            profile.layout = config_dict.get('layout', {})
-            profile.orientation = config_dict.get('orientation', 0)
+            profile = Configuration.load_profile(table)
+            profile.path = os.path.abspath(path)
             self.profiles.append(profile)
+        if cache:
+            cache.save()
+            print('[0] Loaded %d profiles, %d compiled and %d cached in %s' % (
+                len(paths), cache.misses, cache.hits, cache_path))
         self.switch(0)
 
+    def reload(self, paths):
+        """Recompile the profiles loaded from paths, updating them in place
+        so that everything holding them sees the change. A file which no
+        longer loads keeps its profile. Returns the reloaded profiles."""
+        cache = ProfileCache(self.cache_path) if self.cache_path else None
+        changed = set(os.path.abspath(path) for path in paths)
+        reloaded = []
+        for index, path in enumerate(self.paths):
+            if os.path.abspath(path) not in changed:
+                continue
+            try:
+                table = Configuration.load_table(path, cache)
+            except (OSError, ValueError, KeyError) as err:
+                print('[!] Unable to reload profile from %s: %s' % (path, err))
+                continue
+            profile = Configuration.load_profile(table, self.profiles[index])
+            reloaded.append(profile)
+            print('[0] Reloaded profile %d: %s' % (index, profile.title))
+        if cache:
+            cache.save()
+        return reloaded
+
+    @staticmethod
+    def load_table(path, cache=None):
+        if cache:
+            return cache.profile_table(path, Configuration.compile_file)
+        with open(path, 'rb') as f:
+            return Configuration.compile_file(path, f.read())
+
+    @staticmethod
+    def compile_file(path, data):
+        """Raises ValueError when data is not valid JSON."""
+        return Configuration.compile_profile(json.loads(data))
+
+    @staticmethod
+    def compile_profile(config_dict):
+        """Resolve a parsed PLP into a table of plain values, which is what
+        ProfileCache stores: the profile settings and maps, the actions
+        bound to each query, and the hidkeys and led colors resolved for
+        each component uid. See load_profile()."""
+        mappings = config_dict['module_mappings']
+        action_map = mappings.get('actionMap', {})
+        media_map = mappings.get('mediaMap', {})
+        key_map = mappings.get('keyMap', {})
+        color_map = mappings.get('colorMap', {})
+        bindings = {}
+        for uid_query in set(action_map) | set(media_map):
+            bindings[uid_query] = Configuration.compile_actions(
+                    action_map.get(uid_query, {}), media_map.get(uid_query, {}))
+        hidkeys = {}
+        for uid in key_map:
+            hidkeys[uid] = Configuration.compile_hidkeys(key_map[uid])
+        return {
+            'title': config_dict['title'],
+            'icon': Configuration.ICON_TYPE_MAP[config_dict['tabType']],
+            'orientation': config_dict.get('orientation', 0),
+            'layout': config_dict.get('layout', {}),
+            'action_map': action_map,
+            'media_map': media_map,
+            'key_map': key_map,
+            'color_map': color_map,
+            'bindings': bindings,
+            'hidkeys': hidkeys,
+            'colors': Configuration.compile_colors(color_map),
+        }
+
+    @staticmethod
+    def compile_actions(input_actions, media_action):
+        """(input type, action name, action config) for each input bound
+        by an action map entry, then the media action if there is one."""
+        actions = []
+        for input_type in input_actions:
+            action_config = input_actions.get(input_type, {})
+            if 'action' not in action_config:
+                continue
+            actions.append((input_type, action_config['action'], action_config))
+        if media_action:
+            actions.append((Configuration.INPUT_MIXED, media_action['key'], media_action))
+        return actions
+
+    @staticmethod
+    def compile_hidkeys(key_config):
+        """(control, key, modifiers, repeat) hid codes for a key map entry."""
+        hidkeys = []
+        for control in key_config:
+            bind_config = key_config.get(control, {})
+            key = Configuration.HID_KEY_MAP[bind_config['virtual_code']]
+            mod = 0
+            for mc in bind_config['modifier_codes']:
+                if type(mc) is int:
+                    mc = Configuration.QT_KEY_MAP[mc]
+                mod += Configuration.HID_KEY_MAP[mc]
+            repeat = bind_config.get('dial_sensitivity', 1)
+            if repeat != 1:
+                repeat = 8
+            hidkeys.append((control, key, mod, repeat))
+        return hidkeys
+
+    @staticmethod
+    def compile_colors(color_map):
+        """(red, green, blue) for each component uid with a color."""
+        colors = {}
+        for uid, color in color_map.items():
+            try:
+                rgb = int(color.lstrip('#'), 16)
+            except (AttributeError, ValueError):
+                print('[0] Invalid color for component %s: %s' % (uid, color))
+                continue
+            colors[uid] = ((rgb >> 16) & 0xff, (rgb >> 8) & 0xff, rgb & 0xff)
+        return colors
+
+    @staticmethod
+    def load_profile(table, profile=None):
+        """A Profile from a compiled table, or profile updated from it.
+        msgpack returns tuples as lists, so those are restored here."""
+        profile = profile or Profile()
+        profile.bindings = {}
+        profile.hidkeys = {}
+        profile.colors = {}
+        profile.title = table['title']
+        profile.icon = table['icon']
+        profile.orientation = table['orientation']
+        profile.layout = table['layout']
+        profile.action_map = table['action_map']
+        profile.media_map = table['media_map']
+        profile.key_map = table['key_map']
+        profile.color_map = table['color_map']
+        for uid_query, actions in table['bindings'].items():
+            profile.bindings[uid_query] = [tuple(action) for action in actions]
+        for uid, hidkeys in table['hidkeys'].items():
+            profile.hidkeys[uid] = [tuple(hidkey) for hidkey in hidkeys]
+        for uid, color in table['colors'].items():
+            profile.colors[uid] = tuple(color)
+        return profile
+
     def switch(self, index):
         self.profile_index = index
         self.profile = self.profiles[index]
@@ -335,48 +475,29 @@ class Configuration(object):
             index = 0
         self.switch(index)
 
-    def component_hidkeys(self, uid):
-        component_hidkeys = []
-        for control in self.profile.key_map.get(uid, {}):
-            bind_config = self.profile.key_map[uid].get(control, {})
-            key = Configuration.HID_KEY_MAP[bind_config['virtual_code']]
-            mod = 0
-            for mc in bind_config['modifier_codes']:
-                if type(mc) is int:
-                    mc = Configuration.QT_KEY_MAP[mc]
-                mod += Configuration.HID_KEY_MAP[mc]
-            repeat = bind_config.get('dial_sensitivity', 1)
-            if repeat != 1:
-                repeat = 8
-            component_hidkeys.append((control, key, mod, repeat))
-        return component_hidkeys
+    def component_hidkeys(self, uid, profile=None):
+        profile = profile or self.profile
+        return list(profile.hidkeys.get(uid, ()))
 
-    def components(self):
+    def components(self, profile=None):
         """Return the list of configured components."""
-        matchers = set()
-        for uid_query in self.profile.action_map:
-            matchers.add(uid_query)
-        for uid_query in self.profile.media_map:
-            matchers.add(uid_query)
-        return sorted(list(matchers))
-
-    def component_actions(self, uid):
-        component_actions = []
-        for input_type in self.profile.action_map.get(uid, {}):
-            action_config = self.profile.action_map[uid].get(input_type, {})
-            if 'action' not in action_config:
-                continue
-            action_name = action_config['action']
-            component_actions.append((input_type, action_name, action_config))
-        media_action = self.profile.media_map.get(uid, {})
-        if media_action:
-            action_name = media_action['key']
-            input_type = Configuration.INPUT_MIXED
-            component_actions.append((input_type, action_name, media_action))
-        return component_actions
+        profile = profile or self.profile
+        return sorted(profile.bindings)
+
+    def component_actions(self, uid, profile=None):
+        profile = profile or self.profile
+        return profile.bindings.get(uid, [])
+
+    def component_colors(self, profile=None):
+        """Return the led color configured per component uid, as (red,
+        green, blue)."""
+        profile = profile or self.profile
+        return profile.colors
 
     def set_component_actions(self, uid, mapping):
         self.profile.action_map[uid] = mapping
+        self.profile.bindings[uid] = Configuration.compile_actions(
+                mapping, self.profile.media_map.get(uid, {}))
 
 
 def StandardConfiguration():
@@ -389,7 +510,7 @@ def StandardConfiguration():
             sys.exit(1)
         config_paths.extend(layout_paths)
     config_paths.extend(FLAGS.config_paths)
-    config = Configuration(config_paths)
+    config = Configuration(config_paths, cache_path=FLAGS.config_cache)
     # TODO: move the switch here out of Configuration.__init__()
     #config.switch(0)
     return config
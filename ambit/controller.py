@@ -1,12 +1,20 @@
 import ambit.resources
-
-from ambit.component import Component, ComponentBehavior, ComponentLayout
-from ambit.configuration import Configuration
-from ambit.message import message_decode, message_encode, MESSAGE_FORMAT_JSON, MESSAGE_FORMAT_MSGPACK
+import ambit.trace
+
+from ambit.command import CommandCache, CommandRunner
+from ambit.component import canonical_config, Component, ComponentBehavior, ComponentLayout
+from ambit.configuration import Configuration, Profile
+from ambit.executor import CallbackExecutor
+from ambit.pacing import Pacer, ScreenStringCost
+from ambit.message import message_decoder, message_encode, MESSAGE_FORMAT_JSON, MESSAGE_FORMAT_MSGPACK
 from ambit.flags import FLAGS
+from ambit.record import RecordingHandle
+from ambit.state import StateStore
+from ambit.trace import Tracer
+from ambit.watch import ConfigWatcher
+from ambit.metrics import COUNT_BUCKETS, SIZE_BUCKETS, MetricsRegistry, MetricsServer, MetricsSnapshotWriter
 
-import os
-import subprocess
+import concurrent.futures
 import sys
 import threading
 import time
@@ -149,6 +157,7 @@ class Handle:
         self._endpoint_in = endpoint_in
         self._endpoint_out = endpoint_out
         self._control_index = control_index
+        self.max_packet_size = endpoint_out.wMaxPacketSize
 
     def bulkWrite(self, data, timeout=0):
         return self._endpoint_out.write(data, timeout)
@@ -170,25 +179,96 @@ class Handle:
         usb.util.dispose_resources(self._device)
 
 
+class WriteError(Exception):
+    """Set on a write future whose update never reached handle.bulkWrite.
+    The reason is one of the class constants below."""
+    DROPPED = 'dropped'
+    COALESCED = 'coalesced'
+    USB_ERROR = 'usb_error'
+    SHUTDOWN = 'shutdown'
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def resolve_writes(futures, reason=None):
+    """Complete each pending future, failing it with a WriteError when a
+    reason is given. Futures which already completed are left alone."""
+    for future in futures or ():
+        try:
+            if reason is None:
+                future.set_result(None)
+            else:
+                future.set_exception(WriteError(reason))
+        except concurrent.futures.InvalidStateError:
+            pass
+
+
+class ProfileState(object):
+    """What one profile binds on the current layout, so that switching to
+    it needs no rebinding: the queries and callbacks bound to each
+    component uid, their hidkeys and the led colors configured per uid.
+    The signature of a uid is the configuration its callbacks and
+    hidkeys were made from."""
+    profile: Profile
+    bindings: Dict[str, List[str]]
+    callbacks: Dict[str, Dict]
+    hidkeys: Dict[str, List[Tuple]]
+    colors: Dict[str, Tuple[int, int, int]]
+    signatures: Dict[str, Tuple]
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.bindings = {}
+        self.callbacks = {}
+        self.hidkeys = {}
+        self.colors = {}
+        self.signatures = {}
+
+
 class Controller:
     BULK_WRITE_TIMEOUT_MS = 1000
     BULK_READ_TIMEOUT_MS = 1000
     BULK_READ_SIZE_BYTES = 4096
     QUEUE_TIMEOUT_SECONDS = 0.5
 
+    # Pending writes are coalesced into transfers of at most this many
+    # max-size packets. A single write larger than that is sent alone, as
+    # is a write carrying a binary tail, which the device reads as the
+    # payload of its message.
+    BULK_WRITE_MAX_PACKETS = 8
+    # writes with a binary tail (image uploads) are large and slow.
+    BULK_WRITE_TAIL_TIMEOUT_MS = 10000
+    # How long the writer waits for more writes to coalesce with the
+    # first pending one; zero only merges what is already queued.
+    BULK_WRITE_COALESCE_SECONDS = 0
+
     DEFAULT_WAIT_SECONDS = 0.5
 
+    # Queued to wake a worker blocked on its queue at shutdown.
+    QUEUE_SHUTDOWN = object()
+
     # Above 20 updates per second, the screen will hard reset
-    # if the string length is larger than ~3 bytes.
+    # if the string length is larger than ~3 bytes. Shorter strings
+    # are only limited by the pacer (see ScreenStringCost).
     SCREEN_STRING_DELAY_SECONDS = 1 / 20
+    SCREEN_STRING_SHORT_BYTES = 3
+    SCREEN_STRING_MIN_RATE = 2
+    SCREEN_STRING_MAX_RATE = 60
     SCREEN_STRING_QUEUE_DEPTH = 8
-    # FIXME: set based on firmware version or legacy()
+    # the led pacer starts at this interval and adapts between the min
+    # and max rates (updates per second) for each device and firmware.
     LED_DELAY_SECONDS = 1 / 60
-    LED_QUEUE_DEPTH = 64
+    LED_MIN_RATE = 5
+    LED_MAX_RATE = 120
 
     KEEPALIVE_TIMEOUT_SECONDS = 5
     SCREEN_RESET_SECONDS = 3
 
+    # Worker threads running action callbacks off the read thread.
+    CALLBACK_WORKERS = 4
+
     # interface hint passed to Device; the data interface and bulk
     # endpoints are auto-discovered from the descriptors at open().
     USB_INTERFACE_ID = 0
@@ -272,29 +352,93 @@ class Controller:
         if self.device.legacy():
             self.message_format = MESSAGE_FORMAT_JSON
 
+        # stateful, so partial messages carry over between bulk reads.
+        self.message_decoder = message_decoder(self.message_format)
+
         # TODO: do we need more than one lock?
         self.lock = threading.Lock()
+        # held while bindings change: layout updates, profile switches
+        # and configuration reloads come from different threads.
+        self.configure_lock = threading.RLock()
         self.shutdown_event = threading.Event()
+        # notified when a layout has been processed, when queued work
+        # completes and on shutdown; see wait() and wait_for_layout().
+        self.condition = threading.Condition()
+        self.layout_processed = False
 
         self.write_queue = queue.Queue()
         self.screen_string_queue = queue.Queue(Controller.SCREEN_STRING_QUEUE_DEPTH)
-        self.led_queue = queue.Queue(Controller.LED_QUEUE_DEPTH)
+
+        # latest-wins led framebuffer: the desired color per component
+        # index, the indices changed since the last flush and the colors
+        # most recently sent to the device.
+        self.led_lock = threading.Lock()
+        self.led_event = threading.Event()
+        self.led_framebuffer = {}
+        self.led_dirty = set()
+        self.led_flushed = {}
+        self.led_flushing = False
+        # write futures per component index, resolved when that index is
+        # flushed or failed when it is overwritten before a flush.
+        self.led_futures = {}
 
         self.bulk_read_thread = threading.Thread(target=self.bulk_read_worker)
         self.bulk_write_thread = threading.Thread(target=self.bulk_write_worker)
         self.screen_string_thread = threading.Thread(target=self.screen_string_worker)
         self.led_thread = threading.Thread(target=self.led_worker)
         self.keepalive_thread = threading.Thread(target=self.keepalive_worker)
+        self.callback_executor = CallbackExecutor(
+                Controller.CALLBACK_WORKERS, done_callback=self.notify_state)
+        self.led_pacer = Pacer(
+                Controller.pacing_rate(Controller.LED_DELAY_SECONDS),
+                Controller.LED_MIN_RATE, Controller.LED_MAX_RATE)
+        self.screen_string_pacer = Pacer(
+                Controller.pacing_rate(Controller.SCREEN_STRING_DELAY_SECONDS),
+                Controller.SCREEN_STRING_MIN_RATE, Controller.SCREEN_STRING_MAX_RATE)
+        self.screen_string_cost = ScreenStringCost.parse(
+                FLAGS.screen_string_cost,
+                short_bytes=Controller.SCREEN_STRING_SHORT_BYTES,
+                long_seconds=Controller.SCREEN_STRING_DELAY_SECONDS)
+        # one per executeCommand binding, keyed by (uid, input_type, profile).
+        self.command_runners = {}
+        # coalesced by the runners of components since detached.
+        self.detached_coalesced_commands = 0
+        # interned behaviors, see make_action_behavior.
+        self.behaviors = {}
+        # bindings of every profile on the current layout, see
+        # configure_component_callbacks.
+        self.profile_states = {}
+        # configured queries bound to each component uid, and the profile
+        # and base orientation they were configured for.
+        self.component_bindings = {}
+        self.bound_profile = None
+        self.configured_orientation = None
+        self.profile_switches = 0
+        self.config_watcher = None
+        self.config_reloads = 0
+        # persistent_state per component uid and profile, see StateStore.
+        self.state_store = StateStore(FLAGS.state_path or None)
 
         self.version_core = ''
+        self.select_pacing()
         self.failed_writes = 0
         self.failed_reads = 0
         self.dropped_screen_strings = 0
-        self.dropped_leds = 0
+        self.coalesced_leds = 0
+        self.write_requests = 0
+        self.write_transfers = 0
 
         self.last_led_time = 0
         self.last_write_time = 0
         self.last_screen_string_time = 0
+        # monotonic time the messages being processed were read.
+        self.read_timestamp = 0
+
+        self.tracer = Tracer(enabled=bool(FLAGS.trace_output))
+        self.metrics = MetricsRegistry()
+        self.metrics_server = None
+        self.metrics_snapshot_writer = None
+        self.configure_metrics()
 
         # FIXME: this doesn't feel like the right home
         self.current_led_values = (255, 255, 255)
@@ -318,15 +462,125 @@ class Controller:
         }
 
         self.action_callback_map = {}
+        # dispatch policy of actions whose actionMap entry sets none.
+        self.action_dispatch = {}
         for action_name in default_action_callbacks:
             action_callback = default_action_callbacks[action_name]
             self.register_action_callback(action_name, action_callback)
 
-    def register_action_callback(self, action_name, callback):
+    @staticmethod
+    def pacing_rate(delay):
+        return 1 / delay if delay else 0
+
+    def select_pacing(self):
+        """Pace writes with the rates learned for this device and firmware."""
+        key = (getattr(self.device, 'device_class', None), self.version_core)
+        self.led_pacer.select(key)
+        self.screen_string_pacer.select(key)
+
+    def pace(self, pacer, futures, interval=0):
+        """Adds a future to futures which reports to pacer how long the
+        write took to complete, or that it failed."""
+        sent = time.monotonic()
+        def done(future):
+            error = future.exception()
+            if error and error.reason != WriteError.USB_ERROR:
+                return
+            pacer.observe(sent, time.monotonic(), failed=bool(error), interval=interval)
+        future = concurrent.futures.Future()
+        future.add_done_callback(done)
+        futures.append(future)
+
+    def configure_metrics(self):
+        m = self.metrics
+        m.gauge('ambit_queue_depth', 'Items waiting in each write pipeline queue.',
+                function=lambda: {
+                    (('queue', 'write'),): self.write_queue.qsize(),
+                    (('queue', 'screen_string'),): self.screen_string_queue.qsize(),
+                    (('queue', 'led'),): len(self.led_dirty),
+                    (('queue', 'callback'),): self.callback_executor.pending(),
+                })
+        m.counter('ambit_dropped_total', 'Updates dropped or superseded, by reason.',
+                  function=lambda: {
+                      (('reason', 'screen_string'),): self.dropped_screen_strings,
+                      (('reason', 'led_coalesced'),): self.coalesced_leds,
+                      (('reason', 'callback'),): self.callback_executor.dropped,
+                      (('reason', 'callback_coalesced'),): self.callback_executor.coalesced,
+                      (('reason', 'command_coalesced'),): self.coalesced_commands(),
+                  })
+        m.counter('ambit_failed_writes_total', 'Bulk writes which raised a usb error.',
+                  function=lambda: self.failed_writes)
+        m.counter('ambit_failed_reads_total', 'Bulk reads which raised a usb error or timed out.',
+                  function=lambda: self.failed_reads)
+        m.counter('ambit_write_requests_total', 'Writes queued for the device.',
+                  function=lambda: self.write_requests)
+        m.counter('ambit_write_transfers_total', 'Bulk write transfers.',
+                  function=lambda: self.write_transfers)
+        m.counter('ambit_profile_switches_total', 'Profile switches made without a layout round trip.',
+                  function=lambda: self.profile_switches)
+        m.counter('ambit_config_reloads_total', 'Configuration changes reloaded while running.',
+                  function=lambda: self.config_reloads)
+        m.counter('ambit_state_writes_total', 'Times component state was written to disk.',
+                  function=lambda: self.state_store.writes)
+        m.gauge('ambit_pacer_rate', 'Current update rate of each paced worker, per second.',
+                function=lambda: {
+                    (('worker', 'led'),): self.led_pacer.rate,
+                    (('worker', 'screen_string'),): self.screen_string_pacer.rate,
+                })
+        m.counter('ambit_pacer_decreases_total', 'Times a paced worker backed off.',
+                  function=lambda: {
+                      (('worker', 'led'),): self.led_pacer.decreases,
+                      (('worker', 'screen_string'),): self.screen_string_pacer.decreases,
+                  })
+        self.write_messages_total = m.counter(
+                'ambit_write_messages_total', 'Messages encoded for the device.')
+        self.bulk_write_seconds = m.histogram(
+                'ambit_bulk_write_seconds', 'Duration of successful bulk writes.')
+        self.bulk_write_bytes = m.histogram(
+                'ambit_bulk_write_bytes', 'Bytes per bulk write transfer.', SIZE_BUCKETS)
+        self.bulk_write_requests = m.histogram(
+                'ambit_bulk_write_requests', 'Coalesced writes per bulk write transfer.', COUNT_BUCKETS)
+        self.bulk_read_seconds = m.histogram(
+                'ambit_bulk_read_seconds', 'Duration of successful bulk reads, including the wait for data.')
+        self.bulk_read_bytes = m.histogram(
+                'ambit_bulk_read_bytes', 'Bytes per bulk read transfer.', SIZE_BUCKETS)
+        self.bulk_read_messages = m.histogram(
+                'ambit_bulk_read_messages', 'Complete messages decoded per bulk read.', COUNT_BUCKETS)
+        self.input_callback_seconds = m.histogram(
+                'ambit_input_callback_seconds', 'Time from reading an input to the callback it triggered returning.')
+
+    def start_metrics(self):
+        if FLAGS.metrics_address:
+            self.metrics_server = MetricsServer(self.metrics, FLAGS.metrics_address)
+            self.metrics_server.start()
+        if FLAGS.metrics_snapshot:
+            self.metrics_snapshot_writer = MetricsSnapshotWriter(
+                    self.metrics, FLAGS.metrics_snapshot, FLAGS.metrics_snapshot_seconds)
+            self.metrics_snapshot_writer.start()
+
+    def stop_metrics(self):
+        if self.metrics_server:
+            self.metrics_server.stop()
+            self.metrics_server = None
+        if self.metrics_snapshot_writer:
+            self.metrics_snapshot_writer.stop()
+            self.metrics_snapshot_writer = None
+
+    def register_action_callback(self, action_name, callback, dispatch=None):
+        """Bind action_name to callback. dispatch is the policy used when
+        an actionMap entry sets none: callbacks which may block should
+        pass one, such as CallbackExecutor.LATEST, as the default is
+        inline."""
         self.action_callback_map[action_name] = callback
+        if dispatch is None:
+            self.action_dispatch.pop(action_name, None)
+        else:
+            self.action_dispatch[action_name] = dispatch
 
     def open(self):
         self.handle = self.device.open()
+        if FLAGS.record_usb:
+            self.handle = RecordingHandle(self.handle, FLAGS.record_usb, self.device.legacy())
 
     def close(self):
         """ Release device interface """
@@ -375,60 +629,123 @@ class Controller:
                 Controller.USB_SETUP_REQUEST_EMPTY_IN, 7)
 
     def bulk_write_worker(self):
+        # a write which did not fit in the previous transfer.
+        carry = None
         while not self.shutdown_event.is_set():
-            try:
-                data = self.write_queue.get(timeout=Controller.QUEUE_TIMEOUT_SECONDS)
-            except queue.Empty:
-                pass
+            if carry is None:
+                carry = self.write_queue.get()
+            if carry is Controller.QUEUE_SHUTDOWN:
+                carry = None
+                self.write_queue.task_done()
+                continue
+            writes, carry = self.coalesce_writes(carry)
+            if len(writes) == 1:
+                data, _, tail = writes[0]
+                written = self.bulk_write(data, Controller.BULK_WRITE_TAIL_TIMEOUT_MS if tail
+                                          else Controller.BULK_WRITE_TIMEOUT_MS)
             else:
-                self.bulk_write(data)
+                written = self.bulk_write(memoryview(b''.join(data for data, _, _ in writes)))
+            self.write_requests += len(writes)
+            self.write_transfers += 1
+            self.bulk_write_requests.observe(len(writes))
+            for _, futures, _ in writes:
+                resolve_writes(futures, None if written else WriteError.USB_ERROR)
                 self.write_queue.task_done()
-
-    def bulk_write_messages(self, messages):
+            self.notify_state()
+
+    def coalesce_writes(self, first):
+        """Drain pending writes which fit in one transfer along with first.
+        Each write is a (data, futures, tail) triple, and a write with a
+        binary tail is never merged with another. Returns the writes to
+        send and the write which did not fit, if any."""
+        writes = [first]
+        if first[2]:
+            return writes, None
+        size = first[0].nbytes
+        limit = self.handle.max_packet_size * Controller.BULK_WRITE_MAX_PACKETS
+        deadline = time.time() + Controller.BULK_WRITE_COALESCE_SECONDS
+        while size < limit:
+            try:
+                timeout = deadline - time.time()
+                if timeout > 0:
+                    write = self.write_queue.get(timeout=timeout)
+                else:
+                    write = self.write_queue.get_nowait()
+            except queue.Empty:
+                break
+            if write is Controller.QUEUE_SHUTDOWN or write[2] or size + write[0].nbytes > limit:
+                return writes, write
+            writes.append(write)
+            size += write[0].nbytes
+        return writes, None
+
+    def bulk_write_messages(self, messages, futures=None, tail=b''):
+        """Queue messages for the bulk writer, followed by the binary tail
+        if any, in which case they are written in a transfer of their own.
+        The futures, if any, are resolved once the encoded messages are
+        handed to handle.bulkWrite."""
         if not messages:
+            resolve_writes(futures)
             return
         if FLAGS.debug:
             print('[@] WRITE MESSAGES:', messages)
-        data = message_encode(messages, self.message_format)
-        self.write_queue.put(data, Controller.QUEUE_TIMEOUT_SECONDS)
+        data = message_encode(messages, self.message_format, tail)
+        self.write_messages_total.inc(len(messages))
+        self.write_queue.put((data, futures, bool(tail)), Controller.QUEUE_TIMEOUT_SECONDS)
 
-    def bulk_write(self, data):
+    def bulk_write(self, data, timeout_ms=BULK_WRITE_TIMEOUT_MS):
         if FLAGS.debug:
             print("[@] BULK WRITE:", data.tobytes())
+        start = time.monotonic()
         try:
-            self.handle.bulkWrite(data, Controller.BULK_WRITE_TIMEOUT_MS)
+            self.handle.bulkWrite(data, timeout_ms)
         except usb.USBError as exc:
             self.failed_writes += 1
             self.process_usb_error(exc)
-        else:
-            self.lock.acquire()
-            self.last_write_time = time.time()
-            self.lock.release()
+            return False
+        end = time.monotonic()
+        self.bulk_write_seconds.observe(end - start)
+        self.bulk_write_bytes.observe(data.nbytes)
+        self.tracer.record('bulk_write', start, end, bytes=data.nbytes)
+        self.lock.acquire()
+        self.last_write_time = time.time()
+        self.lock.release()
+        return True
 
     def bulk_read_worker(self):
         while not self.shutdown_event.is_set():
             messages = self.bulk_read()
+            self.read_timestamp = time.monotonic()
+            if not self.tracer.enabled:
+                for message in messages:
+                    self.process_bulk_message(message)
+                continue
             for message in messages:
-                self.process_bulk_message(message)
+                with ambit.trace.activate(self.tracer.begin(self.read_timestamp)):
+                    self.process_bulk_message(message)
 
     def bulk_read(self):
         complete_messages = []
-        extra_bytes = b''
         while True:
             try:
+                start = time.monotonic()
                 data = self.handle.bulkRead(
                         Controller.BULK_READ_SIZE_BYTES,
                         Controller.BULK_READ_TIMEOUT_MS)
+                self.bulk_read_seconds.observe(time.monotonic() - start)
+                self.bulk_read_bytes.observe(len(data))
                 if FLAGS.debug:
                     print("[@] BULK READ:", data.tobytes())
             except usb.USBError as exc:
                 self.failed_reads += 1
                 self.process_usb_error(exc)
-                return []
+                return complete_messages
             else:
-                messages, extra_bytes = message_decode(memoryview(extra_bytes + data), self.message_format)
-                complete_messages.extend(messages)
-                if not extra_bytes:
+                complete_messages.extend(self.message_decoder.feed(data))
+                # a trailing partial message stays buffered in the decoder
+                # until the next read, so never hold back complete ones.
+                if complete_messages or not self.message_decoder.pending():
+                    self.bulk_read_messages.observe(len(complete_messages))
                     return complete_messages
 
     def process_usb_error(self, exc):
@@ -459,65 +776,172 @@ class Controller:
 
     def led_worker(self):
         while not self.shutdown_event.is_set():
-            if self.led_queue.full():
-                # TODO: should we be clearing the entire queue when full, or just some of it?
-                for _ in range(self.led_queue.qsize() - 2):
-                    self.led_queue.get()
-                    self.led_queue.task_done()
-                    self.dropped_leds += 1
-            if time.time() - self.last_led_time < Controller.LED_DELAY_SECONDS:
-                wait = Controller.LED_DELAY_SECONDS - (time.time() - self.last_led_time)
+            self.led_event.wait()
+            if self.shutdown_event.is_set():
+                break
+            delay = self.led_pacer.delay()
+            if time.time() - self.last_led_time < delay:
+                wait = delay - (time.time() - self.last_led_time)
                 time.sleep(wait)
-            try:
-                # TODO: look ahead in the queue to find duplicates or
-                # ways that we can join multiple updates into a single
-                # bulk write?
-                leds = self.led_queue.get(timeout=Controller.QUEUE_TIMEOUT_SECONDS)
-            except queue.Empty:
-                pass
+            self.flush_leds()
+
+    def flush_leds(self):
+        """Send every component whose desired color differs from the color
+        most recently sent to the device. Colors which were overwritten in
+        the framebuffer before a flush are never sent."""
+        with self.led_lock:
+            self.led_event.clear()
+            changed = []
+            futures = []
+            for index in sorted(self.led_dirty):
+                futures.extend(self.led_futures.pop(index, ()))
+                color = self.led_framebuffer[index]
+                if self.led_flushed.get(index) != color:
+                    self.led_flushed[index] = color
+                    changed.append((index, color))
+            self.led_dirty = set()
+            self.led_flushing = bool(changed)
+
+        if not changed:
+            # the device already shows every requested color.
+            resolve_writes(futures)
+            self.notify_state()
+            return
+
+        self.pace(self.led_pacer, futures)
+        self.bulk_write_messages(self.led_messages(changed), futures)
+
+        for index, color in changed:
+            component = self.layout.find_component(index)
+            if component:
+                component.led = color
+        self.last_led_time = time.time()
+
+        with self.led_lock:
+            self.led_flushing = False
+        self.notify_state()
+
+    def led_messages(self, changed):
+        if self.device.legacy():
+            leds = []
+            for index, (r, g, b) in changed:
+                leds.append({"b": b, "g": g, "i": index, "m": 0, "r": r})
+            return [{'led': leds}]
+
+        messages = []
+        for index, (r, g, b) in changed:
+            # FIXME: use module type for this instead of input ID.
+            if index == 1:
+                color = self.led_to_int([0, b, g, r])
+                messages.append({'set_module': [index, 5, color]})
+                color = self.led_to_int([1, b, g, r])
+                messages.append({'set_module': [index, 5, color]})
+                color = self.led_to_int([2, b, g, r])
+                messages.append({'set_module': [index, 5, color]})
+                color = self.led_to_int([127, 0, 0, 0])
+                messages.append({'set_module': [index, 5, color]})
             else:
-                messages = []
-                if self.device.legacy():
-                    messages = [{'led': leds}]
-                else:
-                    # FIXME: use a real dataclass for LED, include module type.
-                    for led in leds:
-                        # FIXME: use module type for this instead of input ID.
-                        if led['i'] == 1:
-                            color = self.led_to_int([0, led['b'], led['g'], led['r']])
-                            messages.append({'set_module': [led['i'], 5, color]})
-                            color = self.led_to_int([1, led['b'], led['g'], led['r']])
-                            messages.append({'set_module': [led['i'], 5, color]})
-                            color = self.led_to_int([2, led['b'], led['g'], led['r']])
-                            messages.append({'set_module': [led['i'], 5, color]})
-                            color = self.led_to_int([127, 0, 0, 0])
-                            messages.append({'set_module': [led['i'], 5, color]})
-                        else:
-                            color = self.led_to_int([0, led['b'], led['g'], led['r']])
-                            messages.append({'set_module': [led['i'], 2, color]})
-
-                #data = message_encode(messages, self.message_format)
-                #self.bulk_write(data)
-                self.bulk_write_messages(messages)
-
-                # FIXME: this feels like a pretty inefficient way to
-                # update the component state, but fixing may require
-                # changing the API surface provided by Controller.led()
-                for led in leds:
-                    component = self.layout.find_component(led['i'])
-                    if component:
-                        component.led = (led['r'], led['g'], led['b'])
-                self.last_led_time = time.time()
-                self.led_queue.task_done()
+                color = self.led_to_int([0, b, g, r])
+                messages.append({'set_module': [index, 2, color]})
+        return messages
 
     def led_to_int(self, bgr):
         return int.from_bytes(bytes(bgr), 'big')
 
-    def led(self, leds):
-        try:
-            self.led_queue.put(leds, timeout=Controller.QUEUE_TIMEOUT_SECONDS)
-        except queue.Full:
-            self.dropped_leds += 1
+    def led(self, leds, future=False, wait=False):
+        """Update the framebuffer. With future or wait, returns a Future
+        which resolves once these colors are handed to the device, or fails
+        with WriteError.COALESCED if any of them is overwritten first. With
+        wait, blocks until the returned Future is done."""
+        write = self.write_future('led', future or wait)
+        coalesced = []
+        with self.led_lock:
+            for led in leds:
+                index = led['i']
+                if index in self.led_dirty:
+                    self.coalesced_leds += 1
+                    coalesced.extend(self.led_futures.pop(index, ()))
+                self.led_framebuffer[index] = (led['r'], led['g'], led['b'])
+                self.led_dirty.add(index)
+                if write:
+                    self.led_futures.setdefault(index, []).append(write)
+            self.led_event.set()
+        # resolved outside the lock, as done callbacks may take it.
+        resolve_writes(coalesced, WriteError.COALESCED)
+        if write and not leds:
+            resolve_writes([write])
+        return self.write_result(write, future or wait, wait)
+
+    def write_future(self, name, requested):
+        """A Future for one write, if the caller asked for one or the input
+        being handled is traced."""
+        context = ambit.trace.current()
+        if not requested and context is None:
+            return None
+        future = concurrent.futures.Future()
+        if context is not None:
+            self.trace_write(name, context, future)
+        return future
+
+    def trace_write(self, name, context, future):
+        enqueued = time.monotonic()
+        def done(future):
+            end = time.monotonic()
+            error = future.exception()
+            reason = error.reason if error else 'written'
+            context.tracer.record('%s queued' % name, enqueued, end, context, result=reason)
+            context.tracer.record('input to %s' % name, context.read_time, end, context, result=reason)
+        future.add_done_callback(done)
+
+    def write_result(self, future, requested, wait):
+        if not requested:
+            return None
+        if not wait:
+            return future
+        future.add_done_callback(lambda _: self.notify_state())
+        with self.condition:
+            self.condition.wait_for(lambda: (
+                future.done() or self.shutdown_event.is_set()))
+        # a write queued while shutting down may never be picked up.
+        resolve_writes([future], WriteError.SHUTDOWN)
+        return future
+
+    def cancel_writes(self):
+        """Fail every write future which can no longer be delivered. Only
+        safe once the workers have stopped, as it drains their queues."""
+        with self.led_lock:
+            led_futures, self.led_futures = self.led_futures, {}
+        for futures in led_futures.values():
+            resolve_writes(futures, WriteError.SHUTDOWN)
+        for pending in (self.screen_string_queue, self.write_queue):
+            while True:
+                try:
+                    item = pending.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not Controller.QUEUE_SHUTDOWN:
+                    resolve_writes(item[1] if pending is self.write_queue else [item[1]],
+                                   WriteError.SHUTDOWN)
+                pending.task_done()
+
+    def invalidate_leds(self, indexes=None):
+        """Forget what the device is showing, so that the next flush resends
+        every component in the framebuffer, or only those at indexes."""
+        with self.led_lock:
+            if indexes is None:
+                self.led_flushed = {}
+                self.led_dirty.update(self.led_framebuffer)
+            else:
+                for index in indexes:
+                    self.led_flushed.pop(index, None)
+                    if index in self.led_framebuffer:
+                        self.led_dirty.add(index)
+            if self.led_dirty:
+                self.led_event.set()
+
+    def led_pending(self):
+        with self.led_lock:
+            return bool(self.led_dirty) or self.led_flushing
 
     def clear(self):
         # Reset mappings to empty
@@ -528,44 +952,61 @@ class Controller:
             { "led": [] },
         ])
 
-    def cycle(self):
-        # Cycle through each LED and reset to white.
-        for component in self.layout.connected():
-            self.led([
-                {"b": 0, "g": 0, "i": component.index, "m": 0, "r": 255},
-            ])
-            self.led([
-                {"b": 255, "g": 255, "i": component.index, "m": 0, "r": 255},
-            ])
-            cr, cg, cb = self.current_led_values
-            self.led([
-                {"b": cb, "g": cg, "i": component.index, "m": 0, "r": cr},
-            ])
-
     def print_stats(self):
-        print('[@] Cumulative dropped_leds:', self.dropped_leds)
+        print('[@] Cumulative failed_reads:', self.failed_reads)
+        print('[@] Cumulative coalesced_leds:', self.coalesced_leds)
         print('[@] Cumulative dropped_screen_strings:', self.dropped_screen_strings)
         print('[@] Cumulative failed_writes:', self.failed_writes)
+        print('[@] Cumulative write_requests:', self.write_requests)
+        print('[@] Cumulative write_transfers:', self.write_transfers)
+        print('[@] Cumulative executed_callbacks:', self.callback_executor.executed)
+        print('[@] Cumulative coalesced_callbacks:', self.callback_executor.coalesced)
+        print('[@] Cumulative dropped_callbacks:', self.callback_executor.dropped)
+        print('[@] Cumulative failed_callbacks:', self.callback_executor.failed)
+        print('[@] Cumulative profile_switches:', self.profile_switches)
+        print('[@] Cumulative config_reloads:', self.config_reloads)
+        print('[@] Cumulative state_writes:', self.state_store.writes)
+        print('[@] Cumulative coalesced_commands:', self.coalesced_commands())
+        if self.write_transfers:
+            print('[@] Writes per transfer: %.2f' % (
+                self.write_requests / self.write_transfers))
+        print('[@] Paced led rate: %.1f/s (%d backoffs)' % (
+            self.led_pacer.rate, self.led_pacer.decreases))
+        print('[@] Paced screen_string rate: %.1f/s (%d backoffs)' % (
+            self.screen_string_pacer.rate, self.screen_string_pacer.decreases))
 
     def screen_string_worker(self):
         while not self.shutdown_event.is_set():
-            if time.time() - self.last_screen_string_time < Controller.SCREEN_STRING_DELAY_SECONDS:
-                wait = Controller.SCREEN_STRING_DELAY_SECONDS - (time.time() - self.last_screen_string_time)
-                time.sleep(wait)
             self.drop_stale_screen_strings()
-            try:
-                title = self.screen_string_queue.get(timeout=Controller.QUEUE_TIMEOUT_SECONDS)
-            except queue.Empty:
-                pass
-            else:
-                messages = []
-                if self.device.legacy():
-                    messages = [{ "screen_string": str(title) }]
-                self.bulk_write_messages(messages)
-                component = self.layout.find_component(1)
-                component.screen_string = str(title)
-                self.last_screen_string_time = time.time()
+            if self.shutdown_event.is_set():
+                break
+            item = self.screen_string_queue.get()
+            if item is Controller.QUEUE_SHUTDOWN:
                 self.screen_string_queue.task_done()
+                continue
+            title, write = item
+            title = str(title)
+            # the interval before an update depends on its own length.
+            delay = self.screen_string_delay(title)
+            if time.time() - self.last_screen_string_time < delay:
+                wait = delay - (time.time() - self.last_screen_string_time)
+                time.sleep(wait)
+            messages = []
+            futures = [write] if write else []
+            if self.device.legacy():
+                messages = [{ "screen_string": title }]
+                self.pace(self.screen_string_pacer, futures, delay)
+            self.bulk_write_messages(messages, futures)
+            component = self.layout.find_component(1)
+            component.screen_string = title
+            self.last_screen_string_time = time.time()
+            self.screen_string_queue.task_done()
+            self.notify_state()
+
+    def screen_string_delay(self, title):
+        """Seconds to wait after the previous screen string before title."""
+        length = len(title.encode('utf-8'))
+        return max(self.screen_string_pacer.delay(), self.screen_string_cost.interval(length))
 
     def drop_stale_screen_strings(self):
         # a full queue means we have fallen behind the device; drop all but the
@@ -573,34 +1014,46 @@ class Controller:
         if not self.screen_string_queue.full():
             return
         for _ in range(self.screen_string_queue.qsize() - 2):
-            self.screen_string_queue.get(timeout=Controller.QUEUE_TIMEOUT_SECONDS)
+            _, write = self.screen_string_queue.get(timeout=Controller.QUEUE_TIMEOUT_SECONDS)
+            resolve_writes(write and [write], WriteError.DROPPED)
             self.screen_string_queue.task_done()
             self.dropped_screen_strings += 1
 
-    def screen_string(self, title):
+    def screen_string(self, title, future=False, wait=False):
+        """Queue a screen string. With future or wait, returns a Future
+        which fails with WriteError.DROPPED or WriteError.COALESCED when the
+        title is not sent. With wait, blocks until the Future is done."""
+        write = self.write_future('screen_string', future or wait)
         # skip a title identical to the one most recently queued. deduping
         # against the last enqueued value (set synchronously here) rather than
         # the last delivered value keeps the result independent of worker
         # timing and avoids dropping an intermediate update that differs from
         # what is currently displayed but repeats a still-queued value.
         if title == self.last_enqueued_screen_string:
-            return
+            resolve_writes(write and [write], WriteError.COALESCED)
+            return self.write_result(write, future or wait, wait)
         try:
-            self.screen_string_queue.put(title, timeout=Controller.QUEUE_TIMEOUT_SECONDS)
+            self.screen_string_queue.put((title, write), timeout=Controller.QUEUE_TIMEOUT_SECONDS)
         except queue.Full:
             self.dropped_screen_strings += 1
-            return
+            resolve_writes(write and [write], WriteError.DROPPED)
+            return self.write_result(write, future or wait, wait)
         self.last_enqueued_screen_string = title
+        return self.write_result(write, future or wait, wait)
 
     def screen_write(self, path, index):
         print('[0] Uploading image %s to index %d' % (path, index))
         with open(path, 'rb') as f:
-            data = message_encode([{'screen_write': index}], self.message_format, f.read())
-            flen = f.tell()
-        self.handle.bulkWrite(data, 10000)
-        print('[0] Image upload to index %d (%d bytes) complete!'  % (index, flen))
+            image = f.read()
+        # queued, so that it is written in order with everything else.
+        write = self.write_future('screen_write', True)
+        self.bulk_write_messages([{'screen_write': index}], [write], image)
+        if self.write_result(write, True, True).exception():
+            print('[!] Image upload to index %d failed: %s' % (index, write.exception()))
+            return
+        print('[0] Image upload to index %d (%d bytes) complete!'  % (index, len(image)))
 
-    def screen_display(self, index):
+    def screen_display(self, index, future=False, wait=False):
         messages = []
 
         if self.device.legacy():
@@ -608,10 +1061,12 @@ class Controller:
         else:
             messages = [{'invoke_display': index}]
 
-        self.bulk_write_messages(messages)
+        write = self.write_future('screen_display', future or wait)
+        self.bulk_write_messages(messages, write and [write])
 
         component = self.layout.find_component(1)
         component.screen_display = index
+        return self.write_result(write, future or wait, wait)
 
     def initialize(self):
         # TODO: initialize layout using configuration and set up
@@ -630,9 +1085,9 @@ class Controller:
 
         self.check()
 
-    def configure_orientation(self):
+    def configure_orientation(self, components=None):
         messages = []
-        for component in self.layout.connected():
+        for component in components or self.layout.connected():
             flip = 1 if component.flip else 0
             messages.append({"flip": [ {"i": component.index, "m": flip } ]})
         self.bulk_write_messages(messages)
@@ -692,7 +1147,7 @@ class Controller:
 
         self.start()
 
-    def led_draw(self, pixels, x, y, w, h):
+    def led_draw(self, pixels, x, y, w, h, future=False, wait=False):
         leds = []
         for cy in range(y, y - h, -1):
             for cx in range(x, x + w):
@@ -701,16 +1156,24 @@ class Controller:
                     continue
                 r, g, b = pixels.pop(0)
                 leds.append({"b": b, "g": g, "i": component.index, "m": 0, "r": r})
-        self.led(leds)
+        return self.led(leds, future, wait)
+
+    def configure_leds(self, red=None, green=None, blue=None, components=None):
+        # colors set explicitly apply to every component, otherwise the
+        # profile's own colors take precedence.
+        colors = {}
+        state = self.profile_states.get(self.config.profile)
+        if state and red is None and green is None and blue is None:
+            colors = state.colors
 
-    def configure_leds(self, red=None, green=None, blue=None):
         if red is None: red = self.current_led_values[0]
         if green is None: green = self.current_led_values[1]
         if blue is None: blue = self.current_led_values[2]
 
         leds = []
-        for component in self.layout.connected():
-            leds.append({"b": blue, "g": green, "i": component.index, "m":0, "r": red})
+        for component in components or self.layout.connected():
+            r, g, b = colors.get(component.uid, (red, green, blue))
+            leds.append({"b": b, "g": g, "i": component.index, "m":0, "r": r})
         self.led(leds)
 
         # FIXME: this may not represent current state as self.led() is asynchronous
@@ -765,8 +1228,8 @@ class Controller:
 
     # FIXME: keep consistent mapping across disconnect/reconnect
     # need to remove reliance on index (use uid instead)
-    def configure_midimap(self):
-        for component in self.layout.connected():
+    def configure_midimap(self, components=None):
+        for component in components or self.layout.connected():
             if component.kind == Component.KIND_DIAL:
                 self.configure_midimap_dial(component)
             if component.kind == Component.KIND_BUTTON:
@@ -785,29 +1248,37 @@ class Controller:
                 hidmaps.append(hm)
         #self.bulk_write_messages([{ "hidmap": hidmaps }])
 
-    def configure_display(self):
-        orientation = int((180 + self.config.profile.orientation) % 360 / 90)
-        self.bulk_write_messages([
+    def profile_display(self, profile):
+        orientation = int((180 + profile.orientation) % 360 / 90)
+        return [
             { "screen_orientation": orientation },
-            { "screen_display": self.config.profile.icon },
-            { "screen_string": self.config.profile.title },
-        ])
+            { "screen_display": profile.icon },
+            { "screen_string": profile.title },
+        ]
+
+    def configure_display(self, previous=None):
+        """Show the current profile on the screen. Given the display
+        messages shown until now, only those which differ are written."""
+        messages = self.profile_display(self.config.profile)
+        if previous is not None:
+            messages = [m for m, p in zip(messages, previous) if m != p]
+        if messages:
+            self.bulk_write_messages(messages)
         component = self.layout.find_component(1)
         component.screen_string = self.config.profile.title
         component.screen_display = self.config.profile.icon
 
-    def configure_component_hidkeys(self):
-        for component in self.layout.connected():
-            self.set_component_hidkeys(component)
-
-    def set_component_hidkeys(self, component):
-        for control, key, mod, repeat in self.config.component_hidkeys(component.uid):
-            component.set_hidkey(control, key, mod, repeat)
-
     # TODO: this function could be moved to out of Controller along with the maps.
     # could be a static method eg. ComponentBehavior.from_action(...) and might
     # be possible to remove action_config param from ComponentBehavior.__init__()
-    def make_action_behavior(self, action_config, component_kind, input_type, action_name):
+    def make_action_behavior(self, action_config, component_kind, input_type, action_name, items=None):
+        """The frozen behavior for a binding. Behaviors are interned, so
+        identical bindings share one instance and are only composed once."""
+        key = (component_kind, input_type, action_name, canonical_config(action_config),
+               None if items is None else tuple(items))
+        behavior = self.behaviors.get(key)
+        if behavior is not None:
+            return behavior
         behavior = ComponentBehavior(action_config=action_config)
         if component_kind in Controller.BEHAVIOR_KIND_DEFAULTS:
             behavior += Controller.BEHAVIOR_KIND_DEFAULTS[component_kind]
@@ -815,36 +1286,216 @@ class Controller:
            behavior += Controller.BEHAVIOR_INPUT_DEFAULTS[input_type]
         if action_name in Controller.BEHAVIOR_ACTION_DEFAULTS:
             behavior += Controller.BEHAVIOR_ACTION_DEFAULTS[action_name]
+        if items is not None:
+            behavior.set_items(items)
+        self.behaviors[key] = behavior.freeze()
         return behavior
 
     # TODO: Move this (and callback methods) to outside of Ambit class
     # and instead allow subclasses to set them up. We can have a common
     # subclass which is the default behavior.
-    def configure_component_callbacks(self):
+    def configure_component_callbacks(self, added=None):
+        """Bind the configured actions of every profile and activate the
+        current one, so that a profile switch is only a swap. Given the
+        components a layout change added, only those and the components
+        which now match different queries are rebound. Returns the
+        components whose current bindings were rebound."""
+        profiles = list(self.config.profiles)
+        if self.config.profile not in profiles:
+            profiles.append(self.config.profile)
+
+        previous_states = self.profile_states if added is not None else {}
+        states = {}
+        for profile in profiles:
+            states[profile] = self.profile_state(profile, previous_states.get(profile), added)
+        self.profile_states = states
+
+        state = states[self.config.profile]
+        previous = previous_states.get(self.config.profile)
+        rebound = []
         for component in self.layout.connected():
-            component.reset()
-        for uid_query in self.config.components():
+            if previous is None or previous.callbacks.get(component.uid) is not state.callbacks[component.uid]:
+                rebound.append(component)
+        self.activate_profile(state)
+        self.prune_behaviors()
+        return rebound
+
+    def prune_behaviors(self):
+        """Forget the interned behaviors no profile binds any more, such
+        as those of a reloaded configuration."""
+        live = set()
+        for state in self.profile_states.values():
+            for callbacks in state.callbacks.values():
+                live.update(id(invocation.behavior) for invocation in callbacks.values())
+        self.behaviors = {key: behavior for key, behavior in list(self.behaviors.items())
+                          if id(behavior) in live}
+
+    def profile_state(self, profile, previous=None, added=None):
+        """Bind the configured actions of profile on the current layout,
+        reusing the bindings in previous for components which were not
+        added and whose queries, actions and hidkeys are unchanged."""
+        state = ProfileState(profile)
+        for uid_query in self.config.components(profile):
             components = self.layout.query(uid_query)
             if components:
-                component = components[0]
-                self.set_component_callbacks(uid_query, component)
+                state.bindings.setdefault(components[0].uid, []).append(uid_query)
 
-    def set_component_callbacks(self, uid_query, component):
-        for input_type, action_name, action_config in self.config.component_actions(uid_query):
+        for component in self.layout.connected():
+            uid = component.uid
+            uid_queries = state.bindings.get(uid, [])
+            signature = state.signatures[uid] = (
+                    uid_queries,
+                    [self.config.component_actions(q, profile) for q in uid_queries],
+                    self.config.component_hidkeys(uid, profile))
+            if (previous is not None and component not in (added or ())
+                    and previous.signatures.get(uid) == signature):
+                state.callbacks[uid] = previous.callbacks[uid]
+                state.hidkeys[uid] = previous.hidkeys[uid]
+                continue
+            callbacks = state.callbacks[uid] = {}
+            for uid_query in uid_queries:
+                callbacks.update(self.component_callbacks(uid_query, component, profile))
+            state.hidkeys[uid] = list(signature[2])
+
+        state.colors = self.config.component_colors(profile)
+        return state
+
+    def activate_profile(self, state):
+        """Swap in the bindings of a profile state. Component callbacks are
+        the state's own dicts, so rebinding a component of the active
+        profile also updates its state."""
+        for component in self.layout.connected():
+            component.callbacks = state.callbacks.get(component.uid, {})
+            component.hidkeys = state.hidkeys.get(component.uid, [])
+            component.dispatch = None
+        self.component_bindings = state.bindings
+        self.bound_profile = state.profile
+
+    def switch_profile(self, index):
+        """Switch to the profile at index without a layout round trip: its
+        bindings were made when the layout was configured, so only they
+        are swapped in and only the device state which differs from the
+        previous profile is written."""
+        with self.configure_lock:
+            previous = self.config.profile
+            self.config.switch(index)
+            state = self.profile_states.get(self.config.profile)
+            if state is None:
+                # nothing is bound until the first layout has been processed.
+                return
+            self.profile_switches += 1
+            self.activate_profile(state)
+            self.configure_profile(self.profile_display(previous), self.config.component_colors(previous))
+
+    def configure_profile(self, previous_display, previous_colors):
+        """Write the device state of the current profile which differs
+        from the display messages and led colors of the one shown until
+        now."""
+        self.configure_display(previous_display)
+        self.configured_orientation = self.config.profile.orientation
+        colors = self.config.component_colors()
+        changed = [c for c in self.layout.connected()
+                   if colors.get(c.uid) != previous_colors.get(c.uid)]
+        if changed:
+            self.configure_leds(components=changed)
+
+        # component orientations are relative to the profile orientation.
+        if self.layout.base_orientation != self.config.profile.orientation:
+            self.layout.base_orientation = self.config.profile.orientation
+            self.process_layout(self.layout.layout_dict)
+
+    def reload_config(self, paths):
+        """Reload the configuration files at paths and rebind only the
+        components whose bindings changed. The device connection and the
+        persistent state of every component are left alone."""
+        with self.configure_lock:
+            previous_display = self.profile_display(self.config.profile)
+            previous_colors = self.config.component_colors()
+            reloaded = self.config.reload(paths)
+            if not reloaded:
+                return
+            self.config_reloads += 1
+            if not self.layout_processed:
+                # bindings are made with the first layout.
+                return
+            for profile in reloaded:
+                previous = self.profile_states.get(profile)
+                state = self.profile_states[profile] = self.profile_state(profile, previous)
+                if profile is not self.config.profile:
+                    continue
+                rebound = [c for c in self.layout.connected()
+                           if previous is None or state.callbacks[c.uid] is not previous.callbacks.get(c.uid)]
+                self.activate_profile(state)
+                print('[0] Rebound %d components of profile %s' % (len(rebound), profile.title))
+                self.configure_profile(previous_display, previous_colors)
+            self.prune_behaviors()
+
+    def start_config_watch(self):
+        if FLAGS.watch_config and self.config.paths:
+            self.config_watcher = ConfigWatcher(self.config.paths, self.reload_config)
+            self.config_watcher.start()
+
+    def stop_config_watch(self):
+        if self.config_watcher:
+            self.config_watcher.stop()
+            self.config_watcher = None
+
+    def component_callbacks(self, uid_query, component, profile=None):
+        """Invocations for the actions profile configures for uid_query,
+        keyed by input type."""
+        profile = profile or self.config.profile
+        callbacks = {}
+        for input_type, action_name, action_config in self.config.component_actions(uid_query, profile):
             if action_name not in self.action_callback_map:
                 print('[0] Unrecognized action type:', action_name)
                 continue
             callback = self.action_callback_map[action_name]
 
-            behavior = self.make_action_behavior(action_config, component.kind, input_type, action_name)
+            callback = self.dispatch_callback(component, input_type, action_name, action_config, callback)
+
+            items = None
+            if action_name == Configuration.ACTION_PROFILE_SWITCH:
+                items = self.config.profiles
+            behavior = self.make_action_behavior(action_config, component.kind, input_type, action_name, items)
+
+            # the value of a profile switch is the profile index, which
+            # is shared by every profile and starts over on restart.
+            persistent_state = None
+            if action_name != Configuration.ACTION_PROFILE_SWITCH:
+                persistent_state = self.state_store.state(component.uid, profile.path or profile.title)
+
+            data = None
             if action_name == Configuration.ACTION_EXECUTE_COMMAND:
-                behavior.data = [action_config['argv']]
+                data = [self.command_runner(component.uid, input_type, action_config, profile)]
             if action_name == Configuration.ACTION_CYCLE_MAPPING:
-                behavior.data = [action_config['target']]
-            if action_name == Configuration.ACTION_PROFILE_SWITCH:
-                behavior.set_items(self.config.profiles)
+                data = [action_config['target']]
+
+            invocation = component.make_invocation(
+                    input_type, action_name, behavior, callback, action_config, data, persistent_state)
+            if invocation is not None:
+                callbacks[input_type] = invocation
+        return callbacks
 
-            component.set_callback(input_type, action_name, behavior, callback, action_config)
+    def set_component_callbacks(self, uid_query, component):
+        component.callbacks.update(self.component_callbacks(uid_query, component))
+        component.dispatch = None
+
+    def dispatch_callback(self, component, input_type, action_name, action_config, callback):
+        """Wrap callback to run on the callback executor, in order with the
+        other callbacks of the component, unless its policy is inline.
+        None of the built in actions block (executeCommand has its own
+        runner), so they default to inline."""
+        policy = action_config.get('dispatch', self.action_dispatch.get(action_name, CallbackExecutor.INLINE))
+        if policy not in CallbackExecutor.POLICIES:
+            print('[0] Unrecognized dispatch policy:', policy)
+            policy = CallbackExecutor.QUEUE
+        if policy == CallbackExecutor.INLINE:
+            return callback
+
+        uid = component.uid
+        def dispatch(*args):
+            self.callback_executor.submit(uid, (uid, input_type), policy, callback, *args)
+        return dispatch
 
     def callback_test_cycle(self, value):
         _, value = value
@@ -866,17 +1517,40 @@ class Controller:
         self.set_component_callbacks(component.uid, component)
         self.screen_string(['Red', 'Green', 'Blue'][index])
 
-    def callback_execute_command(self, value, argv):
-        cmd = []
-        for a in argv:
-            cmd.append(a.replace('%AMBIT_VALUE%', str(value)))
-        print('[0] Executing command: %s' % cmd)
-        p = subprocess.run(
-                cmd, env=os.environ.update({'AMBIT_VALUE': str(value)}),
-                stdout=subprocess.PIPE)
-        result = p.stdout.decode().split('\n')[0].strip()
-        if result:
-            self.screen_string(result)
+    def command_runner(self, uid, input_type, action_config, profile=None):
+        cache = None
+        if action_config.get('cacheTtl'):
+            cache = CommandCache(
+                    action_config['cacheTtl'],
+                    action_config.get('cacheSize', CommandCache.DEFAULT_MAX_ENTRIES))
+        runner = CommandRunner(
+                action_config['argv'],
+                output_callback=self.screen_string,
+                debounce=action_config.get('debounce', CommandRunner.DEFAULT_DEBOUNCE_SECONDS),
+                max_concurrency=action_config.get('maxConcurrency', CommandRunner.DEFAULT_MAX_CONCURRENCY),
+                done_callback=self.notify_state,
+                cache=cache)
+        key = (uid, input_type, profile or self.config.profile)
+        previous = self.command_runners.get(key)
+        if previous:
+            previous.cancel()
+        self.command_runners[key] = runner
+        return runner
+
+    def release_command_runners(self, uid):
+        """Cancel and forget the runners of a detached component, in
+        every profile."""
+        for key in [key for key in self.command_runners if key[0] == uid]:
+            runner = self.command_runners.pop(key)
+            runner.cancel()
+            self.detached_coalesced_commands += runner.coalesced
+
+    def coalesced_commands(self):
+        return self.detached_coalesced_commands + sum(
+                r.coalesced for r in list(self.command_runners.values()))
+
+    def callback_execute_command(self, value, runner):
+        runner.run(value)
 
     def callback_set_color_red(self, value):
         value = int(value)
@@ -894,20 +1568,16 @@ class Controller:
         self.screen_string('Blue: %d' % value)
 
     def callback_profile_switch(self, value):
-        value = int(value)
-        self.config.switch(value)
-        self.start()
+        self.switch_profile(int(value))
 
     def callback_profile_prev(self, unused_value):
-        self.config.prev()
-        self.start()
+        self.switch_profile((self.config.profile_index - 1) % len(self.config.profiles))
 
     def callback_profile_next(self, unused_value):
-        self.config.next()
-        self.start()
+        self.switch_profile((self.config.profile_index + 1) % len(self.config.profiles))
 
-    def print_layout(self):
-        for component in self.layout.connected():
+    def print_layout(self, components=None):
+        for component in components or self.layout.connected():
             bound_inputs = []
             for input_type, action_name, _ in self.config.component_actions(component.uid):
                 bound_inputs.append('%s (%s)' % (input_type, action_name))
@@ -953,17 +1623,30 @@ class Controller:
             self.process_version_core(message['version_core'])
 
     def process_layout(self, layout_dict):
-        self.layout.update(layout_dict)
+        with self.configure_lock:
+            diff = self.layout.update(layout_dict)
+            if self.layout_processed:
+                self.reconfigure_layout(diff)
+            else:
+                self.configure_layout()
+            self.layout_processed = True
+
+        print('[0] Processed layout, ready for input!')
+
+        self.notify_state()
+
+    def configure_layout(self):
+        """Configure the device for the whole layout, from scratch."""
+        self.invalidate_leds()
 
         self.print_layout()
         self.clear()
-        self.cycle()
 
         self.configure_component_callbacks()
         self.configure_orientation()
         self.configure_leds()
-        self.configure_component_hidkeys()
         self.configure_display()
+        self.configured_orientation = self.layout.base_orientation
 
         # TODO: support layout change callback
         #self.layout_changed_callback()
@@ -972,9 +1655,47 @@ class Controller:
             self.configure_midimap()
         #self.configure_hidmap()
 
-        print('[0] Processed layout, ready for input!')
+    def reconfigure_layout(self, diff):
+        """Configure only what a layout change affected: the device state
+        of added, moved and reoriented components, and the bindings of
+        components whose matching queries changed. A profile switch
+        rebinds every component."""
+        profile_changed = self.config.profile is not self.bound_profile
+        if not diff and not profile_changed:
+            return
+
+        for component in diff.removed:
+            print('[0] Component detached: %s (%d) %s' % (
+                component.kind_name(), component.index, component.uid))
+            self.release_command_runners(component.uid)
+        affected = diff.affected()
+        self.print_layout(diff.added)
+
+        # indexes may have been reassigned, so whatever the device shows
+        # there is unknown.
+        readdressed = diff.added + diff.moved
+        self.invalidate_leds([c.index for c in readdressed])
+
+        self.configure_component_callbacks(None if profile_changed else diff.added)
+        if affected:
+            self.configure_orientation(affected)
+        if readdressed:
+            self.configure_leds(components=readdressed)
+        if profile_changed or self.configured_orientation != self.layout.base_orientation:
+            self.configure_display()
+            self.configured_orientation = self.layout.base_orientation
+
+        if FLAGS.map_midi and readdressed:
+            self.configure_midimap(readdressed)
 
     def process_input(self, input_messages):
+        if ambit.trace.current() is None:
+            self.process_input_messages(input_messages)
+            return
+        with ambit.trace.span('process_input'):
+            self.process_input_messages(input_messages)
+
+    def process_input_messages(self, input_messages):
         for input_dict in input_messages:
             if not input_dict:
                 continue
@@ -992,17 +1713,19 @@ class Controller:
                     if v[0] == 254:
                         v[0] = 255
 
-            component.previous_values = component.values
-            component.values = v
-            for input_type in component.determine_input_types():
-                raw_value = component.dominant_value(input_type)
+            component.update_values(v)
+            for input_type, vindex in component.dispatch_inputs():
+                raw_value = component.values[vindex]
                 value = component.invoke_callback(input_type)
+                if value is not None:
+                    self.input_callback_seconds.observe(time.monotonic() - self.read_timestamp)
                 self.print_input(component, input_type, value, raw_value)
                 self.display_input(component, input_type, value, raw_value)
 
     def process_version_core(self, version):
         print('[0] Detected Palette firmware version', version)
         self.version_core = version
+        self.select_pacing()
 
     def wait_for_layout(self):
         if not self.device.legacy():
@@ -1010,19 +1733,53 @@ class Controller:
                 {'get_layout': True},
             ])
 
-        while not self.layout:
-            time.sleep(Controller.DEFAULT_WAIT_SECONDS)
+        with self.condition:
+            self.condition.wait_for(lambda: (
+                self.layout_processed or self.shutdown_event.is_set()))
+
+        # the layout is only usable once the configuration it triggered
+        # has reached the device.
+        self.wait()
+
+    def idle(self):
+        """True when no callback, command, led, screen string or bulk write
+        is queued or in flight. A queue item is only marked done once the work it caused
+        has been handed to the next stage, so there is no gap between
+        stages in which everything looks idle."""
+        return (not self.led_pending()
+                and self.callback_executor.idle()
+                and all(r.idle() for r in list(self.command_runners.values()))
+                and not self.screen_string_queue.unfinished_tasks
+                and not self.write_queue.unfinished_tasks)
+
+    def notify_state(self):
+        with self.condition:
+            self.condition.notify_all()
 
     def wait(self):
-        while self.led_queue.qsize() > 0:
-            time.sleep(Controller.DEFAULT_WAIT_SECONDS)
-        while self.screen_string_queue.qsize() > 0:
-            time.sleep(Controller.DEFAULT_WAIT_SECONDS)
-        while self.write_queue.qsize() > 0:
-            time.sleep(Controller.DEFAULT_WAIT_SECONDS)
+        with self.condition:
+            self.condition.wait_for(lambda: (
+                self.idle() or self.shutdown_event.is_set()))
 
     def join(self):
         self.shutdown_event.set()
+        # wake the workers blocked on their queues.
+        self.write_queue.put(Controller.QUEUE_SHUTDOWN)
+        try:
+            self.screen_string_queue.put_nowait(Controller.QUEUE_SHUTDOWN)
+        except queue.Full:
+            pass
+        self.led_event.set()
+        self.notify_state()
+        self.stop_metrics()
+        self.stop_config_watch()
+        self.callback_executor.join()
+        for runner in list(self.command_runners.values()):
+            runner.cancel()
+        self.state_store.stop()
+        if FLAGS.trace_output and self.tracer.events:
+            self.tracer.export(FLAGS.trace_output)
+            print('[0] Wrote %d trace events to %s' % (len(self.tracer.events), FLAGS.trace_output))
         all_threads = (
                 self.keepalive_thread,
                 self.screen_string_thread,
@@ -1036,12 +1793,17 @@ class Controller:
                     thread.join()
                 except:
                     pass
+        self.cancel_writes()
 
     def spawn(self):
         self.bulk_read_thread.start()
         self.bulk_write_thread.start()
         self.screen_string_thread.start()
         self.led_thread.start()
+        self.callback_executor.start()
+        self.start_metrics()
+        self.start_config_watch()
+        self.state_store.start()
 
     def connect(self):
         self.bulk_read()
@@ -1063,12 +1825,11 @@ class Controller:
                     self.screen_string(screen_title)
             if cur_time - last_write_time > Controller.KEEPALIVE_TIMEOUT_SECONDS:
                 self.check()
-            time.sleep(Controller.DEFAULT_WAIT_SECONDS)
+            self.shutdown_event.wait(Controller.DEFAULT_WAIT_SECONDS)
 
     def communicate(self):
         try:
-            while not self.shutdown_event.is_set():
-                time.sleep(Controller.DEFAULT_WAIT_SECONDS)
+            self.shutdown_event.wait()
         except KeyboardInterrupt:
             print('\r[0] Received interrupt, shutting down...')
         except Exception as err:
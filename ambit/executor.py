@@ -0,0 +1,149 @@
+import ambit.trace
+
+import collections
+import queue
+import threading
+
+from typing import Any, Callable, Deque, Dict, List
+
+
+class CallbackLane(object):
+    """Pending calls for one lane, run strictly in submission order."""
+    pending: Deque[List[Any]]
+    running: Any
+
+    def __init__(self):
+        self.pending = collections.deque()
+        self.running = None
+
+
+class CallbackExecutor(object):
+    """Runs action callbacks on a bounded pool of worker threads, so a slow
+    action never stalls the thread reading from the device.
+
+    Calls submitted to the same lane (one per component) run one at a time
+    and in order. When a binding fires again before its previous call has
+    completed, its dispatch policy decides what happens to the new call."""
+
+    # run every call in turn.
+    QUEUE = 'queue'
+    # replace a call that has not started yet with the newer one.
+    LATEST = 'latest'
+    # discard the new call while the binding has one pending or running.
+    DROP = 'drop'
+    # run synchronously in the caller's thread, bypassing the executor.
+    INLINE = 'inline'
+
+    POLICIES = (QUEUE, LATEST, DROP, INLINE)
+
+    DEFAULT_WORKERS = 4
+    # calls beyond this many pending in one lane are dropped.
+    MAX_PENDING = 64
+
+    # queued to wake a worker blocked on the ready queue at shutdown.
+    SHUTDOWN = object()
+
+    lanes: Dict[Any, CallbackLane]
+    threads: List[threading.Thread]
+
+    def __init__(self, workers=DEFAULT_WORKERS, done_callback=None):
+        self.lock = threading.Lock()
+        self.lanes = {}
+        # lanes with a call ready to run and no call running.
+        self.ready = queue.Queue()
+        self.done_callback = done_callback
+        self.threads = []
+        for _ in range(workers):
+            self.threads.append(threading.Thread(target=self.worker))
+
+        self.executed = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def join(self):
+        for _ in self.threads:
+            self.ready.put(CallbackExecutor.SHUTDOWN)
+        for thread in self.threads:
+            if thread.is_alive() and thread is not threading.current_thread():
+                thread.join()
+
+    def submit(self, lane_key, binding, policy, function, *args):
+        """Schedule function(*args) on the lane. Returns False if the call
+        was dropped or merged into a pending call."""
+        if policy == CallbackExecutor.INLINE:
+            function(*args)
+            return True
+
+        with self.lock:
+            lane = self.lanes.get(lane_key)
+            if lane is None:
+                lane = CallbackLane()
+                self.lanes[lane_key] = lane
+
+            context = ambit.trace.current()
+            if policy == CallbackExecutor.LATEST:
+                for call in lane.pending:
+                    if call[0] == binding:
+                        call[1:] = [function, args, context]
+                        self.coalesced += 1
+                        return False
+
+            if policy == CallbackExecutor.DROP:
+                busy = lane.running == binding or any(
+                        call[0] == binding for call in lane.pending)
+                if busy:
+                    self.dropped += 1
+                    return False
+
+            if len(lane.pending) >= CallbackExecutor.MAX_PENDING:
+                self.dropped += 1
+                return False
+
+            lane.pending.append([binding, function, args, context])
+            if lane.running is None and len(lane.pending) == 1:
+                self.ready.put(lane_key)
+        return True
+
+    def worker(self):
+        while True:
+            lane_key = self.ready.get()
+            if lane_key is CallbackExecutor.SHUTDOWN:
+                break
+
+            with self.lock:
+                lane = self.lanes[lane_key]
+                binding, function, args, context = lane.pending.popleft()
+                lane.running = binding
+
+            try:
+                # the call carries the trace of the input which caused it.
+                with ambit.trace.activate(context):
+                    function(*args)
+            except Exception as err:
+                self.failed += 1
+                print('[!] Callback %s failed: %r' % (binding, err))
+
+            with self.lock:
+                self.executed += 1
+                lane.running = None
+                if lane.pending:
+                    self.ready.put(lane_key)
+                else:
+                    del self.lanes[lane_key]
+
+            if self.done_callback:
+                self.done_callback()
+
+    def idle(self):
+        with self.lock:
+            return not self.lanes
+
+    def pending(self):
+        """Number of calls waiting to run."""
+        with self.lock:
+            return sum(len(lane.pending) for lane in self.lanes.values())
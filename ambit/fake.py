@@ -192,11 +192,16 @@ class Handle:
     # sure the Controller read thread is ready.
     WRITE_QUEUE_DEPTH = 32
 
+    # full speed bulk endpoint.
+    MAX_PACKET_SIZE = 64
+
     def __init__(self, layout):
         self._write_queue = queue.Queue(Handle.WRITE_QUEUE_DEPTH)
         self._layout = layout
         self._last_check = 0
         self._dropped_writes = 0
+        self.max_packet_size = Handle.MAX_PACKET_SIZE
+        self.transfers = 0
         self.messages = {}
         self.leds = {}
         self.phase = None
@@ -286,6 +291,7 @@ class Handle:
             print('[F] Device Phase Change:', self.phase)
 
     def bulkWrite(self, data, timeout=0):
+        self.transfers += 1
         messages, extra_data = ambit.message_decode(data, self.message_format)
         if ambit.FLAGS.debug:
             print('[F] Handle.bulkWrite()', messages, timeout)
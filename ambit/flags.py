@@ -1,4 +1,5 @@
 import argparse
+import os
 
 flags = argparse.ArgumentParser(description='Take control of your Palette.')
 
@@ -20,6 +21,43 @@ flags.add_argument('--layouts', default=[], type=str, nargs='*',
 flags.add_argument('--map_midi', default=True, action='store_true',
                    help='map midi controller inputs')
 
+flags.add_argument('--metrics_address', default='',
+                   help='serve prometheus metrics on host:port or unix:/path (empty = disabled)')
+
+flags.add_argument('--metrics_snapshot', default='',
+                   help='periodically write a json metrics snapshot to this path (empty = disabled)')
+
+flags.add_argument('--metrics_snapshot_seconds', default=10, type=float,
+                   help='seconds between json metrics snapshots')
+
+flags.add_argument('--trace_output', default='',
+                   help='record input latency traces and write them as chrome trace json to this path at exit')
+
+flags.add_argument('--record_usb', default='',
+                   help='record all usb traffic to this path for ambit_replay')
+
+flags.add_argument('--replay', default='',
+                   help='usb recording to replay (ambit_replay only)')
+
+flags.add_argument('--replay_speed', default=1, type=float,
+                   help='replay speed multiplier, 0 = as fast as possible')
+
+flags.add_argument('--screen_string_cost', default='',
+                   help='screen string cost model, as short_bytes=3,short_seconds=0,'
+                   'long_seconds=0.05,per_byte_seconds=0')
+
+flags.add_argument('--config_cache', default='',
+                   help='cache of compiled configuration files, e.g. ~/.cache/ambit/profiles.cache '
+                   '(empty = disabled); only worthwhile for large configurations')
+
+flags.add_argument('--watch_config', default=True, action=argparse.BooleanOptionalAction,
+                   help='reload configuration files when they change')
+
+flags.add_argument('--state_path',
+                   default=os.path.join(os.environ.get('XDG_STATE_HOME') or os.path.expanduser('~/.local/state'),
+                                        'ambit', 'state.json'),
+                   help='keep component state such as dial values across restarts (empty = disabled)')
+
 flags.add_argument('config_paths', type=str, metavar='CONFIG', nargs='*',
                    help='configuration files to load')
 
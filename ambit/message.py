@@ -2,6 +2,7 @@ from ambit.flags import FLAGS
 
 import json
 import msgpack
+import re
 
 from typing import Any, Callable, Dict, List, Tuple
 
@@ -47,49 +48,276 @@ def message_decode(data: memoryview, message_format: int) -> Tuple[List[str], by
 
 
 def message_decode_json(data_bytes: bytes) -> Tuple[List[str], bytes]:
-    extra_data = bytes([])
-
-    if data_bytes.startswith(b'{"screen_write":'):
-        extra_data_start = data_bytes.index(b'}') + 1
-        extra_data = data_bytes[extra_data_start:]
-        data_bytes = data_bytes[:extra_data_start]
-
-    try:
-        read_str = data_bytes.decode()
-    except:
-        print('[!] Failed to decode bytes:', data_bytes);
-        return [], extra_data
-
-    # FIXME: this is an awful, terrible hack which will fail as soon
-    # as it encounters }{ inside of a string.
-    json_data = '[' + read_str.strip().replace('\n', ',').replace('}{', '},{') + ']'
-
-    try:
-        messages = json.loads(json_data)
-    except json.decoder.JSONDecodeError as err:
-        if FLAGS.debug:
-            print('[!] JSON DECODE FAILED:', json_data, '--', err)
-        messages = []
+    decoder = JsonMessageDecoder()
+    messages = decoder.feed(data_bytes)
+    return messages, decoder.extra_data
 
+
+def message_decode_msgpack(data_bytes: bytes) -> Tuple[List[str], bytes]:
+    decoder = MsgpackMessageDecoder()
+    messages = decoder.feed(data_bytes)
+    extra_data = b''
+    if decoder.pending():
+        extra_data = data_bytes[decoder.frame_offset:]
     return messages, extra_data
 
 
-def message_decode_msgpack(data_bytes: bytes) -> Tuple[List[str], bytes]:
-    # FIXME: handle bulk data transfers properly for msgpack
-    data_parts = data_bytes.split(b'~')
-    extra_data = data_parts[-1]
-    msgpack_data = data_parts[1:-1]
+def message_decoder(message_format: int) -> 'MessageDecoder':
+    if message_format == MESSAGE_FORMAT_MSGPACK:
+        return MsgpackMessageDecoder()
+
+    return JsonMessageDecoder()
+
+
+class MessageDecoder(object):
+    """Incremental decoder for the bulk read stream. Raw reads are passed
+    to feed() as they arrive and complete messages are returned; bytes
+    belonging to an incomplete message are retained for the next call."""
+
+    decode_failures: int
+
+    def __init__(self):
+        self.decode_failures = 0
+
+    def feed(self, data: Any) -> List[Any]:
+        raise NotImplementedError()
+
+    def pending(self) -> bool:
+        """True when a partially received message is buffered."""
+        raise NotImplementedError()
 
-    if extra_data:
-        extra_data = b'~' + extra_data
 
-    messages = []
-    for msgpack_item in msgpack_data:
+class JsonMessageDecoder(MessageDecoder):
+    """Legacy messages are JSON objects concatenated back to back,
+    optionally separated by newlines.
+
+    Object boundaries are found by counting the braces outside of
+    strings. The scan resumes where the previous feed() stopped, so a
+    large object arriving in many reads is scanned once, and each
+    complete object is parsed exactly once. A malformed object only costs
+    that object rather than the whole read. Objects are parsed as utf-8,
+    or as latin-1 if they are not valid utf-8."""
+
+    # a transfer starting with a screen_write message is followed by raw
+    # image bytes which run to the end of the transfer.
+    SCREEN_WRITE_PREFIX = b'{"screen_write":'
+    SEPARATORS = b' \t\r\n,'
+    OBJECT_START = ord('{')
+
+    # an unterminated object larger than this is assumed to be corrupt.
+    MAX_PENDING_BYTES = 64 * 1024
+
+    extra_data: bytes
+
+    def __init__(self):
+        super(JsonMessageDecoder, self).__init__()
+        self._buffer = bytearray()
+        # state of the scan of the object at the start of the buffer.
+        self._scanner = JsonObjectScanner()
+        # binary tail following a screen_write message in the last feed().
+        self.extra_data = b''
+
+    def feed(self, data: Any) -> List[Any]:
+        self.extra_data = b''
+        messages = []
+        buffer = self._buffer
+        if not buffer and bytes(data[:len(JsonMessageDecoder.SCREEN_WRITE_PREFIX)]) == JsonMessageDecoder.SCREEN_WRITE_PREFIX:
+            # only a message at the start of a transfer carries a tail.
+            data = bytes(data)
+            end = data.find(b'}') + 1
+            if end:
+                try:
+                    messages.append(self._parse(data[:end]))
+                except ValueError as err:
+                    self._fail(data[:end], err)
+                self.extra_data = data[end:]
+                return messages
+        buffer += data
+
+        pos = 0
+        while True:
+            if not self._scanner.scanning():
+                while pos < len(buffer) and buffer[pos] in JsonMessageDecoder.SEPARATORS:
+                    pos += 1
+                if pos == len(buffer):
+                    break
+                if buffer[pos] != JsonMessageDecoder.OBJECT_START:
+                    # resynchronize on the next object.
+                    start = buffer.find(b'{', pos)
+                    if start < 0:
+                        start = len(buffer)
+                    self._fail(bytes(buffer[pos:start]), 'expected object')
+                    pos = start
+                    continue
+                self._scanner.start(pos)
+
+            end = self._scanner.scan(buffer)
+            if end is None:
+                # incomplete, wait for the rest of the object.
+                break
+            try:
+                messages.append(self._parse(bytes(buffer[pos:end])))
+            except ValueError as err:
+                self._fail(bytes(buffer[pos:end]), err)
+            pos = end
+
+        del buffer[:pos]
+        self._scanner.shift(pos)
+        if len(buffer) > JsonMessageDecoder.MAX_PENDING_BYTES:
+            self._fail(bytes(buffer), 'unterminated object')
+            buffer.clear()
+            self._scanner.reset()
+        return messages
+
+    def _parse(self, data: bytes) -> Any:
         try:
-            message = msgpack.loads(msgpack_item)
+            text = data.decode('utf-8')
+        except UnicodeDecodeError:
+            text = data.decode('latin-1')
+        return json.loads(text)
+
+    def _fail(self, data: Any, reason: Any):
+        self.decode_failures += 1
+        if FLAGS.debug:
+            print('[!] JSON DECODE FAILED:', data, '--', reason)
+
+    def pending(self) -> bool:
+        return bool(self._buffer)
+
+
+JSON_OBJECT_TOKENS = re.compile(rb'[{}"\\]')
+
+
+class JsonObjectScanner(object):
+    """Finds the end of a JSON object which may arrive over several reads.
+    Only braces outside of strings are counted; the content itself is not
+    validated."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.offset = -1
+        self.depth = 0
+        self.in_string = False
+        self.skip = 0
+
+    def scanning(self) -> bool:
+        return self.offset >= 0
+
+    def start(self, pos: int):
+        self.offset = pos
+        self.depth = 0
+        self.in_string = False
+        self.skip = pos
+
+    def shift(self, count: int):
+        """Adjust the offsets after count bytes were dropped from the
+        start of the buffer."""
+        if self.scanning():
+            self.offset -= count
+            self.skip -= count
+
+    def scan(self, buffer: bytearray) -> Any:
+        """Return the offset just past the object, or None if it is not yet
+        terminated, in which case the next scan resumes at the end of the
+        buffer."""
+        for match in JSON_OBJECT_TOKENS.finditer(buffer, self.offset):
+            i = match.start()
+            if i < self.skip:
+                continue
+            token = match.group()
+            if self.in_string:
+                if token == b'\\':
+                    self.skip = i + 2
+                elif token == b'"':
+                    self.in_string = False
+            elif token == b'"':
+                self.in_string = True
+            elif token == b'{':
+                self.depth += 1
+            elif token == b'}':
+                self.depth -= 1
+                if self.depth == 0:
+                    self.reset()
+                    return i + 1
+        self.offset = len(buffer)
+        return None
+
+
+class MsgpackMessageDecoder(MessageDecoder):
+    """Each msgpack message is framed by a leading and a trailing b'~'.
+
+    The delimiter happens to be a valid msgpack object on its own (the
+    positive fixint 126), so the whole stream is handed to a single
+    msgpack.Unpacker and the framing is validated on the decoded objects
+    rather than by splitting the raw bytes, which breaks as soon as a
+    payload contains 0x7E."""
+
+    FRAME_DELIMITER = ord('~')
+
+    STATE_OPEN = 0
+    STATE_BODY = 1
+    STATE_CLOSE = 2
+
+    frame_offset: int
+
+    def __init__(self):
+        super(MsgpackMessageDecoder, self).__init__()
+        self._unpacker = msgpack.Unpacker()
+        self._state = MsgpackMessageDecoder.STATE_OPEN
+        self._message = None
+        self._received = 0
+        # stream offset just past the last complete frame.
+        self.frame_offset = 0
+
+    def feed(self, data: Any) -> List[Any]:
+        messages = []
+        self._unpacker.feed(data)
+        self._received += memoryview(data).nbytes
+        try:
+            for item in self._unpacker:
+                message = self._process_item(item)
+                if message is not None:
+                    messages.append(message)
         except ValueError as err:
-            print('[!] MSGPACK DECODE FAILED:', msgpack_item, '--', err)
-        else:
-            messages.append(message)
+            # the unpacker can not resynchronize within a corrupt buffer,
+            # so drop whatever is buffered and start over at the next read.
+            print('[!] MSGPACK DECODE FAILED:', err)
+            self.decode_failures += 1
+            self._reset()
+        return messages
 
-    return messages, extra_data
+    def _process_item(self, item: Any) -> Any:
+        if self._state == MsgpackMessageDecoder.STATE_OPEN:
+            if item != MsgpackMessageDecoder.FRAME_DELIMITER:
+                print('[!] MSGPACK FRAME ERROR, expected delimiter:', item)
+                self.decode_failures += 1
+                self.frame_offset = self._unpacker.tell()
+                return None
+            self._state = MsgpackMessageDecoder.STATE_BODY
+            return None
+
+        if self._state == MsgpackMessageDecoder.STATE_BODY:
+            self._message = item
+            self._state = MsgpackMessageDecoder.STATE_CLOSE
+            return None
+
+        message, self._message = self._message, None
+        self._state = MsgpackMessageDecoder.STATE_OPEN
+        self.frame_offset = self._unpacker.tell()
+        if item != MsgpackMessageDecoder.FRAME_DELIMITER:
+            print('[!] MSGPACK FRAME ERROR, unterminated message:', message)
+            self.decode_failures += 1
+            return None
+        return message
+
+    def _reset(self):
+        self._unpacker = msgpack.Unpacker()
+        self._state = MsgpackMessageDecoder.STATE_OPEN
+        self._message = None
+        self._received = 0
+        self.frame_offset = 0
+
+    def pending(self) -> bool:
+        return self._received != self.frame_offset
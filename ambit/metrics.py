@@ -0,0 +1,250 @@
+import bisect
+import http.server
+import json
+import os
+import socketserver
+import threading
+import time
+
+from typing import Any, Callable, Dict, List, Tuple
+
+
+# Seconds; covers sub-millisecond usb transfers up to multi-second stalls.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+# Bytes per bulk transfer.
+SIZE_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+# Items (writes, messages) per bulk transfer.
+COUNT_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+
+def labels_key(labels):
+    """Hashable, ordered form of a labels dict."""
+    if not labels:
+        return ()
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                             for k, v in pairs)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    TYPE = 'untyped'
+
+    name: str
+    help: str
+
+    def __init__(self, name, help, function=None):
+        self.name = name
+        self.help = help
+        # when set, sampled at export time instead of storing values. it
+        # returns a number, or a dict of labels dict items to numbers.
+        self.function = function
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def samples(self):
+        """List of (name, labels key, value) tuples."""
+        if self.function:
+            value = self.function()
+            if isinstance(value, dict):
+                return [(self.name, labels_key(dict(k)), v) for k, v in sorted(value.items())]
+            return [(self.name, (), value)]
+        with self.lock:
+            return [(self.name, k, v) for k, v in sorted(self.values.items())]
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, labels=None):
+        key = labels_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def set(self, value, labels=None):
+        with self.lock:
+            self.values[labels_key(labels)] = value
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    buckets: Tuple[float, ...]
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=None):
+        key = labels_key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # per bucket counts (plus +Inf), sum.
+                state = [[0] * (len(self.buckets) + 1), 0]
+                self.values[key] = state
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    samples.append((self.name + '_bucket', key + (('le', format_value(bound)),), cumulative))
+                samples.append((self.name + '_sum', key, total))
+                samples.append((self.name + '_count', key, cumulative))
+        return samples
+
+
+class MetricsRegistry(object):
+    """Named metrics of one controller, exportable as prometheus text or
+    as a json snapshot."""
+    metrics: Dict[str, Metric]
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError('duplicate metric: %s' % metric.name)
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, function=None):
+        return self.register(Counter(name, help, function))
+
+    def gauge(self, name, help, function=None):
+        return self.register(Gauge(name, help, function))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    def prometheus_text(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.TYPE))
+            for name, key, value in metric.samples():
+                lines.append('%s%s %s' % (name, format_labels(key), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        metrics = {}
+        for metric in self.metrics.values():
+            metrics[metric.name] = {
+                'type': metric.TYPE,
+                'samples': [{'name': name, 'labels': dict(key), 'value': value}
+                            for name, key, value in metric.samples()],
+            }
+        return {'time': time.time(), 'metrics': metrics}
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.registry.prometheus_text().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix socket clients have no address.
+        return str(self.client_address or 'unix')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class MetricsUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class MetricsServer(object):
+    """Serves prometheus text on host:port, or on a unix socket when the
+    address is given as unix:/path/to/socket."""
+
+    def __init__(self, registry, address):
+        self.address = address
+        if address.startswith('unix:'):
+            path = address[len('unix:'):]
+            if os.path.exists(path):
+                os.unlink(path)
+            self.server = MetricsUnixServer(path, MetricsRequestHandler)
+        else:
+            host, _, port = address.rpartition(':')
+            self.server = MetricsHTTPServer((host or '127.0.0.1', int(port)), MetricsRequestHandler)
+        self.server.registry = registry
+        self.thread = threading.Thread(target=self.server.serve_forever)
+
+    def start(self):
+        print('[0] Serving metrics on %s' % self.address)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.address.startswith('unix:'):
+            try:
+                os.unlink(self.address[len('unix:'):])
+            except OSError:
+                pass
+
+
+class MetricsSnapshotWriter(object):
+    """Periodically replaces path with a json snapshot of the registry."""
+
+    DEFAULT_INTERVAL_SECONDS = 10
+
+    def __init__(self, registry, path, interval=DEFAULT_INTERVAL_SECONDS):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.worker)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def worker(self):
+        while not self.stop_event.wait(self.interval):
+            self.write()
+        self.write()
+
+    def write(self):
+        tmp_path = '%s.tmp' % self.path
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.registry.snapshot(), f)
+            os.replace(tmp_path, self.path)
+        except OSError as err:
+            print('[!] Unable to write metrics snapshot %s: %s' % (self.path, err))
@@ -0,0 +1,130 @@
+import threading
+import time
+
+from typing import Any, Dict
+
+
+class PacerState(object):
+    """Learned rate for one device class and firmware version."""
+    rate: float
+    last_decrease: float
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.last_decrease = 0
+
+
+class Pacer(object):
+    """Closed loop (AIMD) rate control for a worker writing to the device.
+
+    Each update reports how long it took from being sent until its bulk
+    write completed. While updates complete within CONGESTION_FACTOR
+    intervals, the rate increases additively up to max_rate. A slower
+    update or a failed write means the device is falling behind, so the
+    rate is cut multiplicatively, at most once per round of updates.
+
+    The rate is learned separately for each key (device class, firmware
+    version), as they sustain very different throughput."""
+
+    # updates per second added for each update completed in time.
+    INCREASE = 1
+    # rate multiplier applied when the device falls behind.
+    DECREASE = 0.5
+    # an update taking longer than this many intervals is congested.
+    CONGESTION_FACTOR = 2
+
+    states: Dict[Any, PacerState]
+
+    def __init__(self, rate, min_rate, max_rate=None):
+        """A rate of zero disables pacing entirely."""
+        self.initial_rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate or rate
+        self.lock = threading.Lock()
+        self.states = {}
+        self.key = None
+        self.state = PacerState(rate)
+
+        self.increases = 0
+        self.decreases = 0
+
+    @property
+    def rate(self):
+        return self.state.rate
+
+    def select(self, key):
+        """Switch to the state learned for key, starting from the initial
+        rate the first time key is seen."""
+        with self.lock:
+            if key == self.key:
+                return
+            if self.key is not None:
+                self.states[self.key] = self.state
+            self.key = key
+            self.state = self.states.get(key) or PacerState(self.initial_rate)
+
+    def delay(self):
+        """Seconds between updates at the current rate."""
+        rate = self.state.rate
+        if not rate:
+            return 0
+        return 1 / rate
+
+    def observe(self, sent, completed, failed=False, interval=0):
+        """Adjust the rate for an update sent and completed at the given
+        monotonic times. interval is the spacing actually applied before
+        the update, when something other than the pacer set it longer."""
+        if not self.initial_rate:
+            return
+        with self.lock:
+            state = self.state
+            congested = failed or completed - sent > self.CONGESTION_FACTOR * max(interval, self.delay())
+            if congested:
+                # updates sent before the last cut were paced at the old
+                # rate, so they say nothing about the new one.
+                if sent < state.last_decrease:
+                    return
+                state.rate = max(self.min_rate, state.rate * self.DECREASE)
+                state.last_decrease = time.monotonic()
+                self.decreases += 1
+            elif state.rate < self.max_rate:
+                state.rate = min(self.max_rate, state.rate + self.INCREASE)
+                self.increases += 1
+
+
+class ScreenStringCost(object):
+    """Minimum interval before a screen string, by its length in bytes.
+
+    The screen keeps up with short strings at any rate, but hard resets
+    when longer ones arrive faster than about 20 per second. Strings of
+    up to short_bytes wait short_seconds; longer strings wait
+    long_seconds plus per_byte_seconds for each byte beyond short_bytes.
+    bin/ambit_benchmark measures the rate a device sustains per length."""
+
+    FIELDS = ('short_bytes', 'short_seconds', 'long_seconds', 'per_byte_seconds')
+
+    def __init__(self, short_bytes=3, short_seconds=0, long_seconds=1 / 20, per_byte_seconds=0):
+        self.short_bytes = int(short_bytes)
+        self.short_seconds = float(short_seconds)
+        self.long_seconds = float(long_seconds)
+        self.per_byte_seconds = float(per_byte_seconds)
+
+    @staticmethod
+    def parse(spec, **defaults):
+        """Build a cost model from 'field=value,...', filling in fields
+        which are not given from defaults."""
+        fields = dict(defaults)
+        for item in spec.split(','):
+            if not item.strip():
+                continue
+            name, _, value = item.partition('=')
+            name = name.strip()
+            if name not in ScreenStringCost.FIELDS or not value:
+                raise ValueError('invalid screen string cost: %r' % item)
+            fields[name] = float(value)
+        return ScreenStringCost(**fields)
+
+    def interval(self, length):
+        if length <= self.short_bytes:
+            return self.short_seconds
+        return self.long_seconds + self.per_byte_seconds * (length - self.short_bytes)
@@ -0,0 +1,102 @@
+"""On disk cache of compiled profiles, see Configuration.compile_profile."""
+
+import hashlib
+import msgpack
+import os
+import tempfile
+
+from typing import Dict, List
+
+
+class ProfileCache(object):
+    """Compiled profile tables stored in one msgpack file.
+
+    Tables are keyed by the sha256 of the file they were compiled from,
+    and each file path remembers the mtime, size and hash it had when it
+    was last seen. An unchanged file is loaded without being read, a
+    touched file is read and hashed but not recompiled, and only a file
+    whose content changed is compiled again. Tables are kept packed and
+    every load unpacks its own copy, since files with the same content
+    share a table and profiles update their maps in place. Bump VERSION
+    whenever the table format or the way tables are compiled changes."""
+
+    VERSION = 2
+
+    files: Dict[str, List]
+    tables: Dict[str, bytes]
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.tables = {}
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                cache = msgpack.unpackb(f.read())
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, msgpack.UnpackException) as err:
+            print('[!] Ignoring unreadable profile cache %s: %s' % (self.path, err))
+            return
+        if not isinstance(cache, dict) or cache.get('version') != ProfileCache.VERSION:
+            return
+        self.files = cache.get('files', {})
+        self.tables = cache.get('tables', {})
+
+    def profile_table(self, path, compile_fn):
+        """A copy of the table compiled from path, calling
+        compile_fn(path, data) with the file content only when no table
+        for it is cached."""
+        key = os.path.abspath(path)
+        stat = os.stat(key)
+        entry = self.files.get(key)
+        if entry and entry[:2] == [stat.st_mtime_ns, stat.st_size] and entry[2] in self.tables:
+            self.hits += 1
+            return msgpack.unpackb(self.tables[entry[2]])
+
+        with open(key, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        table = self.tables.get(digest)
+        if table is None:
+            self.misses += 1
+            table = self.tables[digest] = msgpack.packb(compile_fn(path, data))
+        else:
+            self.hits += 1
+        self.files[key] = [stat.st_mtime_ns, stat.st_size, digest]
+        self.dirty = True
+        return msgpack.unpackb(table)
+
+    def save(self):
+        """Write the cache if anything changed, dropping tables no file
+        refers to any more. The file is replaced atomically, so a reader
+        never sees a partial cache."""
+        if not self.dirty:
+            return
+        digests = set(entry[2] for entry in self.files.values())
+        self.tables = {d: t for d, t in self.tables.items() if d in digests}
+        data = msgpack.packb({
+            'version': ProfileCache.VERSION,
+            'files': self.files,
+            'tables': self.tables,
+        })
+        directory = os.path.dirname(self.path) or '.'
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.profiles.')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(temp_path, self.path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+        except OSError as err:
+            print('[!] Unable to write profile cache %s: %s' % (self.path, err))
+            return
+        self.dirty = False
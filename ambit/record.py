@@ -0,0 +1,201 @@
+"""Record usb traffic to a file and replay it into a Controller."""
+
+import struct
+import threading
+import time
+import usb
+
+from typing import Any, BinaryIO, List, Tuple
+
+
+RECORD_MAGIC = b'AMBITREC'
+RECORD_VERSION = 1
+
+# header: magic, version, legacy device flag.
+RECORD_HEADER = struct.Struct('<8sBB')
+# per transfer: kind, seconds since the recording started, payload length.
+RECORD_ENTRY = struct.Struct('<BdI')
+
+RECORD_WRITE = 1
+RECORD_READ = 2
+RECORD_READ_ERROR = 3
+RECORD_CONTROL = 4
+
+# errno raised by a replay handle once the recording is exhausted, which
+# the Controller treats as the device going away.
+ERRNO_NO_DEVICE = 19
+
+
+def read_recording(path):
+    """Returns (legacy, entries) where each entry is (kind, time, payload)."""
+    entries = []
+    with open(path, 'rb') as f:
+        header = f.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            raise ValueError('truncated recording: %s' % path)
+        magic, version, legacy = RECORD_HEADER.unpack(header)
+        if magic != RECORD_MAGIC or version != RECORD_VERSION:
+            raise ValueError('not an ambit recording: %s' % path)
+        while True:
+            entry = f.read(RECORD_ENTRY.size)
+            if len(entry) < RECORD_ENTRY.size:
+                break
+            kind, timestamp, length = RECORD_ENTRY.unpack(entry)
+            payload = f.read(length)
+            if len(payload) < length:
+                break
+            entries.append((kind, timestamp, payload))
+    return bool(legacy), entries
+
+
+class RecordingHandle(object):
+    """Wraps a Handle, appending every bulkWrite, bulkRead and controlMsg
+    to a recording with its monotonic time."""
+
+    def __init__(self, handle, path, legacy):
+        self._handle = handle
+        self._file = open(path, 'wb')
+        self._file.write(RECORD_HEADER.pack(RECORD_MAGIC, RECORD_VERSION, int(legacy)))
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self.path = path
+
+    def __getattr__(self, name):
+        return getattr(self._handle, name)
+
+    def _record(self, kind, payload):
+        timestamp = time.monotonic() - self._start
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(RECORD_ENTRY.pack(kind, timestamp, len(payload)))
+            self._file.write(payload)
+
+    def bulkWrite(self, data, timeout=0):
+        result = self._handle.bulkWrite(data, timeout)
+        self._record(RECORD_WRITE, bytes(data))
+        return result
+
+    def bulkRead(self, size, timeout=0):
+        try:
+            data = self._handle.bulkRead(size, timeout)
+        except usb.USBError as exc:
+            self._record(RECORD_READ_ERROR, struct.pack('<i', exc.errno or 0))
+            raise
+        self._record(RECORD_READ, bytes(data))
+        return data
+
+    def controlMsg(self, request_type, request, buffer, *args, **kwargs):
+        result = self._handle.controlMsg(request_type, request, buffer, *args, **kwargs)
+        payload = bytes([request_type, request])
+        if result is not None and not isinstance(result, int):
+            payload += bytes(result)
+        self._record(RECORD_CONTROL, payload)
+        return result
+
+    def releaseInterface(self):
+        try:
+            self._handle.releaseInterface()
+        finally:
+            self.close()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+                print('[0] Wrote usb recording to %s' % self.path)
+
+
+class ReplayHandle(object):
+    """Plays back the reads of a recording, accepting and counting writes
+    the way ambit.fake.Handle does.
+
+    speed scales the recorded timing: 1 is real time, 2 twice as fast and
+    0 as fast as possible. Once every read has been played back, bulkRead
+    raises a no-device error so the Controller shuts down."""
+
+    MAX_PACKET_SIZE = 64
+
+    def __init__(self, entries, speed=1):
+        self._reads = [(k, t, p) for k, t, p in entries if k in (RECORD_READ, RECORD_READ_ERROR)]
+        self._controls = [p[2:] for k, _, p in entries if k == RECORD_CONTROL]
+        self._read_index = 0
+        self._control_index = 0
+        self._start = None
+        self.speed = speed
+        self.max_packet_size = ReplayHandle.MAX_PACKET_SIZE
+
+        self.recorded_writes = sum(1 for k, _, _ in entries if k == RECORD_WRITE)
+        self.reads = 0
+        self.read_bytes = 0
+        self.writes = 0
+        self.write_bytes = 0
+        self.elapsed = 0
+
+    def _wait_until(self, timestamp):
+        if self._start is None:
+            self._start = time.monotonic() - timestamp / self.speed if self.speed else time.monotonic()
+        if self.speed:
+            delay = self._start + timestamp / self.speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def bulkRead(self, size, timeout=0):
+        if self._read_index >= len(self._reads):
+            if self._start is not None and not self.elapsed:
+                self.elapsed = time.monotonic() - self._start
+            raise usb.USBError('end of recording', errno=ERRNO_NO_DEVICE)
+        kind, timestamp, payload = self._reads[self._read_index]
+        self._read_index += 1
+        self._wait_until(timestamp)
+        if kind == RECORD_READ_ERROR:
+            errno, = struct.unpack('<i', payload)
+            # a device loss in the recording would end the replay early.
+            raise usb.USBError('recorded read error', errno=None if errno == ERRNO_NO_DEVICE else errno)
+        self.reads += 1
+        self.read_bytes += len(payload)
+        return memoryview(payload)
+
+    def bulkWrite(self, data, timeout=0):
+        self.writes += 1
+        self.write_bytes += len(data)
+        return len(data)
+
+    def controlMsg(self, request_type, request, buffer, *args, **kwargs):
+        if self._control_index < len(self._controls):
+            self._control_index += 1
+            return self._controls[self._control_index - 1]
+        return None
+
+    def reset(self):
+        pass
+
+    def releaseInterface(self):
+        pass
+
+    def print_stats(self):
+        print('[@] Replayed reads: %d (%d bytes) in %.3fs' % (self.reads, self.read_bytes, self.elapsed))
+        print('[@] Replayed writes: %d (%d bytes), %d recorded' % (
+            self.writes, self.write_bytes, self.recorded_writes))
+        if self.elapsed:
+            print('[@] Replayed reads per second: %.1f' % (self.reads / self.elapsed))
+
+
+class ReplayDevice(object):
+    """Stands in for a Device, opening a ReplayHandle over a recording."""
+
+    def __init__(self, path, speed=1):
+        self.path = path
+        self.speed = speed
+        self._legacy, self._entries = read_recording(path)
+        self.device_id = 'REPLAY'
+        self.interface_id = 0
+        self.handle = None
+
+    def legacy(self):
+        return self._legacy
+
+    def open(self):
+        print('[0] Replaying %d usb transfers from %s' % (len(self._entries), self.path))
+        self.handle = ReplayHandle(self._entries, self.speed)
+        return self.handle
@@ -0,0 +1,143 @@
+"""Component state which outlives the process, see StateStore."""
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+from typing import Any, Dict, Tuple
+
+
+class StateStore(object):
+    """The persistent_state of each component uid in each profile, kept
+    across restarts in a json file. Profiles are identified by the path
+    they were loaded from, since unrelated profiles often share a title.
+
+    Invocations read and write their state dict directly, so an input
+    event costs nothing extra. A writer thread snapshots the dicts every
+    POLL_SECONDS and writes them once they have been unchanged for
+    debounce seconds, or have kept changing for max_delay seconds, by
+    atomically replacing the file. The file is only read when the first
+    state is requested. Without a path, state is kept in memory."""
+
+    VERSION = 2
+    POLL_SECONDS = 0.5
+    DEBOUNCE_SECONDS = 2
+    MAX_DELAY_SECONDS = 30
+
+    states: Dict[Tuple[str, str], Dict[str, Any]]
+    stored: Dict[str, Dict[str, Dict[str, Any]]]
+
+    def __init__(self, path=None, debounce=DEBOUNCE_SECONDS, max_delay=MAX_DELAY_SECONDS):
+        self.path = path
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.states = {}
+        self.stored = {}
+        self.loaded = not path
+        # the last snapshot taken, when it last changed, and since when
+        # it differs from what was written.
+        self.seen = {}
+        self.changed_at = 0
+        self.dirty_at = None
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.worker)
+
+        self.writes = 0
+
+    def state(self, uid, profile):
+        """The state dict of uid in profile, shared by all its bindings."""
+        key = (profile, uid)
+        state = self.states.get(key)
+        if state is not None:
+            return state
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            state = self.states.get(key)
+            if state is None:
+                state = self.states[key] = dict(self.stored.get(profile, {}).get(uid, {}))
+            return state
+
+    def load(self):
+        self.loaded = True
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as err:
+            print('[!] Ignoring unreadable component state %s: %s' % (self.path, err))
+            return
+        if not isinstance(data, dict) or data.get('version') != StateStore.VERSION:
+            return
+        self.stored = data.get('profiles', {})
+        self.seen = self.snapshot()
+
+    def snapshot(self):
+        """{profile: {uid: state}}, including stored state not yet used."""
+        data = {profile: dict(uids) for profile, uids in self.stored.items()}
+        for (profile, uid), state in list(self.states.items()):
+            if state:
+                data.setdefault(profile, {})[uid] = dict(state)
+        return data
+
+    def start(self):
+        if self.path:
+            self.thread.start()
+
+    def stop(self):
+        """Stop the writer, writing any pending change."""
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.flush()
+
+    def worker(self):
+        while not self.stop_event.wait(StateStore.POLL_SECONDS):
+            self.tick()
+
+    def tick(self, now=None):
+        """Write the state if it settled or has been pending too long."""
+        if not self.path or not self.loaded:
+            return
+        now = time.monotonic() if now is None else now
+        snapshot = self.snapshot()
+        if snapshot != self.seen:
+            self.seen = snapshot
+            self.changed_at = now
+            if self.dirty_at is None:
+                self.dirty_at = now
+        if self.dirty_at is None:
+            return
+        if now - self.changed_at >= self.debounce or now - self.dirty_at >= self.max_delay:
+            self.write(snapshot)
+
+    def flush(self):
+        if not self.path or not self.loaded:
+            return
+        snapshot = self.snapshot()
+        if self.dirty_at is not None or snapshot != self.seen:
+            self.seen = snapshot
+            self.write(snapshot)
+
+    def write(self, snapshot):
+        directory = os.path.dirname(self.path) or '.'
+        try:
+            data = json.dumps({'version': StateStore.VERSION, 'profiles': snapshot})
+            os.makedirs(directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.state.')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(data)
+                os.replace(temp_path, self.path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+        except (OSError, TypeError, ValueError) as err:
+            print('[!] Unable to write component state %s: %s' % (self.path, err))
+            return
+        self.dirty_at = None
+        self.writes += 1
@@ -0,0 +1,147 @@
+import collections
+import itertools
+import json
+import os
+import threading
+import time
+
+from typing import Any, Deque, Dict
+
+
+# the trace context of the input being handled by the current thread.
+_local = threading.local()
+
+
+class TraceContext(object):
+    """Identifies one input message, from the moment it was read, as its
+    effects travel through callbacks and write queues."""
+    trace_id: int
+    read_time: float
+
+    def __init__(self, tracer, trace_id, read_time):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.read_time = read_time
+
+
+class Tracer(object):
+    """Records spans as chrome trace events (see chrome://tracing or
+    https://ui.perfetto.dev). Times are monotonic, in microseconds since
+    the tracer was created."""
+
+    DEFAULT_MAX_EVENTS = 100000
+
+    events: Deque[Dict[str, Any]]
+
+    def __init__(self, enabled=False, max_events=DEFAULT_MAX_EVENTS):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.events = collections.deque(maxlen=max_events)
+        self.thread_names = {}
+        self.trace_ids = itertools.count(1)
+        self.origin = time.monotonic()
+        self.pid = os.getpid()
+
+    def begin(self, read_time):
+        """Start tracing an input read at read_time (monotonic)."""
+        if not self.enabled:
+            return None
+        return TraceContext(self, next(self.trace_ids), read_time)
+
+    def record(self, name, start, end, context=None, **args):
+        if not self.enabled:
+            return
+        thread = threading.current_thread()
+        if context is not None:
+            args['trace_id'] = context.trace_id
+        event = {
+            'name': name,
+            'ph': 'X',
+            'ts': (start - self.origin) * 1e6,
+            'dur': (end - start) * 1e6,
+            'pid': self.pid,
+            'tid': thread.ident,
+            'args': args,
+        }
+        with self.lock:
+            self.thread_names[thread.ident] = thread.name
+            self.events.append(event)
+
+    def chrome_trace(self):
+        with self.lock:
+            events = [{
+                'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid,
+                'args': {'name': name},
+            } for tid, name in self.thread_names.items()]
+            events.extend(self.events)
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+def current():
+    return getattr(_local, 'context', None)
+
+
+class Activation(object):
+    """Makes a context current in this thread while entered."""
+    __slots__ = ('context', 'previous')
+
+    def __init__(self, context):
+        self.context = context
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = current()
+        _local.context = self.context
+        return self.context
+
+    def __exit__(self, *unused):
+        _local.context = self.previous
+
+
+class Span(object):
+    """Records the enclosed block against context."""
+    __slots__ = ('context', 'name', 'args', 'start')
+
+    def __init__(self, context, name, args):
+        self.context = context
+        self.name = name
+        self.args = args
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.monotonic()
+
+    def __exit__(self, *unused):
+        self.context.tracer.record(self.name, self.start, time.monotonic(), self.context, **self.args)
+
+
+class NoSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *unused):
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+def activate(context):
+    """Make context current in this thread for the duration."""
+    return Activation(context)
+
+
+def span(name, **args):
+    """Record the enclosed block against the current trace context, if
+    there is one. Hot paths check current() first, so that they neither
+    enter a span nor format its name and args when nothing is traced."""
+    context = current()
+    if context is None:
+        return NO_SPAN
+    return Span(context, name, args)
@@ -0,0 +1,158 @@
+"""Watch configuration files for changes, with inotify where available."""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+
+from typing import Dict, Optional, Tuple
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# wd, mask, cookie, name length, followed by the name.
+INOTIFY_EVENT = struct.Struct('iIII')
+INOTIFY_READ_SIZE = 65536
+
+
+def file_signature(path):
+    """(mtime, size) of path, or None when it can't be read."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+class Inotify(object):
+    """Just enough of inotify, through libc, to watch directories.
+    Raises OSError where inotify is unavailable."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+
+    def add_watch(self, directory, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed: %s' % directory)
+        self.watches[wd] = directory
+
+    def read(self, timeout):
+        """Paths of the files with events within timeout seconds."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, INOTIFY_READ_SIZE)
+        except BlockingIOError:
+            return []
+        paths = []
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            wd, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            directory = self.watches.get(wd)
+            if directory is not None and name:
+                paths.append(os.path.join(directory, os.fsdecode(name)))
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ConfigWatcher(object):
+    """Calls callback with the watched paths whose mtime or size changed.
+
+    inotify watches the directories holding the paths rather than the
+    files, since editors often replace a file instead of writing to it.
+    Where inotify is unavailable, the paths are polled every
+    poll_seconds. Bursts of events are debounced, so saving a file
+    reports it once."""
+
+    POLL_SECONDS = 1
+    DEBOUNCE_SECONDS = 0.2
+    INOTIFY_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    signatures: Dict[str, Optional[Tuple[int, int]]]
+
+    def __init__(self, paths, callback, poll_seconds=POLL_SECONDS, use_inotify=True):
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.callback = callback
+        self.poll_seconds = poll_seconds
+        self.signatures = {path: file_signature(path) for path in self.paths}
+        self.stop_event = threading.Event()
+        # nothing is lost when the process exits mid-poll.
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.inotify = None
+        if use_inotify:
+            self.inotify = self.open_inotify()
+
+    def open_inotify(self):
+        inotify = None
+        try:
+            inotify = Inotify()
+            for directory in sorted(set(os.path.dirname(path) for path in self.paths)):
+                inotify.add_watch(directory, ConfigWatcher.INOTIFY_MASK)
+        except OSError as err:
+            print('[0] Polling configuration files, inotify is unavailable: %s' % err)
+            if inotify:
+                inotify.close()
+            return None
+        return inotify
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
+
+    def worker(self):
+        while not self.stop_event.is_set():
+            if self.inotify:
+                # wake up now and then to notice stop().
+                if not any(path in self.signatures for path in self.inotify.read(self.poll_seconds)):
+                    continue
+                while self.inotify.read(ConfigWatcher.DEBOUNCE_SECONDS):
+                    if self.stop_event.is_set():
+                        return
+            elif self.stop_event.wait(self.poll_seconds):
+                return
+            self.check()
+
+    def check(self):
+        """Report the paths changed since they were last seen. A path
+        which disappeared is not reported until it is back."""
+        changed = []
+        for path in self.paths:
+            signature = file_signature(path)
+            if signature == self.signatures[path]:
+                continue
+            self.signatures[path] = signature
+            if signature is not None:
+                changed.append(path)
+        if not changed:
+            return
+        try:
+            self.callback(changed)
+        except Exception as err:
+            print('[!] Failed to reload %s: %s' % (', '.join(changed), err))
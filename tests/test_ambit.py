@@ -3,17 +3,31 @@ import os
 os.environ['SDL_VIDEODRIVER'] = 'dummy'
 
 import ambit
+import ambit.capture
+import ambit.component
 import ambit.controller
 import ambit.coordinates
 import ambit.fake
 import ambit.image
+import ambit.metrics
+import ambit.pacing
+import ambit.profile_cache
+import ambit.record
 import ambit.resources
 import ambit.simulator
+import ambit.state
+import ambit.trace
+import ambit.watch
 
+import copy
 import glob
 import io
+import json
 import pygame
 import queue
+import shutil
+import tempfile
+import threading
 import time
 import unittest
 import unittest.mock
@@ -26,6 +40,9 @@ TEST_INPUT_SETTLED_SECONDS = 0.25
 # covered separately by test_screen_string_dropping.
 TEST_SCREEN_STRING_QUEUE_DEPTH = 256
 
+# component state from earlier runs would change what the tests observe.
+ambit.FLAGS.state_path = ''
+
 
 class AmbitIntegrationTest(unittest.TestCase):
     def setUp(self):
@@ -163,7 +180,6 @@ class AmbitIntegrationTest(unittest.TestCase):
 
         # check for error conditions
         self.assertEqual(0, ctrl.failed_writes)
-        self.assertEqual(0, ctrl.dropped_leds)
         self.assertEqual(0, ctrl.dropped_screen_strings)
 
     def test_multifunction_dial(self):
@@ -256,7 +272,6 @@ class AmbitIntegrationTest(unittest.TestCase):
 
         # check for error conditions
         self.assertEqual(0, ctrl.failed_writes)
-        self.assertEqual(0, ctrl.dropped_leds)
         self.assertEqual(0, ctrl.dropped_screen_strings)
 
     def test_behaviors(self):
@@ -440,7 +455,6 @@ class AmbitIntegrationTest(unittest.TestCase):
 
         # check for error conditions
         self.assertEqual(0, ctrl.failed_writes)
-        self.assertEqual(0, ctrl.dropped_leds)
         self.assertEqual(0, ctrl.dropped_screen_strings)
 
     def test_layout_query(self):
@@ -538,9 +552,217 @@ class AmbitIntegrationTest(unittest.TestCase):
 
         # check for error conditions
         self.assertEqual(0, ctrl.failed_writes)
-        self.assertEqual(0, ctrl.dropped_leds)
         self.assertEqual(0, ctrl.dropped_screen_strings)
 
+    def test_layout_hotplug(self):
+        # plugging in one button only configures that button: the rest of
+        # the kit keeps its bindings and nothing else is resent.
+        ambit.FLAGS.debug = False
+        ambit.FLAGS.verbose = False
+
+        device = ambit.fake.Device('DEAD:BEEF', 'XYZ')
+        device.components_connected(ambit.fake.LAYOUT_DEFAULT_PROKIT)
+        config = ambit.Configuration(ambit.resources.layout_paths('test-behaviors'))
+        ctrl = ambit.Controller(config, device)
+        self.ctrl = ctrl
+        ctrl.open()
+        ctrl.connect()
+        ctrl.wait_for_layout()
+        time.sleep(TEST_INPUT_SETTLED_SECONDS)
+
+        callbacks = dict(ctrl.layout.find_component(2).callbacks)
+        self.assertTrue(callbacks)
+        generation = ctrl.layout.generation
+        layout = copy.deepcopy(ambit.fake.LAYOUT_DEFAULT_PROKIT)
+        layout['c'][0] = {'u': '  8X!', 'i': 16, 't': 1, 'c': [None, None, None]}
+        messages = []
+        write = ctrl.bulk_write_messages
+        def record(m, futures=None):
+            messages.extend(m)
+            write(m, futures)
+        ctrl.bulk_write_messages = record
+        device.layout_changed(layout)
+        with ctrl.condition:
+            ctrl.condition.wait_for(lambda: ctrl.layout.generation > generation, 5)
+        time.sleep(TEST_INPUT_SETTLED_SECONDS)
+        ctrl.wait()
+
+        self.assertEqual(16, len(ctrl.layout.connected()))
+        self.assertEqual(callbacks, ctrl.layout.find_component(2).callbacks)
+        self.assertNotIn({'midimap': []}, messages)
+        indexes = set()
+        for message in messages:
+            for key in ('flip', 'led', 'midimap'):
+                for entry in message.get(key, ()):
+                    indexes.add(entry['i'])
+        self.assertEqual({16}, indexes)
+
+    def test_layout_detach_commands(self):
+        # detaching a component cancels and forgets its command runners
+        # in every profile.
+        ambit.FLAGS.debug = False
+        ambit.FLAGS.verbose = False
+
+        device = ambit.fake.Device('DEAD:BEEF', 'XYZ')
+        device.components_connected(ambit.fake.LAYOUT_DEFAULT_PROKIT)
+        config = ambit.Configuration(ambit.resources.layout_paths('showcase'))
+        ctrl = ambit.Controller(config, device)
+        self.ctrl = ctrl
+        ctrl.open()
+        ctrl.connect()
+        ctrl.wait_for_layout()
+
+        uid = ctrl.layout.query('[slot=(0,-1)]')[0].uid
+        self.assertIn(uid, [key[0] for key in ctrl.command_runners])
+        def detach(node):
+            node['c'] = [None if c and c['u'].strip() == uid else c for c in node['c']]
+            for c in node['c']:
+                if c:
+                    detach(c)
+        layout = copy.deepcopy(ambit.fake.LAYOUT_DEFAULT_PROKIT)
+        detach(layout)
+        generation = ctrl.layout.generation
+        device.layout_changed(layout)
+        with ctrl.condition:
+            ctrl.condition.wait_for(lambda: ctrl.layout.generation > generation, 5)
+        time.sleep(TEST_INPUT_SETTLED_SECONDS)
+
+        self.assertFalse(ctrl.layout.query(uid))
+        self.assertNotIn(uid, [key[0] for key in ctrl.command_runners])
+
+    def test_profile_switch(self):
+        # switching profiles swaps in bindings made with the layout and
+        # writes only the display and led state which differs.
+        ambit.FLAGS.debug = False
+        ambit.FLAGS.verbose = False
+
+        device = ambit.fake.Device('DEAD:BEEF', 'XYZ')
+        device.components_connected(ambit.fake.LAYOUT_DEFAULT_PROKIT)
+        config = ambit.Configuration(ambit.resources.layout_paths('showcase'))
+        ctrl = ambit.Controller(config, device)
+        self.ctrl = ctrl
+        ctrl.open()
+        ctrl.connect()
+        ctrl.wait_for_layout()
+        time.sleep(TEST_INPUT_SETTLED_SECONDS)
+        ctrl.wait()
+
+        self.assertEqual(4, len(ctrl.profile_states))
+        component = ctrl.layout.find_component(2)
+        config.profiles[1].colors = {component.uid: (255, 0, 0)}
+        ctrl.profile_states[config.profiles[1]].colors = config.profiles[1].colors
+        generation = ctrl.layout.generation
+        messages = []
+        write = ctrl.bulk_write_messages
+        def record(m, futures=None):
+            messages.extend(m)
+            write(m, futures)
+        ctrl.bulk_write_messages = record
+        ctrl.callback_profile_next(None)
+        ctrl.wait()
+
+        self.assertIs(config.profiles[1], config.profile)
+        self.assertEqual(generation, ctrl.layout.generation)
+        self.assertEqual(1, ctrl.profile_switches)
+        state = ctrl.profile_states[config.profile]
+        self.assertIs(state.callbacks[component.uid], component.callbacks)
+        self.assertIs(config.profile, ctrl.bound_profile)
+        self.assertNotIn({'start': 1}, messages)
+        self.assertNotIn('screen_orientation', [k for m in messages for k in m])
+        self.assertIn({'screen_string': config.profile.title}, messages)
+        leds = [entry for m in messages for entry in m.get('led', ())]
+        self.assertEqual([component.index], [entry['i'] for entry in leds])
+        self.assertEqual((255, 0, 0), (leds[0]['r'], leds[0]['g'], leds[0]['b']))
+
+        # switching back restores the first profile's bindings.
+        ctrl.callback_profile_prev(None)
+        ctrl.wait()
+        self.assertIs(config.profiles[0], ctrl.bound_profile)
+        self.assertIs(ctrl.profile_states[config.profiles[0]].callbacks[component.uid], component.callbacks)
+
+    def test_config_reload(self):
+        # editing a loaded profile rebinds only the component whose actions
+        # changed, without a layout round trip or losing component state.
+        ambit.FLAGS.debug = False
+        ambit.FLAGS.verbose = False
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'test.plp')
+            with open(ambit.resources.layout_paths('test-behaviors')[0], 'rb') as f:
+                data = f.read()
+            with open(path, 'wb') as f:
+                f.write(data)
+
+            device = ambit.fake.Device('DEAD:BEEF', 'XYZ')
+            device.components_connected(ambit.fake.LAYOUT_DEFAULT_PROKIT)
+            config = ambit.Configuration([path])
+            ctrl = ambit.Controller(config, device)
+            self.ctrl = ctrl
+            ctrl.open()
+            ctrl.connect()
+            ctrl.wait_for_layout()
+            time.sleep(TEST_INPUT_SETTLED_SECONDS)
+
+            changed = ctrl.layout.query('[slot=(-1,1)]')[0]
+            callbacks = {c.uid: c.callbacks for c in ctrl.layout.connected()}
+            states = {c.uid: c.persistent_state for c in ctrl.layout.connected()}
+            generation = ctrl.layout.generation
+            with open(path, 'wb') as f:
+                f.write(data.replace(b'"value": 50', b'"value": 75'))
+            deadline = time.time() + 5
+            while not ctrl.config_reloads and time.time() < deadline:
+                time.sleep(0.05)
+
+            self.assertEqual(1, ctrl.config_reloads)
+            self.assertEqual(generation, ctrl.layout.generation)
+            for component in ctrl.layout.connected():
+                self.assertIs(states[component.uid], component.persistent_state)
+                if component is changed:
+                    self.assertIsNot(callbacks[component.uid], component.callbacks)
+                else:
+                    self.assertIs(callbacks[component.uid], component.callbacks)
+            invocation = changed.callbacks[ambit.Configuration.INPUT_RELEASED]
+            self.assertEqual(75, invocation.action_config['value'])
+            # only the behaviors still bound stay interned.
+            bound = set(id(invocation.behavior) for state in ctrl.profile_states.values()
+                        for callbacks in state.callbacks.values() for invocation in callbacks.values())
+            self.assertEqual(bound, set(id(behavior) for behavior in ctrl.behaviors.values()))
+
+    def test_state_restored(self):
+        # component state written when one controller shuts down is
+        # restored into the bindings of the next, but not into those of
+        # another file with a profile of the same title.
+        ambit.FLAGS.debug = False
+        ambit.FLAGS.verbose = False
+
+        with tempfile.TemporaryDirectory() as directory:
+            ambit.FLAGS.state_path = os.path.join(directory, 'state.json')
+            paths = ambit.resources.layout_paths('test-behaviors')
+            other_path = os.path.join(directory, 'test.plp')
+            shutil.copy(paths[0], other_path)
+            try:
+                values = []
+                for paths, value in ((paths, 42), (paths, None), ([other_path], None)):
+                    device = ambit.fake.Device('DEAD:BEEF', 'XYZ')
+                    device.components_connected(ambit.fake.LAYOUT_DEFAULT_PROKIT)
+                    config = ambit.Configuration(paths)
+                    ctrl = ambit.Controller(config, device)
+                    self.ctrl = ctrl
+                    ctrl.open()
+                    ctrl.connect()
+                    ctrl.wait_for_layout()
+                    component = ctrl.layout.query('[slot=(0,-2)]')[0]
+                    invocation = component.callbacks[ambit.Configuration.INPUT_ROTATION_RIGHT]
+                    self.assertIs(ctrl.state_store.state(component.uid, config.profile.path),
+                                  invocation.persistent_state)
+                    values.append(invocation.persistent_state['stored_value'])
+                    if value is not None:
+                        invocation.persistent_state['stored_value'] = value
+                    ctrl.join()
+                self.assertEqual([0, 42, 0], values)
+            finally:
+                ambit.FLAGS.state_path = ''
+
     # TODO: replace test_slider_range_{broken,fixed} with a parameterized
     # test suite which exercises the entire suite for both versions.
     def test_slider_range_broken(self):
@@ -570,7 +792,7 @@ class AmbitIntegrationTest(unittest.TestCase):
 
         time.sleep(TEST_INPUT_SETTLED_SECONDS)
 
-        self.assertEqual([255,0,0,0,0,0,0,0], ctrl.layout.find_component(7).values)
+        self.assertEqual([255,0,0,0,0,0,0,0], list(ctrl.layout.find_component(7).values))
 
     def test_slider_range_fixed(self):
         ambit.FLAGS.debug = True
@@ -599,13 +821,13 @@ class AmbitIntegrationTest(unittest.TestCase):
 
         time.sleep(TEST_INPUT_SETTLED_SECONDS)
 
-        self.assertEqual([254,0,0,0,0,0,0,0], ctrl.layout.find_component(7).values)
+        self.assertEqual([254,0,0,0,0,0,0,0], list(ctrl.layout.find_component(7).values))
 
         device.input_slide_up(7, 1)
 
         time.sleep(TEST_INPUT_SETTLED_SECONDS)
 
-        self.assertEqual([255,0,0,0,0,0,0,0], ctrl.layout.find_component(7).values)
+        self.assertEqual([255,0,0,0,0,0,0,0], list(ctrl.layout.find_component(7).values))
 
     def test_default_input(self):
         ambit.FLAGS.debug = True
@@ -676,8 +898,8 @@ class AmbitIntegrationTest(unittest.TestCase):
         device.input_slide_up(7, 4)
         time.sleep(TEST_INPUT_SETTLED_SECONDS * 8)
         self.assertEqual("Slider: 4", device.handle.screen_string)
-        self.assertEqual([0,0,0,3,0,0,0,0], ctrl.layout.find_component(5).values)
-        self.assertEqual([4,0,0,0,0,0,0,0], ctrl.layout.find_component(7).values)
+        self.assertEqual([0,0,0,3,0,0,0,0], list(ctrl.layout.find_component(5).values))
+        self.assertEqual([4,0,0,0,0,0,0,0], list(ctrl.layout.find_component(7).values))
 
         # screen reset timeout reached
         time.sleep(ambit.controller.Controller.SCREEN_RESET_SECONDS + 1)
@@ -689,7 +911,6 @@ class AmbitIntegrationTest(unittest.TestCase):
 
         # check for error conditions
         self.assertEqual(0, ctrl.failed_writes)
-        self.assertEqual(0, ctrl.dropped_leds)
         self.assertEqual(0, ctrl.dropped_screen_strings)
 
     def test_screen_string_dropping(self):
@@ -702,13 +923,190 @@ class AmbitIntegrationTest(unittest.TestCase):
 
         depth = ambit.controller.Controller.SCREEN_STRING_QUEUE_DEPTH
         for i in range(depth):
-            ctrl.screen_string_queue.put('s%d' % i)
+            ctrl.screen_string_queue.put(('s%d' % i, None))
 
         ctrl.drop_stale_screen_strings()
 
         self.assertEqual(2, ctrl.screen_string_queue.qsize())
         self.assertEqual(depth - 2, ctrl.dropped_screen_strings)
 
+    def test_write_coalescing(self):
+        # pending writes are packed into as few transfers as fit the
+        # endpoint, and a write which does not fit is carried over.
+        device = ambit.fake.Device('DEAD:BEEF', 'XYZ')
+        config = ambit.Configuration()
+        ctrl = ambit.Controller(config, device)
+        ctrl.open()
+
+        limit = device.handle.max_packet_size * ambit.Controller.BULK_WRITE_MAX_PACKETS
+        first = (memoryview(b'x' * 100), None, False)
+        for _ in range(3):
+            ctrl.write_queue.put((memoryview(b'y' * 100), None, False))
+        ctrl.write_queue.put((memoryview(b'z' * limit), None, False))
+
+        writes, carry = ctrl.coalesce_writes(first)
+        self.assertEqual(4, len(writes))
+        self.assertEqual(b'z' * limit, carry[0].tobytes())
+        self.assertEqual(0, ctrl.write_queue.qsize())
+
+        writes, carry = ctrl.coalesce_writes(carry)
+        self.assertEqual(1, len(writes))
+        self.assertIsNone(carry)
+
+        # a write with a binary tail is never merged, however small.
+        ctrl.bulk_write_messages([{'check': 1}])
+        ctrl.bulk_write_messages([{'screen_write': 23}], tail=b'image')
+        ctrl.bulk_write_messages([{'check': 1}])
+        writes, carry = ctrl.coalesce_writes(ctrl.write_queue.get())
+        self.assertEqual(1, len(writes))
+        writes, carry = ctrl.coalesce_writes(carry)
+        self.assertEqual([True], [tail for _, _, tail in writes])
+        self.assertIsNone(carry)
+        self.assertEqual(1, ctrl.write_queue.qsize())
+
+    def test_led_framebuffer(self):
+        # only the latest color per component is flushed, and a component
+        # whose color has not changed since the last flush is not resent.
+        device = ambit.fake.Device('DEAD:BEEF', 'XYZ')
+        config = ambit.Configuration()
+        ctrl = ambit.Controller(config, device)
+
+        ctrl.led([{'i': 1, 'r': 255, 'g': 0, 'b': 0, 'm': 0}])
+        ctrl.led([{'i': 1, 'r': 0, 'g': 255, 'b': 0, 'm': 0}])
+        ctrl.led([{'i': 2, 'r': 0, 'g': 0, 'b': 255, 'm': 0}])
+        ctrl.flush_leds()
+        self.assertEqual(1, ctrl.coalesced_leds)
+        self.assertEqual(1, ctrl.write_queue.qsize())
+        data, _, _ = ctrl.write_queue.get()
+        messages, _ = ambit.message_decode(data, ctrl.message_format)
+        self.assertEqual([{'led': [
+            {'b': 0, 'g': 255, 'i': 1, 'm': 0, 'r': 0},
+            {'b': 255, 'g': 0, 'i': 2, 'm': 0, 'r': 0},
+        ]}], messages)
+
+        ctrl.led([{'i': 1, 'r': 0, 'g': 255, 'b': 0, 'm': 0}])
+        ctrl.flush_leds()
+        self.assertEqual(0, ctrl.write_queue.qsize())
+        self.assertFalse(ctrl.led_pending())
+
+    def test_write_futures(self):
+        # a write future fails with a reason when its update is overwritten
+        # or deduplicated, and otherwise resolves once the bytes are written.
+        ambit.FLAGS.debug = False
+        ambit.FLAGS.verbose = False
+
+        device = ambit.fake.Device('DEAD:BEEF', 'XYZ')
+        device.components_connected(ambit.fake.LAYOUT_DEFAULT_EXPERTKIT)
+        config = ambit.Configuration()
+        ctrl = ambit.Controller(config, device)
+        self.ctrl = ctrl
+        ctrl.open()
+        ctrl.connect()
+        ctrl.wait_for_layout()
+
+        red = ctrl.led([{'i': 2, 'r': 255, 'g': 0, 'b': 0, 'm': 0}], future=True)
+        green = ctrl.led([{'i': 2, 'r': 0, 'g': 255, 'b': 0, 'm': 0}], wait=True)
+        self.assertEqual(ambit.WriteError.COALESCED, red.exception().reason)
+        self.assertIsNone(green.exception())
+        self.assertEqual((0, 255, 0), device.handle.leds[2])
+
+        title = ctrl.screen_string('FUTURE', wait=True)
+        self.assertIsNone(title.exception())
+        self.assertEqual('FUTURE', device.handle.screen_string)
+        repeat = ctrl.screen_string('FUTURE', future=True)
+        self.assertEqual(ambit.WriteError.COALESCED, repeat.exception().reason)
+
+        self.assertIsNone(ctrl.screen_display(0, wait=True).exception())
+
+    def test_wait_returns_on_completion(self):
+        # wait() is notified when the last write completes rather than
+        # polling, so it returns well within one polling interval.
+        ambit.FLAGS.debug = False
+        ambit.FLAGS.verbose = False
+
+        device = ambit.fake.Device('DEAD:BEEF', 'XYZ')
+        device.components_connected(ambit.fake.LAYOUT_DEFAULT_EXPERTKIT)
+        config = ambit.Configuration()
+        ctrl = ambit.Controller(config, device)
+        self.ctrl = ctrl
+        ctrl.open()
+        ctrl.connect()
+        ctrl.wait_for_layout()
+        self.assertTrue(ctrl.idle())
+
+        ctrl.screen_string('WAIT')
+        start = time.time()
+        ctrl.wait()
+        self.assertLess(time.time() - start, ambit.Controller.DEFAULT_WAIT_SECONDS)
+        self.assertEqual('WAIT', device.handle.screen_string)
+
+    def test_input_tracing(self):
+        # an input carries its trace from the read through to the write of
+        # the screen string it caused.
+        ambit.FLAGS.debug = False
+        ambit.FLAGS.verbose = True
+
+        device = ambit.fake.Device('DEAD:BEEF', 'XYZ')
+        device.components_connected(ambit.fake.LAYOUT_DEFAULT_EXPERTKIT)
+        config = ambit.Configuration()
+        ctrl = ambit.Controller(config, device)
+        self.ctrl = ctrl
+        ctrl.open()
+        ctrl.connect()
+        ctrl.wait_for_layout()
+
+        # nothing is recorded, or even formatted, without a context.
+        self.assertIs(ambit.trace.NO_SPAN, ambit.trace.span('untraced'))
+
+        ctrl.tracer.enabled = True
+        device.input_pressed(5)
+        time.sleep(TEST_INPUT_SETTLED_SECONDS)
+        ctrl.wait()
+
+        events = ctrl.tracer.chrome_trace()['traceEvents']
+        spans = [e for e in events if e['ph'] == 'X' and 'trace_id' in e['args']]
+        names = [e['name'] for e in spans]
+        self.assertIn('process_input', names)
+        self.assertIn('input to screen_string', names)
+        written = [e for e in spans if e['name'] == 'input to screen_string'][0]
+        self.assertEqual('written', written['args']['result'])
+        read = [e for e in spans if e['name'] == 'process_input'][0]
+        self.assertEqual(read['args']['trace_id'], written['args']['trace_id'])
+        self.assertLessEqual(written['ts'], read['ts'])
+
+    def test_record_and_replay(self):
+        # a recorded session replays into a fresh controller, which sees the
+        # same layout and inputs and shuts down at the end of the recording.
+        ambit.FLAGS.debug = False
+        ambit.FLAGS.verbose = False
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'session.rec')
+            device = ambit.fake.Device('DEAD:BEEF', 'XYZ')
+            device.components_connected(ambit.fake.LAYOUT_DEFAULT_EXPERTKIT)
+            ctrl = ambit.Controller(ambit.Configuration(), device)
+            ambit.FLAGS.record_usb = path
+            try:
+                ctrl.open()
+            finally:
+                ambit.FLAGS.record_usb = ''
+            ctrl.connect()
+            ctrl.wait_for_layout()
+            device.input_slide_up(7, 4)
+            time.sleep(TEST_INPUT_SETTLED_SECONDS)
+            ctrl.close()
+
+            replay = ambit.record.ReplayDevice(path, speed=0)
+            self.assertTrue(replay.legacy())
+            ctrl = ambit.Controller(ambit.Configuration(), replay)
+            ctrl.open()
+            ctrl.connect()
+            self.assertTrue(ctrl.shutdown_event.wait(5))
+            self.assertEqual(8, len(ctrl.layout.connected()))
+            self.assertEqual([4,0,0,0,0,0,0,0], list(ctrl.layout.find_component(7).values))
+            self.assertGreater(replay.handle.reads, 0)
+            ctrl.close()
+
     def test_dial_rotation_displays_set_value_only(self):
         # a dial rotation raises both a relative-movement event and a 'set'
         # event carrying the accumulated value; verbose mode should display
@@ -739,6 +1137,135 @@ class AmbitIntegrationTest(unittest.TestCase):
             device.handle.messages['screen_string'][before:])
 
 
+class AmbitComponentTest(unittest.TestCase):
+    def test_input_dispatch(self):
+        # a dial rotation with a changed set value raises set and rotation
+        # in dispatch order, but only bound input types are dispatched.
+        ambit.FLAGS.verbose = False
+        dial = ambit.component.Component(2, 'C4@', ambit.component.Component.KIND_DIAL)
+        dial.previous_values = [0, 0, 0, 10, 0, 0, 0, 0]
+        dial.values = [0, 0, 2, 12, 0, 0, 0, 0]
+        self.assertEqual([
+            ambit.Configuration.INPUT_SET,
+            ambit.Configuration.INPUT_ROTATION_RIGHT,
+        ], dial.determine_input_types())
+        self.assertEqual((), dial.dispatch_inputs())
+
+        behavior = ambit.component.ComponentBehavior(ambit.component.ComponentBehavior.DELTA)
+        behavior.finalize()
+        dial.set_callback(ambit.Configuration.INPUT_ROTATION_RIGHT, 'test', behavior, print, {})
+        self.assertEqual(((ambit.Configuration.INPUT_ROTATION_RIGHT, 2),), dial.dispatch_inputs())
+        other = ambit.component.Component(3, 'D5o', ambit.component.Component.KIND_DIAL)
+        other.set_callback(ambit.Configuration.INPUT_ROTATION_RIGHT, 'test', behavior, print, {})
+        other.dispatch_inputs()
+        self.assertIs(dial.dispatch, other.dispatch)
+
+    def test_update_values(self):
+        # the decoded values become current and the current ones previous.
+        slider = ambit.component.Component(9, '8W(', ambit.component.Component.KIND_SLIDER)
+        values = [10, 1, 2, 3, 4, 5, 6, 7]
+        slider.update_values(values)
+        slider.update_values([20, 1])
+        self.assertEqual([20, 1], slider.values)
+        self.assertIs(values, slider.previous_values)
+        with self.assertRaises(AttributeError):
+            slider.unknown = True
+
+
+    def test_behavior_interning(self):
+        # equal bindings share one frozen behavior, whatever the key order
+        # of their action configs; profile items are part of the identity.
+        device = ambit.fake.Device('DEAD:BEEF', 'XYZ')
+        ctrl = ambit.Controller(ambit.Configuration(), device)
+        kind = ambit.component.Component.KIND_DIAL
+        a = ctrl.make_action_behavior({'limits': [0, 9], 'threshold': 2},
+                kind, ambit.Configuration.INPUT_ROTATION_LEFT, ambit.Configuration.ACTION_TEST_ACCUMULATE)
+        b = ctrl.make_action_behavior({'threshold': 2, 'limits': [0, 9]},
+                kind, ambit.Configuration.INPUT_ROTATION_LEFT, ambit.Configuration.ACTION_TEST_ACCUMULATE)
+        self.assertIs(a, b)
+        self.assertEqual(((0, 9), 2, True), (a.limits, a.threshold, a.invert))
+        with self.assertRaises(AttributeError):
+            a.threshold = 3
+        with self.assertRaises(TypeError):
+            a.action_config['threshold'] = 3
+        c = ctrl.make_action_behavior({}, kind, ambit.Configuration.INPUT_PRESSED,
+                ambit.Configuration.ACTION_PROFILE_SWITCH, ['one', 'two', 'three'])
+        self.assertEqual((0, 2), c.limits)
+        self.assertIsNot(c, ctrl.make_action_behavior({}, kind, ambit.Configuration.INPUT_PRESSED,
+                ambit.Configuration.ACTION_PROFILE_SWITCH, ['one', 'two']))
+
+
+    def test_compiled_callback_value(self):
+        # the function compiled for a binding agrees with the reference
+        # callback_value for every behavior, input type and value.
+        device = ambit.fake.Device('DEAD:BEEF', 'XYZ')
+        ctrl = ambit.Controller(ambit.Configuration(), device)
+        configs = [{}, {'invert': True}, {'loop': True, 'limits': [0, 9]},
+                   {'value': 3}, {'discrete': False}, {'items': ['a', 'b', 'c']}]
+        actions = [
+            ambit.Configuration.ACTION_TEST_TRIGGER,
+            ambit.Configuration.ACTION_TEST_CYCLE,
+            ambit.Configuration.ACTION_TEST_DELTA,
+            ambit.Configuration.ACTION_TEST_ACCUMULATE,
+            ambit.Configuration.ACTION_SET_COLOR_RED,
+        ]
+        for kind in (ambit.component.Component.KIND_DIAL, ambit.component.Component.KIND_SLIDER):
+            for input_type in ambit.component.INPUT_TYPE_DISPATCH_ORDER:
+                for action_name in actions:
+                    for config in configs:
+                        behavior = ctrl.make_action_behavior(config, kind, input_type, action_name)
+                        invocation = ambit.component.ComponentInvocation(
+                                input_type, action_name, behavior, None, 0, config, {})
+                        if invocation.value_function == invocation.callback_value:
+                            # not compiled: a loop without limits.
+                            self.assertTrue(behavior.loop and not behavior.limits)
+                            continue
+                        for stored, change, value in ((0, 0, 0), (2, 5, 128), (9, -3, 255), (-4, 1, 17)):
+                            invocation.persistent_state['stored_value'] = stored
+                            invocation.cumulative_change = change
+                            self.assertEqual(
+                                    invocation.callback_value(value),
+                                    invocation.value_function(value),
+                                    (kind, input_type, action_name, config, stored, change, value))
+
+
+    def test_layout_diff(self):
+        # an update reports the components added, removed, moved (new
+        # index or slot) and reoriented by the new layout.
+        layout = ambit.ComponentLayout(ambit.fake.LAYOUT_DEFAULT_PROKIT)
+        moved = copy.deepcopy(ambit.fake.LAYOUT_DEFAULT_PROKIT)
+        moved['c'][0], moved['c'][1] = moved['c'][1], None
+        moved['c'][0]['c'][0]['c'][0] = None
+        diff = layout.update(moved)
+        self.assertEqual([], diff.added)
+        self.assertEqual(['8S$', 'B$;'], sorted(c.uid for c in diff.removed))
+        self.assertIn('C4@', [c.uid for c in diff.moved])
+        self.assertIn('C4@', [c.uid for c in diff.reoriented])
+        self.assertFalse(layout.update(moved))
+        diff = layout.update(ambit.fake.LAYOUT_DEFAULT_PROKIT)
+        self.assertEqual(['8S$', 'B$;'], sorted(c.uid for c in diff.added))
+
+    def test_query_cache(self):
+        # queries are compiled once and their results memoized until the
+        # layout changes; an update re-indexes the connected components.
+        layout = ambit.ComponentLayout(ambit.fake.LAYOUT_DEFAULT_PROKIT)
+        compiled = ambit.component.compile_query('[kind=Dial orientation=0]')
+        self.assertIs(compiled, ambit.component.compile_query('[kind=Dial orientation=0]'))
+        self.assertEqual('components_by_kind', compiled.index_name)
+        self.assertEqual((('orientation', 0),), compiled.predicates)
+        dials = layout.query('[kind=Dial orientation=0]')
+        self.assertEqual(['C4@', '6pZ'], [c.uid for c in dials])
+        self.assertEqual(dials, layout.search(kind=ambit.Component.KIND_DIAL, orientation=0))
+        generation = layout.generation
+        self.assertEqual(dials, layout.query('[kind=Dial orientation=0]'))
+        self.assertEqual(generation, layout.query_cache_generation)
+
+        layout.update(ambit.fake.LAYOUT_BASE_ONLY)
+        self.assertEqual(generation + 1, layout.generation)
+        self.assertEqual([], layout.query('[kind=Dial orientation=0]'))
+        self.assertEqual(['00000'], [c.uid for c in layout.connected()])
+
+
 class AmbitCoordinatesTest(unittest.TestCase):
     def test_narrow_male_port_slot_0deg(self):
         component_orientation = 0
@@ -888,6 +1415,427 @@ class AmbitMessageTest(unittest.TestCase):
         ], messages) 
         self.assertEqual(b'EXTRA_DATA', extra_data)
 
+    def test_json_decoder_streaming(self):
+        # braces inside strings, newline separators and a multi-byte utf-8
+        # character split across reads.
+        data = ('{"screen_string":"}{"}\n{"in":[{"i":2,"v":[1,0,0,0]}]}'
+                '{"screen_string":"café"}').encode()
+        decoder = ambit.message.message_decoder(ambit.message.MESSAGE_FORMAT_JSON)
+        decoded = []
+        for i in range(0, len(data), 7):
+            decoded.extend(decoder.feed(data[i:i + 7]))
+        self.assertEqual([
+            {'screen_string': '}{'},
+            {'in': [{'i': 2, 'v': [1, 0, 0, 0]}]},
+            {'screen_string': 'café'},
+        ], decoded)
+        self.assertFalse(decoder.pending())
+
+    def test_json_decoder_malformed_object(self):
+        # a corrupt object costs only itself, not the rest of the read.
+        data = b'{"check":1}{"in":[1,,2]}{"version_core":"1.3.1"}'
+        decoder = ambit.message.message_decoder(ambit.message.MESSAGE_FORMAT_JSON)
+        self.assertEqual([
+            {'check': 1},
+            {'version_core': '1.3.1'},
+        ], decoder.feed(data))
+        self.assertEqual(1, decoder.decode_failures)
+
+    def test_json_decoder_screen_write(self):
+        # only a screen_write starting the transfer is followed by a tail.
+        decoder = ambit.message.message_decoder(ambit.message.MESSAGE_FORMAT_JSON)
+        self.assertEqual([{'screen_write': 3}], decoder.feed(b'{"screen_write":3}{"a":1}'))
+        self.assertEqual(b'{"a":1}', decoder.extra_data)
+        self.assertEqual([{'check': 1}, {'screen_write': 3}, {'a': 1}],
+                         decoder.feed(b'{"check":1}{"screen_write":3}{"a":1}'))
+        self.assertEqual(b'', decoder.extra_data)
+
+    def test_json_decoder_large_object(self):
+        # an object arriving over many reads is only parsed once complete.
+        data = json.dumps({'screen_string': '{"}' * 5000}).encode() + b'\n{"check":1}'
+        decoder = ambit.message.message_decoder(ambit.message.MESSAGE_FORMAT_JSON)
+        decoded = []
+        for i in range(0, len(data), 64):
+            decoded.extend(decoder.feed(memoryview(data)[i:i + 64]))
+        self.assertEqual([{'screen_string': '{"}' * 5000}, {'check': 1}], decoded)
+        self.assertFalse(decoder.pending())
+        self.assertEqual(0, decoder.decode_failures)
+
+    def test_msgpack_decoder_streaming(self):
+        # 126 encodes as the frame delimiter byte (0x7E) in msgpack, so
+        # this payload would break a decoder which splits on b'~'.
+        messages = [
+            {'in': [{'i': 126, 'v': [126, 0, 0, 0, 0, 0, 0, 0]}]},
+            {'version_core': '1.4.6136'},
+        ]
+        data = ambit.message.message_encode(
+                messages, ambit.message.MESSAGE_FORMAT_MSGPACK).tobytes()
+
+        # feed one byte per read, the worst case for a partial frame.
+        decoder = ambit.message.message_decoder(ambit.message.MESSAGE_FORMAT_MSGPACK)
+        decoded = []
+        for i in range(len(data)):
+            decoded.extend(decoder.feed(data[i:i + 1]))
+        self.assertEqual(messages, decoded)
+        self.assertFalse(decoder.pending())
+        self.assertEqual(0, decoder.decode_failures)
+
+    def test_msgpack_decoder_partial_frame(self):
+        data = ambit.message.message_encode(
+                [{'check': 1}, {'l': {'u': '~~~'}}],
+                ambit.message.MESSAGE_FORMAT_MSGPACK).tobytes()
+        messages, extra_data = ambit.message.message_decode(
+                memoryview(data[:-3]), ambit.message.MESSAGE_FORMAT_MSGPACK)
+        self.assertEqual([{'check': 1}], messages)
+        self.assertEqual(data[data.index(b'~~') + 1:-3], extra_data)
+
+
+class AmbitExecutorTest(unittest.TestCase):
+    def test_dispatch_policies(self):
+        # calls on one lane run in order; a pending 'latest' call is replaced
+        # by the newer one and a busy 'drop' binding discards the new call.
+        done = threading.Event()
+        executor = ambit.CallbackExecutor(
+                2, done_callback=lambda: executor.idle() and done.set())
+        calls = []
+        executor.submit('a', 'x', ambit.CallbackExecutor.QUEUE, calls.append, 1)
+        executor.submit('a', 'x', ambit.CallbackExecutor.QUEUE, calls.append, 2)
+        executor.submit('a', 'y', ambit.CallbackExecutor.LATEST, calls.append, 3)
+        executor.submit('a', 'y', ambit.CallbackExecutor.LATEST, calls.append, 4)
+        executor.submit('a', 'z', ambit.CallbackExecutor.DROP, calls.append, 5)
+        executor.submit('a', 'z', ambit.CallbackExecutor.DROP, calls.append, 6)
+        executor.submit('a', 'i', ambit.CallbackExecutor.INLINE, calls.append, 0)
+        self.assertEqual([0], calls)
+
+        executor.start()
+        self.assertTrue(done.wait(5))
+        executor.join()
+        self.assertEqual([0, 1, 2, 4, 5], calls)
+        self.assertEqual(1, executor.coalesced)
+        self.assertEqual(1, executor.dropped)
+
+
+    def test_registered_dispatch(self):
+        # a custom action registered with a dispatch policy runs on the
+        # executor unless its actionMap entry overrides the policy.
+        ctrl = ambit.Controller(ambit.Configuration(), ambit.fake.Device('DEAD:BEEF', 'XYZ'))
+        ctrl.layout.update(ambit.fake.LAYOUT_DEFAULT_PROKIT)
+        dial = ctrl.layout.query('[kind=Dial]')[0]
+        calls = []
+        ctrl.register_action_callback('slowAction', calls.append, ambit.CallbackExecutor.LATEST)
+        submitted = []
+        ctrl.callback_executor.submit = lambda *args: submitted.append(args[2])
+        for config in ({}, {'dispatch': 'inline'}):
+            callback = ctrl.dispatch_callback(dial, ambit.Configuration.INPUT_PRESSED, 'slowAction', config, calls.append)
+            callback(1)
+        self.assertEqual([ambit.CallbackExecutor.LATEST], submitted)
+        self.assertEqual([1], calls)
+
+
+class AmbitPacingTest(unittest.TestCase):
+    def test_pacer_aimd(self):
+        # timely updates raise the rate additively up to the max, a slow
+        # one halves it once per round, and each key learns its own rate.
+        pacer = ambit.pacing.Pacer(10, 2, 12)
+        pacer.select('a')
+        for _ in range(5):
+            pacer.observe(0, 0.01)
+        self.assertEqual(12, pacer.rate)
+        sent = time.monotonic()
+        pacer.observe(sent, sent + 1)
+        self.assertEqual(6, pacer.rate)
+        pacer.observe(sent, sent + 1)
+        self.assertEqual(6, pacer.rate)
+        pacer.observe(time.monotonic(), 0, failed=True)
+        self.assertEqual(3, pacer.rate)
+        pacer.select('b')
+        self.assertEqual(10, pacer.rate)
+        pacer.select('a')
+        self.assertEqual(3, pacer.rate)
+        self.assertEqual(2, pacer.decreases)
+
+    def test_controller_pacing(self):
+        # a failed led write backs the led pacer off, and a firmware
+        # version is paced separately from the one detected before it.
+        device = ambit.fake.Device('DEAD:BEEF', 'XYZ')
+        config = ambit.Configuration()
+        ctrl = ambit.Controller(config, device)
+        rate = ctrl.led_pacer.rate
+        self.assertEqual(60, round(rate))
+        ctrl.led([{'i': 1, 'r': 255, 'g': 0, 'b': 0, 'm': 0}])
+        ctrl.flush_leds()
+        _, futures, _ = ctrl.write_queue.get()
+        ambit.controller.resolve_writes(futures, ambit.controller.WriteError.USB_ERROR)
+        self.assertEqual(rate / 2, ctrl.led_pacer.rate)
+        self.assertIn('ambit_pacer_rate{worker="led"} 30', ctrl.metrics.prometheus_text())
+        ctrl.process_version_core('0.9.0')
+        self.assertEqual(rate, ctrl.led_pacer.rate)
+
+    def test_screen_string_cost(self):
+        # short strings are only limited by the pacer, longer ones wait
+        # the long interval plus a configurable cost per extra byte.
+        cost = ambit.pacing.ScreenStringCost.parse(
+                'per_byte_seconds=0.01, short_seconds=0.001', long_seconds=0.05)
+        self.assertEqual(0.001, cost.interval(3))
+        self.assertAlmostEqual(0.05, cost.interval(4) - 0.01)
+        self.assertAlmostEqual(0.13, cost.interval(11))
+        with self.assertRaises(ValueError):
+            ambit.pacing.ScreenStringCost.parse('bytes=3')
+
+        device = ambit.fake.Device('DEAD:BEEF', 'XYZ')
+        config = ambit.Configuration()
+        ctrl = ambit.Controller(config, device)
+        ctrl.screen_string_pacer.state.rate = 60
+        self.assertEqual(1 / 60, ctrl.screen_string_delay('255'))
+        self.assertEqual(1 / 20, ctrl.screen_string_delay('Slider: 255'))
+
+
+class AmbitProfileCacheTest(unittest.TestCase):
+    def test_profile_cache(self):
+        # a profile is compiled once, reused while its file is unchanged,
+        # rehashed but not recompiled when only touched, and compiled
+        # again when its content changes.
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'hack.plp')
+            with open(ambit.resources.layout_paths('showcase')[1], 'rb') as f:
+                data = f.read()
+            with open(path, 'wb') as f:
+                f.write(data)
+            cache_path = os.path.join(directory, 'cache', 'profiles.cache')
+            compiled = []
+            def compile_file(path, data):
+                compiled.append(path)
+                return ambit.Configuration.compile_file(path, data)
+
+            cache = ambit.profile_cache.ProfileCache(cache_path)
+            table = cache.profile_table(path, compile_file)
+            cache.save()
+            self.assertEqual(1, len(compiled))
+
+            cache = ambit.profile_cache.ProfileCache(cache_path)
+            profile = ambit.Configuration.load_profile(cache.profile_table(path, compile_file))
+            self.assertEqual(ambit.Configuration.load_profile(table).bindings, profile.bindings)
+            self.assertFalse(cache.dirty)
+            os.utime(path, ns=(0, 0))
+            cache.profile_table(path, compile_file)
+            self.assertEqual(1, len(compiled))
+            self.assertEqual((2, 0), (cache.hits, cache.misses))
+            self.assertTrue(cache.dirty)
+            cache.save()
+
+            with open(path, 'wb') as f:
+                f.write(data.replace(b'"HACK"', b'"HACKED"'))
+            config = ambit.Configuration([path], cache_path=cache_path)
+            self.assertEqual('HACKED', config.profile.title)
+            with open(cache_path, 'wb') as f:
+                f.write(b'not a cache')
+            cached = ambit.Configuration([path], cache_path=cache_path).profile
+            uncached = ambit.Configuration([path]).profile
+            self.assertEqual(uncached.bindings, cached.bindings)
+            self.assertEqual(uncached.hidkeys, cached.hidkeys)
+            self.assertTrue(cached.bindings)
+
+    def test_profile_cache_copies(self):
+        # files with the same content share a cached table, but changing
+        # one profile must not change the other.
+        with tempfile.TemporaryDirectory() as directory:
+            paths = []
+            for name in ('a.plp', 'b.plp'):
+                paths.append(os.path.join(directory, name))
+                shutil.copy(ambit.resources.layout_paths('showcase')[0], paths[-1])
+            cache_path = os.path.join(directory, 'profiles.cache')
+            for _ in range(2):
+                config = ambit.Configuration(paths, cache_path=cache_path)
+                p0, p1 = config.profiles
+                self.assertIsNot(p0.action_map, p1.action_map)
+                self.assertIsNot(p0.layout, p1.layout)
+                config.set_component_actions('X', {})
+                self.assertIn('X', p0.action_map)
+                self.assertNotIn('X', p1.action_map)
+
+
+class AmbitStateTest(unittest.TestCase):
+    def test_state_store(self):
+        # state is written once it settles or has been pending too long,
+        # atomically, and read back lazily per uid and profile.
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'state', 'state.json')
+            store = ambit.state.StateStore(path, debounce=1, max_delay=5)
+            state = store.state('8X!', 'MUSIC')
+            self.assertIs(state, store.state('8X!', 'MUSIC'))
+            self.assertIsNot(state, store.state('8X!', 'META'))
+            state['stored_value'] = 10
+            store.tick(now=100)
+            store.tick(now=100.5)
+            self.assertFalse(os.path.exists(path))
+            store.tick(now=101)
+            self.assertEqual(1, store.writes)
+
+            # a value changing constantly is still written every max_delay.
+            for n in range(12):
+                state['stored_value'] = n
+                store.tick(now=102 + n / 2)
+            self.assertEqual(2, store.writes)
+            state['stored_value'] = 20
+            store.stop()
+            self.assertEqual(3, store.writes)
+            self.assertEqual([], [f for f in os.listdir(os.path.dirname(path)) if f != 'state.json'])
+
+            store = ambit.state.StateStore(path)
+            self.assertFalse(store.loaded)
+            self.assertEqual({'stored_value': 20}, store.state('8X!', 'MUSIC'))
+            self.assertEqual({}, store.state('8X!', 'HOME'))
+            store.flush()
+            self.assertEqual(0, store.writes)
+
+
+class AmbitWatchTest(unittest.TestCase):
+    def test_config_watcher(self):
+        # a changed file is reported once, with inotify and when polling.
+        for use_inotify in (True, False):
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'profile.plp')
+                other = os.path.join(directory, 'other.plp')
+                with open(path, 'w') as f:
+                    f.write('{}')
+                changes = queue.Queue()
+                watcher = ambit.watch.ConfigWatcher(
+                        [path], changes.put, poll_seconds=0.05, use_inotify=use_inotify)
+                self.assertEqual(use_inotify, watcher.inotify is not None)
+                watcher.start()
+                try:
+                    with open(other, 'w') as f:
+                        f.write('{}')
+                    # editors often replace the file rather than write it.
+                    with open(path + '.tmp', 'w') as f:
+                        f.write('{"title": "changed"}')
+                    os.replace(path + '.tmp', path)
+                    self.assertEqual([path], changes.get(timeout=5))
+                    time.sleep(ambit.watch.ConfigWatcher.DEBOUNCE_SECONDS * 2)
+                    self.assertTrue(changes.empty())
+                finally:
+                    watcher.stop()
+
+
+class AmbitCommandTest(unittest.TestCase):
+    def test_command_runner_coalesces(self):
+        # values arriving while the command runs collapse to the latest,
+        # and AMBIT_VALUE is passed without touching os.environ.
+        done = threading.Event()
+        output = []
+        runner = ambit.CommandRunner(
+                ['sh', '-c', 'sleep 0.2; echo %AMBIT_VALUE% $AMBIT_VALUE'],
+                output_callback=output.append,
+                done_callback=lambda: runner.idle() and done.set())
+        for value in range(1, 5):
+            runner.run(value)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(['1 1', '4 4'], output)
+        self.assertEqual(2, runner.coalesced)
+        self.assertNotIn('AMBIT_VALUE', os.environ)
+
+    def test_command_cache(self):
+        # fresh output is reused, expired entries are dropped and the least
+        # recently used entry is evicted beyond max_entries.
+        cache = ambit.CommandCache(0.1, max_entries=2)
+        cache.put('a', 'A')
+        cache.put('b', 'B')
+        self.assertEqual('A', cache.get('a'))
+        cache.put('c', 'C')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual('A', cache.get('a'))
+        time.sleep(0.15)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(2, cache.hits)
+
+    def test_command_runner_debounce(self):
+        done = threading.Event()
+        output = []
+        runner = ambit.CommandRunner(
+                ['echo', '%AMBIT_VALUE%'], output_callback=output.append,
+                debounce=0.1, done_callback=lambda: runner.idle() and done.set())
+        for value in range(1, 5):
+            runner.run(value)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(['4'], output)
+        self.assertEqual(1, runner.launched)
+
+
+class AmbitCaptureTest(unittest.TestCase):
+    def test_capture_messages(self):
+        with ambit.capture.Capture('docs/captures/test-button-press-release.pcapng') as capture:
+            self.assertEqual([
+                {'in': [{'i': 2, 'v': [1, 0, 0, 0, 0, 0, 0, 0]}]},
+                {'in': [{'i': 2, 'v': [0, 0, 0, 0, 0, 0, 0, 0]}]},
+            ], list(capture.messages()))
+            self.assertEqual([{'check': 1}], list(capture.messages(inbound=False)))
+
+    def test_capture_images(self):
+        # the images uploaded in the capture are the shipped reference assets.
+        with ambit.capture.Capture('docs/captures/core-update-images.pcapng') as capture:
+            images = dict(capture.images())
+        self.assertEqual(23, len(images))
+        with open('ambit/resources/assets/reference/0.raw', 'rb') as f:
+            self.assertEqual(f.read(), images[0])
+
+    def test_capture_packet_outlives_close(self):
+        with ambit.capture.Capture('docs/captures/test-button-press-release.pcapng') as capture:
+            packet = next(capture.bulk_payloads(inbound=True))
+        self.assertEqual(b'{"in"', bytes(packet.data[:5]))
+
+
+class AmbitMetricsTest(unittest.TestCase):
+    def test_prometheus_text(self):
+        registry = ambit.metrics.MetricsRegistry()
+        counter = registry.counter('test_total', 'Test counter.')
+        counter.inc(labels={'reason': 'a'})
+        counter.inc(2, labels={'reason': 'a'})
+        histogram = registry.histogram('test_seconds', 'Test histogram.', (0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        self.assertEqual('\n'.join([
+            '# HELP test_total Test counter.',
+            '# TYPE test_total counter',
+            'test_total{reason="a"} 3',
+            '# HELP test_seconds Test histogram.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{le="0.1"} 1',
+            'test_seconds_bucket{le="1"} 2',
+            'test_seconds_bucket{le="+Inf"} 3',
+            'test_seconds_sum 5.55',
+            'test_seconds_count 3',
+        ]) + '\n', registry.prometheus_text())
+
+    def test_controller_metrics(self):
+        device = ambit.fake.Device('DEAD:BEEF', 'XYZ')
+        config = ambit.Configuration()
+        ctrl = ambit.Controller(config, device)
+        ctrl.led([{'i': 1, 'r': 255, 'g': 0, 'b': 0, 'm': 0}])
+        ctrl.screen_string('METRICS')
+        text = ctrl.metrics.prometheus_text()
+        self.assertIn('ambit_queue_depth{queue="led"} 1', text)
+        self.assertIn('ambit_queue_depth{queue="screen_string"} 1', text)
+        self.assertIn('ambit_failed_reads_total 0', text)
+        snapshot = ctrl.metrics.snapshot()
+        self.assertEqual('counter', snapshot['metrics']['ambit_dropped_total']['type'])
+
+    def test_input_callback_seconds(self):
+        # only inputs which trigger their callback are observed.
+        ctrl = ambit.Controller(ambit.Configuration(), ambit.fake.Device('DEAD:BEEF', 'XYZ'))
+        ctrl.version_core = '9.9.9'
+        ctrl.layout.update(ambit.fake.LAYOUT_DEFAULT_PROKIT)
+        dial = ctrl.layout.query('[kind=Dial]')[0]
+        behavior = ambit.component.ComponentBehavior(
+                ambit.component.ComponentBehavior.DELTA, threshold=4)
+        behavior.finalize()
+        triggered = []
+        dial.set_callback(ambit.Configuration.INPUT_ROTATION_RIGHT, 'test', behavior, triggered.append, {})
+        for _ in range(4):
+            ctrl.process_input([{'i': dial.index, 'v': [0, 0, 1, 0, 0, 0, 0, 0]}])
+        self.assertEqual([4], triggered)
+        self.assertIn('ambit_input_callback_seconds_count 1', ctrl.metrics.prometheus_text())
+
 
 # Minimal stand-in for a pyusb core device, as enumerated by usb.core.find
 # in Device._discover, so discovery can be exercised without hardware.
@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+
+import ambit.capture
+
+if len(sys.argv) != 3:
+    print('usage:', sys.argv[0], '<pcapng> <out_dir>')
+    sys.exit(1)
+
+with ambit.capture.Capture(sys.argv[1]) as capture:
+    for index, image in capture.images():
+        raw_path = os.path.join(sys.argv[2], '%d.raw' % index)
+        with open(raw_path, 'wb') as f:
+            f.write(image)
+        print('[*] Finished writing screen image %d to %s' % (index, raw_path))